@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 {
     'name': 'DPD HOME delivery for BENELUX only',
-    'version': '11.0.0.0.2',
+    'version': '11.0.0.0.6',
     'author': "Jean-Paul Robineau",
     'category': 'Delivery',
     'summary': "DPD Delivery For BENELUX only",
@@ -11,20 +11,38 @@
         'stock',
     ],
     'description': """DPD Delivery For BENELUX only
+
+The shipping cost simulation needs the numpy Python library, it is
+disabled without it.
 """,
     'website': 'http://www.apertoso.be/',
     'data': [
         'security/ir.model.access.csv',
         'data/synchro_action_rule_data.xml',
+        'wizard/price_simulation_view.xml',
         'views/delivery_dpd_view.xml',
         'views/picking_view.xml',
+        'views/shipment_job_view.xml',
+        'views/parcel_shop_view.xml',
+        'views/metric_summary_view.xml',
+        'views/rate_limit_view.xml',
+        'views/tracking_event_view.xml',
+        'views/delivery_state_report_view.xml',
         'wizard/wizard_test_connection_view.xml',
     ],
     'demo': [
     ],
-    'external_dependencies': {'python': ['zeep']},
+    'external_dependencies': {'python': ['zeep', 'PyPDF2']},
     'license': 'OPL-1',
-    'tests': [],
+    'tests': [
+        'tests/test_envelope.py',
+        'tests/test_guard.py',
+        'tests/test_parser.py',
+        'tests/test_price_simulation.py',
+        'tests/test_rate_cache.py',
+        'tests/test_sync_claim.py',
+        'tests/test_tracking_push.py',
+    ],
     'installable': True,
     'auto_install': False,
     'application': False,
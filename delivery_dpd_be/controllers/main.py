@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+import base64
+import functools
+import hmac
+import io
+import tempfile
+
+from werkzeug.exceptions import NotFound
+
+from odoo import http
+from odoo.http import request
+from odoo.tools import config
+
+from odoo.addons.delivery_dpd_be.models import dpd_cache
+from odoo.addons.delivery_dpd_be.models import dpd_client
+from odoo.addons.delivery_dpd_be.models import dpd_label
+from odoo.addons.delivery_dpd_be.models import dpd_metrics
+from odoo.addons.delivery_dpd_be.models import parcel_shop
+
+MAX_PARCEL_SHOPS = 50
+MAX_PUSHED_EVENTS = 5000
+
+
+def check_token(option, token=None):
+    '''
+    Check the token of a request against a server option, given as a
+    bearer token or a token parameter, no token is accepted when the
+    option isn't set
+    '''
+    expected = config.get(option)
+    authorization = request.httprequest.headers.get('Authorization', '')
+    if authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+    return bool(expected and token and
+                hmac.compare_digest(str(token), str(expected)))
+
+
+class DPDLabelController(http.Controller):
+
+    @http.route('/delivery_dpd_be/label/<int:picking_id>', type='http',
+                auth='user')
+    def download_label(self, picking_id, **kwargs):
+        picking = request.env['stock.picking'].browse(picking_id).exists()
+        if not picking:
+            return request.not_found()
+        picking.check_access_rights('read')
+        picking.check_access_rule('read')
+        attachment = picking._dpd_get_label_attachment()
+        if not attachment:
+            return request.not_found()
+        filename = picking.dpd_label_name or '%s.pdf' % picking.name
+        # Stream the file from the filestore instead of loading it
+        if attachment.store_fname:
+            filepath = attachment._full_path(attachment.store_fname)
+        else:
+            filepath = io.BytesIO(base64.b64decode(attachment.db_datas))
+        return http.send_file(filepath, filename=filename,
+                              mimetype='application/pdf',
+                              mtime=attachment.write_date,
+                              as_attachment=True)
+
+    @http.route('/delivery_dpd_be/labels', type='http', auth='user')
+    def download_labels(self, ids=None, four_up='0', **kwargs):
+        try:
+            picking_ids = [int(picking_id) for picking_id in ids.split(',')]
+        except (AttributeError, ValueError):
+            return http.Response(
+                'Expected comma separated picking ids', status=400)
+        pickings = request.env['stock.picking'].browse(picking_ids).exists()
+        pickings.check_access_rights('read')
+        pickings.check_access_rule('read')
+        if len(pickings) > dpd_label.MAX_LABELS:
+            return http.Response(
+                'At most %s labels can be merged' % dpd_label.MAX_LABELS,
+                status=400)
+        label_openers = []
+        checksums = set()
+        for picking in pickings:
+            attachment = picking._dpd_get_label_attachment()
+            # The pickings of the former A4 batches share the same document
+            if not attachment or attachment.checksum in checksums:
+                continue
+            checksums.add(attachment.checksum)
+            # The files are only opened when their chunk is merged
+            if attachment.store_fname:
+                label_openers.append(functools.partial(
+                    open, attachment._full_path(attachment.store_fname),
+                    'rb'))
+            else:
+                label_openers.append(
+                    lambda datas=attachment.db_datas: io.BytesIO(
+                        base64.b64decode(datas)))
+        if not label_openers:
+            return request.not_found()
+        output = tempfile.TemporaryFile()
+        dpd_label.merge_label_pdfs(label_openers, output,
+                                   four_up=four_up == '1')
+        output.seek(0)
+        return http.send_file(output, filename='dpd_labels.pdf',
+                              mimetype='application/pdf',
+                              as_attachment=True)
+
+
+class DPDParcelShopController(http.Controller):
+
+    @http.route('/delivery_dpd_be/parcel_shops', type='json', auth='public')
+    def parcel_shops(self, latitude=None, longitude=None, country=None,
+                     zip_code=None, city=None, carrier_id=None, limit=10,
+                     **kwargs):
+        # Public route, the invalid parameters find no shop
+        try:
+            carrier_id = carrier_id and int(carrier_id)
+            limit = max(1, min(int(limit), MAX_PARCEL_SHOPS))
+            if latitude is not None and longitude is not None:
+                latitude, longitude = float(latitude), float(longitude)
+                if not parcel_shop.is_supported(latitude, longitude):
+                    return []
+            else:
+                latitude = longitude = None
+        except (TypeError, ValueError, OverflowError):
+            return []
+        if latitude is None and not (
+                isinstance(country, str) and isinstance(zip_code, str) and
+                (city is None or isinstance(city, str))):
+            return []
+        carrier_model = request.env['delivery.carrier'].sudo()
+        domain = [('delivery_type', '=', 'dpd_be')]
+        if carrier_id:
+            domain.append(('id', '=', carrier_id))
+        carrier = carrier_model.search(domain, limit=1)
+        if not carrier:
+            return []
+        return carrier.dpd_find_parcel_shops(
+            latitude=latitude, longitude=longitude, country=country,
+            zip_code=zip_code, city=city, limit=limit)
+
+
+class DPDMetricsController(http.Controller):
+
+    @http.route('/delivery_dpd_be/metrics', type='http', auth='none')
+    def metrics(self, token=None, **kwargs):
+        # Only served when dpd_metrics_token is set in the server
+        # configuration
+        if not check_token('dpd_metrics_token', token):
+            return request.not_found()
+        stats = dpd_cache.rate_cache.stats()
+        gauges = {
+            'dpd_rate_cache_entries': stats['size'],
+            'dpd_wsdl_clients': len(dpd_client._clients),
+            'dpd_cached_tokens': len(dpd_client._tokens),
+        }
+        return request.make_response(
+            dpd_metrics.render(gauges),
+            headers=[('Content-Type', 'text/plain; version=0.0.4')])
+
+
+class DPDTrackingPushController(http.Controller):
+    # The notifications are only buffered, the ir_cron_dpd_tracking_push
+    # cron applies them. Only served when dpd_push_token is set in the
+    # server configuration.
+
+    @http.route('/delivery_dpd_be/tracking/push', type='http', auth='none',
+                methods=['GET', 'POST'], csrf=False)
+    def tracking_push(self, token=None, **kwargs):
+        # One notification in the parameters of the request
+        if not check_token('dpd_push_token', token) or not request.db:
+            return request.not_found()
+        error = self._buffer_events([kwargs])
+        if error:
+            return http.Response(error, status=400)
+        return http.Response('OK', status=202)
+
+    @http.route('/delivery_dpd_be/tracking/push_batch', type='json',
+                auth='none', csrf=False)
+    def tracking_push_batch(self, events=None, token=None, **kwargs):
+        # A list of notifications, as the params of a JSON-RPC request
+        if not check_token('dpd_push_token', token) or not request.db:
+            raise NotFound()
+        error = self._buffer_events(events)
+        if error:
+            return {'error': error}
+        return {'accepted': len(events)}
+
+    def _buffer_events(self, events):
+        '''
+        :param events: list of dicts with parcel_number, status, timestamp
+                       and depot
+        :return: error message or None
+        '''
+        if not isinstance(events, list) or \
+                len(events) > MAX_PUSHED_EVENTS or \
+                not all(isinstance(event, dict) and
+                        event.get('parcel_number') for event in events):
+            return 'Expected at most %s notifications with a ' \
+                   'parcel_number' % MAX_PUSHED_EVENTS
+        request.env['dpd.tracking.push'].sudo()._buffer([{
+            'parcel_number': str(event['parcel_number']),
+            'status': event.get('status') and str(event['status']),
+            'timestamp': event.get('timestamp') and str(event['timestamp']),
+            'depot': event.get('depot') and str(event['depot']),
+        } for event in events])
+        return None
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import api, SUPERUSER_ID
+
+from odoo.addons.delivery_dpd_be.models import dpd_label
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    # dpd_label_bin is now stored as an attachment, move the labels out of
+    # the column of stock_picking
+    cr.execute("""
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'stock_picking' AND column_name = 'dpd_label_bin'
+    """)
+    if not cr.fetchone():
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    cr.execute("""
+        SELECT id FROM stock_picking WHERE dpd_label_bin IS NOT NULL
+    """)
+    picking_ids = [row[0] for row in cr.fetchall()]
+    _logger.info("Moving %s DPD labels to attachments", len(picking_ids))
+    for picking_id in picking_ids:
+        cr.execute("SELECT dpd_label_bin FROM stock_picking WHERE id = %s",
+                   (picking_id,))
+        label = dpd_label.label_from_base64(bytes(cr.fetchone()[0]))
+        env['stock.picking'].browse(picking_id)._dpd_store_label(label)
+        label.close()
+    cr.execute("ALTER TABLE stock_picking DROP COLUMN dpd_label_bin")
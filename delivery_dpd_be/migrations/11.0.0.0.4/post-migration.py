@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import api, SUPERUSER_ID
+
+from odoo.addons.delivery_dpd_be.models import dpd_parser
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    # The rows of stock.picking.delivery become tracking events, the table
+    # is dropped with the model at the end of the update
+    cr.execute("""
+        SELECT 1 FROM information_schema.tables
+        WHERE table_name = 'stock_picking_delivery'
+    """)
+    if not cr.fetchone():
+        return
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    cr.execute("""
+        SELECT picking_id, state, date, location, extra_info
+        FROM stock_picking_delivery
+        WHERE picking_id IS NOT NULL AND state IS NOT NULL AND reached
+        ORDER BY id
+    """)
+    events = [{
+        'picking_id': picking_id,
+        'state': state,
+        'date': dpd_parser.parse_date(date),
+        'location': location,
+        'description': extra_info,
+    } for picking_id, state, date, location, extra_info in cr.fetchall()]
+    _logger.info("Moving %s DPD delivery states to tracking events",
+                 len(events))
+    env['stock.picking.tracking.event']._append(events)
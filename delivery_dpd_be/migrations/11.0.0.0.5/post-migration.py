@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import api, SUPERUSER_ID
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    # The delivery state analysis is built from the existing events once,
+    # the tracking updates refresh it afterwards
+    _logger.info("Building the DPD delivery state analysis")
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    env['dpd.delivery.state.report']._refresh()
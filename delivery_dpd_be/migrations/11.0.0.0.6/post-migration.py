@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from odoo import api, SUPERUSER_ID
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    # The synchronisation cron is in a noupdate block, its new interval is
+    # only set when it was left to the former default
+    env = api.Environment(cr, SUPERUSER_ID, {})
+    crons = env['ir.cron'].with_context(active_test=False).search([
+        ('code', 'in', ('model._check_delivery_synchro()',
+                        'model._check_delivery_synchro(runner=True)')),
+    ])
+    cron = env.ref('delivery_dpd_be.ir_cron_delivery_synchronisation',
+                   raise_if_not_found=False)
+    if cron:
+        crons |= cron.with_context(active_test=False)
+    crons = crons.filtered(lambda c: c.interval_number == 4 and
+                           c.interval_type == 'hours')
+    _logger.info("Running %s DPD synchronisation crons every 15 minutes",
+                 len(crons))
+    crons.write({
+        'interval_number': 15,
+        'interval_type': 'minutes',
+    })
+    # The copies of the synchronisation cron were left active when it was
+    # turned off
+    if cron and not cron.active:
+        env['stock.picking']._dpd_set_sync_active(False)
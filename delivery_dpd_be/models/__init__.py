@@ -1,4 +1,11 @@
 # -*- coding: utf-8 -*-
 
 from . import delivery_dpd
-from . import picking
\ No newline at end of file
+from . import picking
+from . import shipment_job
+from . import parcel_shop
+from . import metric_summary
+from . import rate_limit
+from . import tracking_event
+from . import tracking_push
+from . import delivery_state_report
@@ -1,18 +1,62 @@
 import logging
 import math
+import operator
+import time
+from concurrent import futures
 from datetime import datetime, timedelta
 
+import psycopg2
 import requests
 from lxml import etree
-from zeep import Client, exceptions as zeep_exceptions
+from zeep import exceptions as zeep_exceptions
 
-from odoo import fields, models, api, exceptions, _
-from odoo.tools.safe_eval import safe_eval
+from odoo import fields, models, api, exceptions, tools, _
+from odoo.tools import config
+
+from . import dpd_cache
+from . import dpd_client
+from . import dpd_envelope
+from . import dpd_guard
+from . import dpd_label
+from . import dpd_metrics
+from . import dpd_parser
+from . import parcel_shop
 
 _logger = logging.getLogger(__name__)
 price_types = [('fixed', 'Fixed price '),
                ('customer_price', 'Customer price')
                ]
+# DPD tokens are valid for 24h, they are refreshed one hour earlier
+TOKEN_LIFETIME = timedelta(hours=24)
+TOKEN_REFRESH_MARGIN = timedelta(hours=1)
+LOGIN_LOCK_ATTEMPTS = 30
+# A change of these fields logs in to another DPD account
+DPD_ACCOUNT_FIELDS = ('dpd_delis_id', 'dpd_password', 'prod_environment')
+AUTH_ERROR = 'AUTH_ERROR'
+# Shops asked to DPD per grid cell or postcode
+PARCEL_SHOP_FETCH_LIMIT = 100
+
+
+
+class NoAnswer(str):
+    '''
+    Error of a storeOrders request sent to DPD which got no answer, DPD
+    may have stored the shipments
+    '''
+
+
+class NoAnswerError(exceptions.ValidationError):
+    '''
+    None of the shipments were confirmed and some of them may be stored by
+    DPD, they must not be sent again without checking
+    '''
+
+
+price_rule_operators = {'==': operator.eq,
+                        '<=': operator.le,
+                        '<': operator.lt,
+                        '>=': operator.ge,
+                        '>': operator.gt}
 
 dpd_mapping = {
     'getAuth': {
@@ -45,6 +89,16 @@ dpd_mapping = {
         'errorcode': "errorCode",
         'errormessage': "errorMessage",
     },
+    'findParcelShops': {
+        'stage-url': 'https://public-dis-stage.dpd.nl/Services/'
+                     'ParcelShopFinderService.svc?singlewsdl',
+        'life-url': 'https://public-dis.dpd.nl/Services/'
+                    'ParcelShopFinderService.svc?singlewsdl',
+        'SOAPAction': 'http://dpd.com/common/service/'
+                      'ParcelShopFinderService/3.0/findParcelShops',
+        'errorcode': "faultCodeField",
+        'errormessage': "messageField",
+    },
     'findParcelShopsByGeoData': {
         'stage-url': 'https://public-dis-stage.dpd.nl/Services/'
                      'ParcelShopFinderService.svc?singlewsdl',
@@ -58,6 +112,19 @@ dpd_mapping = {
 }
 
 
+def get_service_url(action, environment):
+    '''
+    URL of a DPD service, dpd_service_url in the server configuration
+    replaces the DPD host, like by the one of scripts/fake_dpd_server.py
+    '''
+    url = dpd_mapping.get(action).get('%s-url' % environment)
+    base_url = config.get('dpd_service_url')
+    if base_url:
+        url = '%s/Services/%s' % (base_url.rstrip('/'),
+                                  url.split('/Services/', 1)[1])
+    return url
+
+
 def get_data(nd, fld):
     att_value = nd.find(fld)
     if att_value is not None and att_value.text is not None:
@@ -65,10 +132,148 @@ def get_data(nd, fld):
     return ''
 
 
+def compile_price_rule(line):
+    # Plain values of a delivery.price.rule, or of a rule with its fields
+    return (line.variable, price_rule_operators[line.operator],
+            line.max_value, line.price_type == 'fixed', line.list_base_price,
+            line.list_price, line.variable_factor, line.quantity_per_value)
+
+
 def get_dpd_weight(weight):
     return math.trunc(weight * 100)
 
 
+def send_message(url, action, encoded_request, stream=False, dbname=None):
+    '''
+    Post a SOAP request to DPD, doesn't use the ORM so it can run in a
+    worker thread
+    :param stream: don't download the body of a successful response, it
+                   is read by dpd_parser.parse_response
+    :param dbname: database of the shared rate limit of the service, the
+                   call isn't limited without it
+    :return: error message/False, response/None
+    '''
+    breaker = dpd_guard.get_breaker(action, url)
+    if breaker.state == 'open':
+        dpd_metrics.inc('dpd_breaker_rejected_total', action=action)
+        return _('DPD %s is unavailable, calls resume in %d seconds') % (
+            action, breaker.retry_after()), None
+    if dbname and not dpd_guard.acquire(dbname, action, url):
+        dpd_metrics.inc('dpd_rate_limited_total', action=action)
+        return _('Too many DPD %s calls, try again later') % action, None
+    if not breaker.allow():
+        # Another call is probing the service
+        dpd_metrics.inc('dpd_breaker_rejected_total', action=action)
+        return _('DPD %s is unavailable, calls resume in %d seconds') % (
+            action, breaker.retry_after()), None
+    try:
+        return _send_message(breaker, url, action, encoded_request,
+                             stream=stream)
+    finally:
+        # An unexpected exception during a probe doesn't leave the service
+        # half open for ever
+        breaker.release()
+
+
+def _send_message(breaker, url, action, encoded_request, stream=False):
+    error = False
+    headers = {
+        "Content-Type": "text/xml; charset=UTF-8",
+        "Content-Length": str(len(encoded_request)),
+        "SOAPAction": dpd_mapping.get(action).get('SOAPAction')
+    }
+
+    start = time.time()
+    try:
+        response = dpd_client.post(url=url,
+                                   headers=headers,
+                                   data=encoded_request,
+                                   stream=stream,
+                                   action=action)
+    except requests.exceptions.RequestException as e:
+        _logger.info("DPD %s request failed: %s", action, e)
+        dpd_metrics.record_call(action, time.time() - start,
+                                len(encoded_request), 0,
+                                error_code=type(e).__name__)
+        dpd_guard.record_result(action, url, failed=True)
+        if action in dpd_client.NON_IDEMPOTENT_ACTIONS and \
+                dpd_client.is_unanswered(e):
+            return NoAnswer(_('DPD did not answer, check whether the '
+                              'shipment was stored: %s') % e), None
+        return _('DPD could not be reached: %s') % e, None
+    duration = time.time() - start
+    error_code = None
+    # A SOAP fault means the service works, only unanswered calls and
+    # server errors without fault count for the breaker
+    failed = False
+    if response.status_code != 200:
+        error_code = 'HTTP_%s' % response.status_code
+        node = None
+        try:
+            node = etree.fromstring(response.content)
+            expr = '//*[local-name()=$name]'
+            errorcode = node.xpath(expr, name=dpd_mapping.get(action).get(
+                'errorcode'))[0].text
+            errormessage = \
+                node.xpath(expr, name=dpd_mapping.get(action).get(
+                    'errormessage'))[0].text
+            error = 'Error: %s\nError message: %s' % (errorcode,
+                                                      errormessage)
+            error_code = errorcode or error_code
+        except (etree.XMLSyntaxError, IndexError):
+            _logger.info(encoded_request)
+            # After the retries on 5xx DPD may answer with a proxy
+            # error page instead of a SOAP fault
+            _logger.info(response.content)
+            error = 'An error has occured'
+        failed = response.status_code >= 500 and (
+            node is None or not node.xpath('//*[local-name()="Fault"]'))
+        # A gateway error may come after DPD handled the request
+        if failed and response.status_code in (502, 504) and \
+                action in dpd_client.NON_IDEMPOTENT_ACTIONS:
+            error = NoAnswer(_('DPD did not answer, check whether the '
+                               'shipment was stored: %s') % error_code)
+    if stream and not error_code:
+        # The body is counted by dpd_parser.parse_response
+        received = 0
+    else:
+        received = len(response.content)
+    retries = getattr(response.raw, 'retries', None)
+    dpd_metrics.record_call(
+        action, duration, len(encoded_request), received,
+        error_code=error_code,
+        retries=retries is not None and len(retries.history) or 0)
+    dpd_guard.record_result(action, url, failed=failed)
+    return error, response
+
+
+def is_auth_error(action, content):
+    '''
+    Check if DPD refused the request because of the authentication token
+    '''
+    try:
+        node = etree.fromstring(content)
+    except etree.XMLSyntaxError:
+        return False
+    codes = node.xpath(
+        '//*[local-name()=$name or local-name()="errorCode"]/text()',
+        name=dpd_mapping.get(action).get('errorcode'))
+    return any(code.startswith('LOGIN_') for code in codes)
+
+
+def fetch_tracking_data(url, encoded_request, dbname=None):
+    action = 'getTrackingData'
+    error, response = send_message(url=url, action=action,
+                                   encoded_request=encoded_request,
+                                   stream=True, dbname=dbname)
+    if error and response is not None and \
+            is_auth_error(action, response.content):
+        return AUTH_ERROR
+    if error:
+        return error
+    return dpd_parser.parse_response(response, action).states
+
+
 class ProviderDPDBE(models.Model):
     _inherit = 'delivery.carrier'
 
@@ -106,6 +311,19 @@ class ProviderDPDBE(models.Model):
         string='DPD Shipping Type',
         default='CL',
     )
+    dpd_batch_size = fields.Integer(
+        string='Orders per request',
+        default=30,
+        help='When several pickings are shipped at once, their orders are '
+             'sent to DPD in requests of this many orders. The A4 labels '
+             'are always requested one order at a time.',
+    )
+    dpd_queue_shipments = fields.Boolean(
+        string='Send shipments in background',
+        help='Validating a picking queues its shipment instead of waiting '
+             'for DPD, the queue is sent by a scheduled action which '
+             'retries the failed shipments.',
+    )
     dpd_shipping_cost = fields.Float(
         string='Fixed Shipping Cost',
         help='As DPD doesnot provide the shipping cost, you can manually '
@@ -138,11 +356,61 @@ class ProviderDPDBE(models.Model):
         default='fixed'
     )
 
+    dpd_rate_cache_hits = fields.Integer(
+        string='Cached quotes',
+        compute='_compute_dpd_rate_cache_stats',
+    )
+    dpd_rate_cache_misses = fields.Integer(
+        string='Computed quotes',
+        compute='_compute_dpd_rate_cache_stats',
+    )
+
+    @api.multi
+    def _compute_dpd_rate_cache_stats(self):
+        # Statistics of this worker since its start
+        stats = dpd_cache.rate_cache.stats()
+        for carrier in self:
+            carrier.dpd_rate_cache_hits = stats['hits']
+            carrier.dpd_rate_cache_misses = stats['misses']
+
+    @api.model_cr
+    def init(self):
+        # Version of the price rules and prices the quotes are computed
+        # with, shared by all the workers
+        self.env.cr.execute("CREATE SEQUENCE IF NOT EXISTS dpd_rate_version")
+
+    @api.model
+    def _dpd_rate_version(self):
+        self.env.cr.execute("SELECT last_value FROM dpd_rate_version")
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _dpd_bump_rate_version(self):
+        '''
+        Drop the cached quotes and compiled price rules of all the workers,
+        their keys hold the version
+        '''
+        self.env.cr.execute("SELECT nextval('dpd_rate_version')")
+        dpd_cache.rate_cache.clear()
+
+    @api.multi
+    def write(self, vals):
+        self._dpd_bump_rate_version()
+        if any(name in vals for name in DPD_ACCOUNT_FIELDS):
+            # The token, depot and customer uid belong to the former account
+            vals = dict(vals, dpd_token=False, dpd_depot=False,
+                        dpd_customer_uid=False, dpd_login_date=False)
+            for carrier in self:
+                dpd_client.drop_tokens(self.env.cr.dbname, carrier.id)
+        res = super(ProviderDPDBE, self).write(vals)
+        if 'prod_environment' in vals:
+            self.action_dpd_reload_wsdl()
+        return res
+
     @api.onchange('dpd_auto_sync_delivery')
     def onchange_dpd_auto_sync_delivery(self):
-        self.env.ref('delivery_dpd_be.'
-                     'ir_cron_delivery_synchronisation').write(
-            {'active': self.dpd_auto_sync_delivery})
+        self.env['stock.picking']._dpd_set_sync_active(
+            self.dpd_auto_sync_delivery)
 
     def dpd_be_rate_shipment(self, order):
         '''
@@ -153,6 +421,41 @@ class ProviderDPDBE(models.Model):
                    'error_message': a string containing an error message,
                    'warning_message': a string containing a warning message}
         '''
+        # Repeated quotes for an unchanged cart are served from the cache
+        key = self._get_rate_cache_key(order)
+        res = dpd_cache.rate_cache.get(key)
+        dpd_metrics.inc('dpd_rate_cache_total',
+                        result=res is None and 'miss' or 'hit')
+        if res is None:
+            res = self._dpd_be_compute_rate(order)
+            dpd_cache.rate_cache.set(key, res)
+        return dict(res)
+
+    def _get_rate_cache_key(self, order):
+        total = weight = volume = quantity = 0.0
+        for line in order.order_line:
+            if line.state == 'cancel':
+                continue
+            if line.is_delivery:
+                total -= line.price_total
+                continue
+            if not line.product_id:
+                continue
+            qty = line.product_uom._compute_quantity(
+                line.product_uom_qty, line.product_id.uom_id)
+            weight += (line.product_id.weight or 0.0) * qty
+            volume += (line.product_id.volume or 0.0) * qty
+            quantity += qty
+        total += order.amount_total or 0.0
+        partner = order.partner_shipping_id
+        return (self.env.cr.dbname, self._dpd_rate_version(), self.id,
+                order.carrier_id.id, order.pricelist_id.id,
+                order.currency_id.id, partner.country_id.id,
+                partner.state_id.id, partner.zip,
+                round(weight, 2), round(volume, 4), round(quantity, 2),
+                round(total, 2))
+
+    def _dpd_be_compute_rate(self, order):
         res = {'success': True,
                'price': 0.0,
                'error_message': False,
@@ -193,29 +496,60 @@ class ProviderDPDBE(models.Model):
         }
 
     def get_order(self, picking):
-        return {
-            'generalShipmentData':
-                {'sendingDepot': self.dpd_depot,
-                 'product': self.dpd_shipping_type,
-                 'sender': self.get_sender_recipient(
-                     picking.picking_type_id.warehouse_id.partner_id),
-                 'recipient': self.get_sender_recipient(
-                     picking.partner_id),
-                 },
-            'parcels': self.get_parcels(picking=picking),
-            'productAndServiceData': {
-                'orderType': 'consignment'}
-        }
+        return self.get_orders(picking)[picking.id]
 
-    def get_parcels(self, picking):
-        parcels = []
-        for line in picking.dpd_parcel_ids:
-            parcel = {
-                'customerReferenceNumber1': line.name,
-                'weight': get_dpd_weight(line.weight),
+    def get_orders(self, pickings):
+        '''
+        Build the storeOrders orders of several pickings, the partners,
+        their states and countries and the parcels are read at once for
+        all the pickings and the sender of a warehouse is built once
+        :return: dict {picking id: order}
+        '''
+        warehouse_partners = pickings.mapped(
+            'picking_type_id.warehouse_id.partner_id')
+        partners = pickings.mapped('partner_id') | warehouse_partners
+        partners.mapped('state_id.name')
+        partners.mapped('country_id.code')
+        parcels = self.get_parcels_by_picking(pickings)
+
+        depot = self._dpd_get_auth()['depot']
+        senders = {}
+        res = {}
+        for picking in pickings:
+            warehouse = picking.picking_type_id.warehouse_id
+            if warehouse.id not in senders:
+                senders[warehouse.id] = self.get_sender_recipient(
+                    warehouse.partner_id)
+            res[picking.id] = {
+                'generalShipmentData':
+                    {'sendingDepot': depot,
+                     'product': self.dpd_shipping_type,
+                     'sender': senders[warehouse.id],
+                     'recipient': self.get_sender_recipient(
+                         picking.partner_id),
+                     },
+                'parcels': parcels.get(picking.id, []),
+                'productAndServiceData': {
+                    'orderType': 'consignment'}
             }
-            parcels.append(parcel)
-        return parcels
+        return res
+
+    def get_parcels(self, picking):
+        return self.get_parcels_by_picking(picking).get(picking.id, [])
+
+    def get_parcels_by_picking(self, pickings):
+        '''
+        :return: dict {picking id: list of parcels}
+        '''
+        res = {}
+        for line in self.env['stock.picking.parcel'].search_read(
+                [('picking_id', 'in', pickings.ids)],
+                ['picking_id', 'name', 'weight'], order='id'):
+            res.setdefault(line['picking_id'][0], []).append({
+                'customerReferenceNumber1': line['name'],
+                'weight': get_dpd_weight(line['weight']),
+            })
+        return res
 
     def get_print_options(self):
         return {
@@ -228,7 +562,7 @@ class ProviderDPDBE(models.Model):
             'authentication':
                 {
                     'delisId': self.dpd_delis_id,
-                    'authToken': self.dpd_token,
+                    'authToken': self._dpd_get_auth()['authToken'],
                     'messageLanguage': self.env.user.lang
                 }
         }
@@ -248,50 +582,128 @@ class ProviderDPDBE(models.Model):
         if not successfull:
             raise exceptions.AccessError(error)
 
+        # Send the pickings in batches of storeOrders requests, the orders
+        # of all the batches are built at once
+        orders = self.get_orders(pickings)
+        results = {}
+        batch_size = max(self.dpd_batch_size, 1)
+        for start in range(0, len(pickings), batch_size):
+            results.update(self.dpd_store_orders(
+                pickings[start:start + batch_size], orders=orders))
+
+        errors = [(picking, results[picking.id]) for picking in pickings
+                  if not isinstance(results[picking.id], tuple)]
+        if errors and len(errors) == len(pickings):
+            message = '\n'.join('%s: %s' % (picking.name, error)
+                                for picking, error in errors)
+            if any(isinstance(error, NoAnswer) for picking, error in errors):
+                raise NoAnswerError(message)
+            raise exceptions.ValidationError(message)
+        # Only the faulty orders of a batch fail, log why on their picking
+        for picking, error in errors:
+            picking.message_post(
+                body=_("Shipment could not be sent to DPD: %s") % error)
+
         res = []
         for picking in pickings:
             shipping_data = {
                 'tracking_number': "",
-                'exact_price': 0.0
+                'exact_price': 0.0,
+                # DPD may have stored the shipment without answering
+                'dpd_no_answer': isinstance(results[picking.id], NoAnswer),
             }
-            try:
-                order = self.get_order(picking=picking)
-
-                action = 'storeOrders'
-                client = Client(self.dpd_get_url(action=action))
-
-                request = client.service._binding.create_message(
-                    action,
-                    printOptions=self.get_print_options(),
-                    order=order,
-                    _soapheaders=self.get_soap_headers())
-
-                error, response = self.dpd_send_message(action=action,
-                                                        request=request)
-                if error:
-                    raise exceptions.AccessError(error)
-
-                node = etree.fromstring(response.content)
-                pl_pdf = node.xpath('//parcellabelsPDF')[0].text
-                pl_num = node.xpath('//parcelLabelNumber')[0].text
-
-                picking.dpd_label_bin = pl_pdf
+            if isinstance(results[picking.id], tuple):
+                pl_num, label = results[picking.id]
                 picking.dpd_label_name = '%s.pdf' % picking.name
+                picking._dpd_store_label(label)
                 shipping_data.update({'tracking_number': pl_num})
+            res = res + [shipping_data]
+        return res
 
-            except zeep_exceptions.Fault as zeep_exception:
-                errorcode = zeep_exception.detail[0][0].text
-                errormessage = zeep_exception.detail[0][1].text
-                if errorcode:
-                    logmessage = "An error occured."
-                    logmessage += "\nFull Response:%s\n" % errormessage
-                else:
-                    logmessage = "An error occured."
-                    logmessage += "\nCode:%s\n" % zeep_exception.code
-                    logmessage += "\nMessage:%s\n" % zeep_exception.message
-                raise exceptions.ValidationError(logmessage)
+    def dpd_store_orders(self, pickings, orders=None):
+        '''
+        Send the orders of the pickings in one storeOrders request, one
+        request per picking for the A4 labels
+        :param pickings:
+        :param orders: dict {picking id: order} of get_orders, built when
+                       not given
+        :return: dict {picking id: (parcel label number, LabelFile)} or
+                 {picking id: error message} for the faulty orders
+        '''
+        if orders is None:
+            orders = self.get_orders(pickings)
+        if len(pickings) > 1 and self.dpd_label_size != 'A6':
+            # A4 pages hold the labels of several orders and can't be split
+            # per picking, every picking gets its own request and document
+            res = {}
+            for picking in pickings:
+                res.update(self.dpd_store_orders(picking, orders=orders))
+            return res
+        try:
+            action = 'storeOrders'
+            error, response = self.dpd_send_authenticated(
+                action, lambda: self.dpd_create_message(
+                    action,
+                    printOptions=self.get_print_options(),
+                    order=[orders[picking.id] for picking in pickings],
+                    _soapheaders=self.get_soap_headers()), stream=True)
+        except zeep_exceptions.Fault as zeep_exception:
+            errorcode = zeep_exception.detail[0][0].text
+            errormessage = zeep_exception.detail[0][1].text
+            if errorcode:
+                logmessage = "An error occured."
+                logmessage += "\nFull Response:%s\n" % errormessage
+            else:
+                logmessage = "An error occured."
+                logmessage += "\nCode:%s\n" % zeep_exception.code
+                logmessage += "\nMessage:%s\n" % zeep_exception.message
+            raise exceptions.ValidationError(logmessage)
 
-            res = res + [shipping_data]
+        if error:
+            # DPD may have stored the orders which got no answer, they
+            # aren't sent again
+            if response is None or len(pickings) == 1 or \
+                    isinstance(error, NoAnswer):
+                return {picking.id: error for picking in pickings}
+            # DPD rejects the whole request when one of its orders is
+            # faulty, split the batch to isolate the faulty orders
+            half = len(pickings) // 2
+            res = self.dpd_store_orders(pickings[:half], orders=orders)
+            res.update(self.dpd_store_orders(pickings[half:], orders=orders))
+            return res
+
+        # The label is decoded to a file while the response is received
+        result = dpd_parser.parse_response(response, action)
+        pl_pdf = result.label
+        shipments = result.shipments
+        if pl_pdf is None or not result.label_number:
+            return {picking.id: _('No parcel label returned')
+                    for picking in pickings}
+        if len(pickings) == 1:
+            return {pickings.id: (result.label_number, pl_pdf)}
+
+        # The labels of all the orders are returned in one document
+        res = {}
+        label_pages = []
+        for picking, shipment in zip(pickings, shipments):
+            faults = shipment['faults']
+            pl_nums = shipment['parcelLabelNumbers']
+            if faults or not pl_nums:
+                res[picking.id] = ', '.join(
+                    '%s %s' % (fault.get('faultCode', ''),
+                               fault.get('message', ''))
+                    for fault in faults) or _('No parcel label returned')
+                continue
+            res[picking.id] = (pl_nums[0], pl_pdf)
+            label_pages.append((picking.id, len(pl_nums)))
+        for picking in pickings[len(shipments):]:
+            res[picking.id] = _('No parcel label returned')
+
+        # A6 labels are printed one per page, so the document is split per
+        # picking
+        for picking_id, label in dpd_label.split_label_pdf(
+                pl_pdf, label_pages):
+            res[picking_id] = (res[picking_id][0], label)
         return res
 
     def dpd_be_get_tracking_link(self, picking):
@@ -307,62 +719,185 @@ class ProviderDPDBE(models.Model):
             _('Shipment can not be cancelled anymore.'))
         return True
 
-    def dpd_send_message(self, action, request):
-        error = False
+    def dpd_send_message(self, action, request, stream=False):
         encoded_request = etree.tostring(request, encoding='utf-8')
-        headers = {
-            "Content-Type": "text/xml; charset=UTF-8",
-            "Content-Length": str(len(encoded_request)),
-            "SOAPAction": dpd_mapping.get(action).get('SOAPAction')
-        }
+        res = send_message(url=self.dpd_get_url(action=action),
+                           action=action, encoded_request=encoded_request,
+                           stream=stream, dbname=self.env.cr.dbname)
+        self.env['dpd.metric.summary']._flush_if_due()
+        return res
 
-        response = requests.post(url=self.dpd_get_url(action=action),
-                                 headers=headers,
-                                 data=encoded_request)
-        if response.status_code != 200:
-            try:
-                node = etree.fromstring(response.content)
-                expr = '//*[local-name()=$name]'
-                errorcode = node.xpath(expr, name=dpd_mapping.get(action).get(
-                    'errorcode'))[0].text
-                errormessage = \
-                    node.xpath(expr, name=dpd_mapping.get(action).get(
-                        'errormessage'))[0].text
-                error = 'Error: %s\nError message: %s' % (errorcode,
-                                                          errormessage)
-            except:
-                _logger.info(encoded_request)
-                node = etree.fromstring(response.content)
-                _logger.info(etree.tostring(node, pretty_print=True))
-                error = 'An error has occured'
-        return error, response
+    @api.multi
+    def dpd_is_available(self, action):
+        '''
+        False while the calls to the service are suspended after failures
+        '''
+        self.ensure_one()
+        return dpd_guard.is_available(action, self.dpd_get_url(action=action))
+
+    def dpd_get_environment(self):
+        return self.prod_environment and 'life' or 'stage'
 
     def dpd_get_url(self, action):
-        return dpd_mapping.get(action).get(
-            '%s-url' % (self.prod_environment and 'life' or 'stage'))
+        return get_service_url(action, self.dpd_get_environment())
+
+    def dpd_get_binding(self, action):
+        # The zeep clients are shared by the whole process, the WSDL is only
+        # downloaded and parsed once per service and environment
+        return dpd_client.get_binding(action, self.dpd_get_environment(),
+                                      self.dpd_get_url(action=action))
+
+    def dpd_create_message(self, action, **kwargs):
+        '''
+        Build the request envelope from the element templates, when
+        dpd_verify_envelopes is set in the server configuration it is
+        checked against the envelope of the zeep binding
+        '''
+        headers = kwargs.pop('_soapheaders', None)
+        request = dpd_envelope.create_message(action, headers=headers,
+                                              **kwargs)
+        if config.get('dpd_verify_envelopes'):
+            if headers:
+                kwargs['_soapheaders'] = headers
+            expected = self.dpd_get_binding(action).create_message(
+                action, **kwargs)
+            if etree.tostring(expected) != etree.tostring(request):
+                _logger.warning("DPD %s envelope differs from the WSDL "
+                                "binding, sending the zeep envelope", action)
+                return expected
+        return request
 
     @api.multi
-    def login(self, force=False):
+    def action_dpd_reload_wsdl(self):
+        for environment in ('stage', 'life'):
+            for action in dpd_mapping:
+                dpd_client.invalidate_client(
+                    action, environment,
+                    get_service_url(action, environment))
+        return True
+
+    def _dpd_token_key(self):
+        # The other workers don't use the token of a former account
+        return (self.env.cr.dbname, self.id, self.dpd_delis_id,
+                self.dpd_get_environment())
+
+    def _dpd_get_auth(self):
+        '''
+        The authentication of the last login, from the cache of the process
+        so the hot paths don't read the carrier
+        '''
+        auth = dpd_client.get_token(self._dpd_token_key())
+        if auth is None:
+            login_date = fields.Datetime.from_string(self.dpd_login_date)
+            auth = {'customerUid': self.dpd_customer_uid,
+                    'depot': self.dpd_depot,
+                    'authToken': self.dpd_token,
+                    'expires': login_date and login_date + TOKEN_LIFETIME}
+        return auth
+
+    def _dpd_lock_carrier(self, cr):
+        '''
+        Lock the carrier row with cr, waits while another worker holds it.
+        The current transaction may have created or written the row, which
+        cr can't see or lock, the row is then locked with the current
+        cursor.
+        :return: cursor holding the lock and the token, depot, customer uid
+                 and login date of the row or None, None when the lock could
+                 not be obtained
+        '''
+        query = """
+            SELECT dpd_token, dpd_depot, dpd_customer_uid, dpd_login_date
+            FROM delivery_carrier WHERE id = %s
+            FOR UPDATE NOWAIT"""
+        for attempt in range(LOGIN_LOCK_ATTEMPTS):
+            try:
+                cr.execute(query, (self.id,), log_exceptions=False)
+                row = cr.fetchone()
+                if row:
+                    return cr, row
+            except psycopg2.OperationalError:
+                cr.rollback()
+            try:
+                with self.env.cr.savepoint():
+                    self.env.cr.execute(query, (self.id,),
+                                        log_exceptions=False)
+                    row = self.env.cr.fetchone()
+            except psycopg2.OperationalError:
+                # Another worker is logging in, wait for its token
+                time.sleep(1)
+                continue
+            if not row:
+                raise exceptions.MissingError(
+                    _('The carrier %s does not exist anymore.') % self.id)
+            return self.env.cr, row
+        return None, None
+
+    @api.multi
+    def login(self, force=False, stale_token=None):
         '''
         Login to DPD server
-        :param force:
+        :param force: login even when the token is still valid
+        :param stale_token: token refused by DPD, login unless another
+                            worker already replaced it
         :return: succeeded: True/False, error: Errormessage/False
         '''
-        # Check if last login was more then 24h ago
-        # Dpd accepts max 2 logins per 24h
-        dpd_login_date = fields.Datetime.from_string(
-            self.dpd_login_date)
-        if dpd_login_date:
-            dpd_login_date += timedelta(hours=24)
-
-        if not force and dpd_login_date and dpd_login_date > datetime.now():
+        self.ensure_one()
+        # Dpd accepts max 2 logins per 24h, the token is refreshed a bit
+        # before it expires
+        auth = self._dpd_get_auth()
+        if not force and not stale_token and auth['authToken'] and \
+                auth['expires'] and auth['expires'] > \
+                datetime.now() + TOKEN_REFRESH_MARGIN:
+            dpd_client.set_token(self._dpd_token_key(), auth)
             return True, False
 
+        # Only one worker at a time logs in, the token is committed in its
+        # own transaction so it is kept when the current one is rolled back,
+        # unless the current transaction holds the carrier
+        with self.pool.cursor() as login_cr:
+            cr, row = self._dpd_lock_carrier(login_cr)
+            if row is None:
+                return False, _('Another process is logging in to DPD, '
+                                'please try again.')
+            token, depot, customer_uid, login_date = row
+            expires = login_date and login_date + TOKEN_LIFETIME
+            if not force and token and token != stale_token and \
+                    expires and expires > \
+                    datetime.now() + TOKEN_REFRESH_MARGIN:
+                # Another worker logged in in the meantime
+                auth = {'customerUid': customer_uid,
+                        'depot': depot,
+                        'authToken': token,
+                        'expires': expires}
+            else:
+                with dpd_metrics.timer('dpd_login_seconds'):
+                    error, auth = self._dpd_get_auth_token()
+                dpd_metrics.inc('dpd_logins_total',
+                                result=error and 'error' or 'ok')
+                if error:
+                    return False, error
+                cr.execute("""
+                    UPDATE delivery_carrier
+                    SET dpd_customer_uid = %s, dpd_depot = %s,
+                        dpd_token = %s, dpd_login_date = %s
+                    WHERE id = %s""", (auth['customerUid'], auth['depot'],
+                                       auth['authToken'],
+                                       auth['expires'] - TOKEN_LIFETIME,
+                                       self.id))
+
+        dpd_client.set_token(self._dpd_token_key(), auth)
+        self.invalidate_cache(['dpd_customer_uid', 'dpd_depot', 'dpd_token',
+                               'dpd_login_date'], self.ids)
+        return True, False
+
+    def _dpd_get_auth_token(self):
+        '''
+        Call getAuth
+        :return: error/False, auth dict
+        '''
         try:
             action = 'getAuth'
-            client = Client(self.dpd_get_url(action=action))
-
-            request = client.service._binding.create_message(
+            request = self.dpd_create_message(
                 action,
                 delisId=self.dpd_delis_id,
                 password=self.dpd_password,
@@ -371,23 +906,36 @@ class ProviderDPDBE(models.Model):
             error, response = self.dpd_send_message(action=action,
                                                     request=request)
             if error:
-                return False, error
+                return error, None
 
             node = etree.fromstring(response.content)
             res_node = node.xpath('//return')[0]
-            cUId = get_data(res_node, 'customerUid')
-            depot = get_data(res_node, 'depot')
-            token = get_data(res_node, 'authToken')
-
-            self.write({'dpd_customer_uid': cUId,
-                        'dpd_depot': depot,
-                        'dpd_token': token,
-                        'dpd_login_date': datetime.now()})
+            return False, {
+                'customerUid': get_data(res_node, 'customerUid'),
+                'depot': get_data(res_node, 'depot'),
+                'authToken': get_data(res_node, 'authToken'),
+                'expires': datetime.now() + TOKEN_LIFETIME}
 
         except zeep_exceptions.Fault as zeep_exception:
-            return zeep_exception.detail[0][1].text
+            return zeep_exception.detail[0][1].text, None
 
-        return True, False
+    def dpd_send_authenticated(self, action, build_request, stream=False):
+        '''
+        Send the request built by build_request(), when DPD refuses the
+        token login again once and send it again
+        '''
+        token = self._dpd_get_auth()['authToken']
+        error, response = self.dpd_send_message(
+            action=action, request=build_request(), stream=stream)
+        if error and response is not None and \
+                is_auth_error(action, response.content):
+            dpd_metrics.inc('dpd_auth_retries_total', action=action)
+            successfull, error = self.login(stale_token=token)
+            if not successfull:
+                return error, response
+            error, response = self.dpd_send_message(
+                action=action, request=build_request(), stream=stream)
+        return error, response
 
     @api.multi
     def action_test_connection(self):
@@ -398,6 +946,14 @@ class ProviderDPDBE(models.Model):
         return self.env.ref('delivery_dpd_be.'
                             'action_wizard_test_connection').read()[0]
 
+    def dpd_tracking_request(self, picking):
+        action = 'getTrackingData'
+        return self.dpd_create_message(
+            action,
+            parcelLabelNumber=picking.carrier_tracking_ref,
+            _soapheaders=self.get_soap_headers()
+        )
+
     @api.multi
     def get_tracking_information(self, picking):
         # Try to login to DPD
@@ -407,40 +963,11 @@ class ProviderDPDBE(models.Model):
 
         try:
             action = 'getTrackingData'
-            client = Client(self.dpd_get_url(action=action))
-
-            request = client.service._binding.create_message(
-                action,
-                parcelLabelNumber=picking.carrier_tracking_ref,
-                _soapheaders=self.get_soap_headers()
-            )
-
-            error, response = self.dpd_send_message(action=action,
-                                                    request=request)
-            if response.status_code == 200:
-                node = etree.fromstring(response.content)
-                states = []
-                for status_info in node.xpath('//statusInfo'):
-                    reached = get_data(status_info, 'statusHasBeenReached')
-                    status = get_data(status_info, 'status')
-                    current = get_data(status_info, 'isCurrentStatus')
-                    location = get_data(status_info, 'location/content')
-                    date = get_data(status_info, 'date/content')
-                    info = get_data(status_info,
-                                    'description/content/content')
-                    state = {'state': status,
-                             'reached': reached == 'true',
-                             'current': current == 'true',
-                             'location': location,
-                             'date': date,
-                             'extra_info': ''}
-                    infos = [info]
-                    for extra_info in status_info.xpath(
-                            'importantItems/content'):
-                        infos.append(get_data(extra_info, 'content'))
-                    state['extra_info'] = '/'.join(infos)
-                    states.append(state)
-
+            error, response = self.dpd_send_authenticated(
+                action, lambda: self.dpd_tracking_request(picking),
+                stream=True)
+            if response is not None and response.status_code == 200:
+                states = dpd_parser.parse_response(response, action).states
                 picking.update_tracking_information(data=states)
 
             if error:
@@ -460,33 +987,189 @@ class ProviderDPDBE(models.Model):
 
         return True
 
+    @api.multi
+    def dpd_fetch_tracking(self, pickings, workers=8, deadline=None):
+        '''
+        Fetch the tracking data of the pickings with concurrent requests,
+        only the network calls and the parsing run in the worker threads
+        :param pickings: pickings of this carrier
+        :param workers: number of concurrent requests
+        :param deadline: time.time() after which pending requests are dropped
+        :return: dict {picking id: list of states or error message}
+        '''
+        self.ensure_one()
+        successfull, error = self.login()
+        if not successfull:
+            raise exceptions.AccessError(error)
+
+        res = self._dpd_fetch_tracking(pickings, workers, deadline)
+        # The token was refused, login again once and retry those pickings
+        refused = pickings.filtered(lambda p: res.get(p.id) == AUTH_ERROR)
+        if refused:
+            successfull, error = self.login(
+                stale_token=self._dpd_get_auth()['authToken'])
+            if not successfull:
+                raise exceptions.AccessError(error)
+            res.update(self._dpd_fetch_tracking(refused, workers, deadline))
+        return res
+
+    def _dpd_fetch_tracking(self, pickings, workers, deadline):
+        url = self.dpd_get_url(action='getTrackingData')
+        requests_by_picking = {
+            picking.id: etree.tostring(self.dpd_tracking_request(picking),
+                                       encoding='utf-8')
+            for picking in pickings}
+        res = {}
+        dbname = self.env.cr.dbname
+        executor = futures.ThreadPoolExecutor(max_workers=workers)
+        try:
+            jobs = {executor.submit(fetch_tracking_data, url, request,
+                                    dbname):
+                    picking_id
+                    for picking_id, request in requests_by_picking.items()}
+            timeout = deadline and max(deadline - time.time(), 0) or None
+            try:
+                for job in futures.as_completed(jobs, timeout=timeout):
+                    try:
+                        res[jobs[job]] = job.result()
+                    except Exception as e:
+                        _logger.info("DPD tracking failed: %s", e)
+                        res[jobs[job]] = str(e)
+            except futures.TimeoutError:
+                _logger.info("DPD tracking time budget exceeded, %s of %s "
+                             "pickings fetched", len(res), len(jobs))
+                for job in jobs:
+                    job.cancel()
+        finally:
+            executor.shutdown(wait=False)
+        return res
+
+    @api.multi
+    def dpd_find_parcel_shops(self, latitude=None, longitude=None,
+                              country=None, zip_code=None, city=None,
+                              limit=10):
+        '''
+        Find the DPD parcel shops near a position or an address. They are
+        read from the local cache, DPD is only asked for the grid cells
+        which were not fetched within the TTL. Addresses are located at
+        postcode precision. Only the Benelux is searched.
+        :return: list of shop dicts sorted by distance, in km
+        '''
+        self.ensure_one()
+        shop_model = self.env['dpd.parcel.shop'].sudo()
+        area_model = self.env['dpd.parcel.shop.area'].sudo()
+        if latitude is None or longitude is None:
+            if not country or not zip_code or \
+                    country.upper() not in parcel_shop.COUNTRIES:
+                return []
+            latitude, longitude = self._dpd_locate_zip(country, zip_code,
+                                                       city)
+            if latitude is None:
+                return []
+        if not parcel_shop.is_supported(latitude, longitude):
+            return []
+        ttl = area_model._get_ttl()
+        for bucket in parcel_shop.get_neighbour_buckets(latitude, longitude):
+            cell_latitude, cell_longitude = \
+                parcel_shop.get_bucket_center(bucket)
+            # The cells over the border of the Benelux have no shop
+            if not parcel_shop.is_supported(cell_latitude, cell_longitude):
+                continue
+            name = 'grid:%s' % bucket
+            if area_model._get_fresh(name):
+                continue
+            shops = self._dpd_request_parcel_shops(
+                'findParcelShopsByGeoData', latitude=cell_latitude,
+                longitude=cell_longitude)
+            # When DPD fails the stale shops are still answered
+            if shops is None:
+                continue
+            shop_model._store_shops(shops)
+            shop_model._purge_bucket(bucket, ttl)
+            area_model._mark_fetched(name)
+        return shop_model._find_near(latitude, longitude, limit)
+
+    def _dpd_locate_zip(self, country, zip_code, city=None):
+        '''
+        Position of a postcode, the one of its nearest parcel shop
+        :return: latitude, longitude or None, None
+        '''
+        area_model = self.env['dpd.parcel.shop.area'].sudo()
+        name = 'zip:%s:%s' % (country.upper(),
+                              ''.join(zip_code.split()).upper())
+        area = area_model._get_fresh(name)
+        if area:
+            return area.latitude, area.longitude
+        shops = self._dpd_request_parcel_shops(
+            'findParcelShops', country=country.upper(), zipCode=zip_code,
+            city=city or None)
+        if not shops:
+            return None, None
+        self.env['dpd.parcel.shop'].sudo()._store_shops(shops)
+        try:
+            latitude = float(shops[0]['latitude'])
+            longitude = float(shops[0]['longitude'])
+        except ValueError:
+            return None, None
+        area_model._mark_fetched(name, latitude, longitude)
+        return latitude, longitude
+
+    def _dpd_request_parcel_shops(self, action, **kwargs):
+        '''
+        Call the ParcelShopFinderService
+        :return: list of shop dicts or None when DPD could not answer
+        '''
+        successfull, error = self.login()
+        if not successfull:
+            _logger.info("DPD %s failed: %s", action, error)
+            return None
+        error, response = self.dpd_send_authenticated(
+            action, lambda: self.dpd_create_message(
+                action, limit=PARCEL_SHOP_FETCH_LIMIT,
+                _soapheaders=self.get_soap_headers(), **kwargs))
+        if error:
+            _logger.info("DPD %s failed: %s", action, error)
+            return None
+        return dpd_parser.parse_parcel_shops(response.content)
+
+    def _get_compiled_price_rules(self):
+        '''
+        The price rules of the carrier as a tuple of plain values, cached
+        until a price rule is changed
+        '''
+        return self._get_compiled_price_rules_version(
+            self._dpd_rate_version())
+
+    @tools.ormcache('self.id', 'version')
+    def _get_compiled_price_rules_version(self, version):
+        return tuple(compile_price_rule(line) for line in self.price_rule_ids)
+
     def get_price_from_picking(self, total, weight, volume, quantity):
         # Overruled this method to implement variable_factor='per_quantity'
         price = 0.0
         criteria_found = False
         price_dict = {'price': total, 'volume': volume, 'weight': weight,
                       'wv': volume * weight, 'quantity': quantity}
-        for line in self.price_rule_ids:
-            test = safe_eval(
-                line.variable + line.operator + str(
-                    line.max_value), price_dict)
-            if test:
-                base_price = line.list_base_price
-                if line.price_type != 'fixed':
+        for variable, compare, max_value, fixed, list_base_price, \
+                list_price, variable_factor, quantity_per_value in \
+                self._get_compiled_price_rules():
+            if compare(price_dict[variable], max_value):
+                base_price = list_base_price
+                if not fixed:
                     # get the customer price
-                    base_price = line.carrier_id.product_id.price
+                    base_price = self.product_id.price
 
-                if line.variable_factor != 'per_quantity':
+                if variable_factor != 'per_quantity':
                     price = \
-                        base_price + line.list_price * price_dict[
-                            line.variable_factor]
+                        base_price + list_price * price_dict[
+                            variable_factor]
                     criteria_found = True
                     break
                 else:
                     price = \
-                        (base_price + line.list_price) * math.ceil(
+                        (base_price + list_price) * math.ceil(
                             (price_dict['quantity'] /
-                             line.quantity_per_value))
+                             quantity_per_value))
                     criteria_found = True
                     break
 
@@ -501,6 +1184,22 @@ class ProviderDPDBE(models.Model):
 class PriceRule(models.Model):
     _inherit = "delivery.price.rule"
 
+    @api.model
+    def create(self, vals):
+        # Recompile the price rules of the carriers and drop their quotes
+        self.env['delivery.carrier']._dpd_bump_rate_version()
+        return super(PriceRule, self).create(vals)
+
+    @api.multi
+    def write(self, vals):
+        self.env['delivery.carrier']._dpd_bump_rate_version()
+        return super(PriceRule, self).write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.env['delivery.carrier']._dpd_bump_rate_version()
+        return super(PriceRule, self).unlink()
+
     @api.depends('variable', 'operator', 'max_value', 'list_base_price',
                  'list_price', 'variable_factor')
     def _get_name(self):
@@ -546,3 +1245,53 @@ class PriceRule(models.Model):
         help="Fixed price: a fixed price, "
              "Customer price: calculated based on pricelists."
     )
+
+
+class Pricelist(models.Model):
+    _inherit = 'product.pricelist'
+
+    @api.multi
+    def write(self, vals):
+        # The rate quotes depend on the prices of the carrier products
+        if self.mapped('item_ids')._dpd_affects_rates():
+            self.env['delivery.carrier']._dpd_bump_rate_version()
+        return super(Pricelist, self).write(vals)
+
+
+class PricelistItem(models.Model):
+    _inherit = 'product.pricelist.item'
+
+    @api.multi
+    def _dpd_affects_rates(self):
+        '''
+        Whether the items may change the price of the product of a DPD
+        carrier, the items of the other products don't change the quotes
+        '''
+        products = self.env['delivery.carrier'].sudo().search(
+            [('delivery_type', '=', 'dpd_be')]).mapped('product_id')
+        return any(
+            item.applied_on in ('3_global', '2_product_category') or
+            item.product_id in products or
+            item.product_tmpl_id in products.mapped('product_tmpl_id')
+            for item in self)
+
+    @api.model
+    def create(self, vals):
+        item = super(PricelistItem, self).create(vals)
+        if item._dpd_affects_rates():
+            self.env['delivery.carrier']._dpd_bump_rate_version()
+        return item
+
+    @api.multi
+    def write(self, vals):
+        affects_rates = self._dpd_affects_rates()
+        res = super(PricelistItem, self).write(vals)
+        if affects_rates or self._dpd_affects_rates():
+            self.env['delivery.carrier']._dpd_bump_rate_version()
+        return res
+
+    @api.multi
+    def unlink(self):
+        if self._dpd_affects_rates():
+            self.env['delivery.carrier']._dpd_bump_rate_version()
+        return super(PricelistItem, self).unlink()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+from odoo import fields, models, api
+
+from .picking import shipment_states
+
+
+class DPDDeliveryStateReport(models.Model):
+    '''
+    Time the pickings spent in each delivery state, rebuilt from the
+    tracking events of the pickings they were received for
+    '''
+    _name = 'dpd.delivery.state.report'
+    _description = 'DPD delivery state analysis'
+    _order = 'date_start desc, id desc'
+    _log_access = False
+
+    picking_id = fields.Many2one(
+        comodel_name='stock.picking',
+        string='Picking',
+        required=True,
+        readonly=True,
+        index=True,
+        ondelete='cascade',
+    )
+    carrier_id = fields.Many2one(
+        comodel_name='delivery.carrier',
+        string='Carrier',
+        readonly=True,
+        index=True,
+    )
+    country_id = fields.Many2one(
+        comodel_name='res.country',
+        string='Destination country',
+        readonly=True,
+    )
+    state = fields.Selection(
+        selection=shipment_states,
+        string='Delivery state',
+        readonly=True,
+        index=True,
+    )
+    date_start = fields.Datetime(
+        string='Reached on',
+        readonly=True,
+        index=True,
+    )
+    date_end = fields.Datetime(
+        string='Left on',
+        readonly=True,
+    )
+    dwell_hours = fields.Float(
+        string='Hours in state',
+        readonly=True,
+        group_operator='avg',
+    )
+    current = fields.Boolean(
+        string='Current state',
+        readonly=True,
+    )
+
+    @api.model
+    def _refresh(self, picking_ids=None):
+        '''
+        Rebuild the rows of some pickings from their tracking events, a
+        state lasts from its first event until the next state is reached
+        :param picking_ids: all the pickings when None
+        '''
+        where = ''
+        params = []
+        if picking_ids is not None:
+            if not picking_ids:
+                return
+            where = 'AND picking_id IN %s'
+            params = [tuple(picking_ids)]
+            self.env.cr.execute("""
+                DELETE FROM dpd_delivery_state_report
+                WHERE picking_id IN %s""", params)
+        else:
+            self.env.cr.execute("DELETE FROM dpd_delivery_state_report")
+        self.env.cr.execute("""
+            INSERT INTO dpd_delivery_state_report (
+                picking_id, carrier_id, country_id, state, date_start,
+                date_end, dwell_hours, current)
+            SELECT s.picking_id, p.carrier_id, partner.country_id, s.state,
+                s.date_start, s.date_end,
+                EXTRACT(EPOCH FROM COALESCE(s.date_end,
+                    now() at time zone 'UTC') - s.date_start) / 3600,
+                s.date_end IS NULL
+            FROM (
+                SELECT picking_id, state, date_start,
+                    CASE WHEN state = 'DELIVERED' THEN date_start
+                    ELSE LEAD(date_start) OVER (
+                        PARTITION BY picking_id
+                        ORDER BY date_start, first_id) END AS date_end
+                FROM (
+                    SELECT picking_id, state, MIN(date) AS date_start,
+                        MIN(id) AS first_id
+                    FROM stock_picking_tracking_event
+                    WHERE date IS NOT NULL {}
+                    GROUP BY picking_id, state) AS reached
+            ) AS s
+            JOIN stock_picking AS p ON p.id = s.picking_id
+            LEFT JOIN res_partner AS partner ON partner.id = p.partner_id
+            """.format(where), params)
+        self.invalidate_cache()
+
+    @api.model
+    def _cron_refresh_current(self):
+        # The parcels which are still in a state spend more time in it
+        self.env.cr.execute("""
+            UPDATE dpd_delivery_state_report
+            SET dwell_hours = EXTRACT(EPOCH FROM
+                (now() at time zone 'UTC') - date_start) / 3600
+            WHERE current""")
+        self.invalidate_cache()
+        return True
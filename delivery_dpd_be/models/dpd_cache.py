@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import OrderedDict
+
+from odoo.tools import config
+
+
+class QuoteCache(object):
+    '''
+    Bounded LRU cache whose entries expire after ttl seconds, safe to share
+    between the threads of a worker
+    '''
+
+    def __init__(self, size=2048, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.time():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._data)}
+
+
+# Rate quotes of dpd_be_rate_shipment, the other workers stop using their
+# entries when the rate version of the carriers changes or when they expire
+rate_cache = QuoteCache(
+    size=int(config.get('dpd_rate_cache_size') or 2048),
+    ttl=int(config.get('dpd_rate_cache_ttl') or 300))
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.exceptions import ProtocolError, \
+    ReadTimeoutError
+from requests.packages.urllib3.util.retry import Retry
+from zeep import Client
+from zeep.cache import SqliteCache
+from zeep.transports import Transport
+
+from odoo.tools import config
+
+from . import dpd_metrics
+
+_logger = logging.getLogger(__name__)
+
+# DPD only changes its WSDL documents on a new service version, so a
+# downloaded document can be kept for a week on disk
+WSDL_CACHE_TIMEOUT = 7 * 24 * 3600
+
+# Transport settings, can be overruled in the server configuration file
+TRANSPORT_DEFAULTS = {
+    'dpd_pool_size': 10,
+    'dpd_connect_timeout': 10.0,
+    'dpd_read_timeout': 60.0,
+    'dpd_max_retries': 3,
+    'dpd_retry_backoff': 0.5,
+    'dpd_breaker_failures': 5,
+    'dpd_breaker_reset': 30.0,
+    'dpd_rate_limit': 10.0,
+    'dpd_rate_burst': 20.0,
+    'dpd_rate_limit_wait': 30.0,
+}
+
+# DPD may have executed these calls when no answer came back, they are
+# not sent again after a read error or a gateway error
+NON_IDEMPOTENT_ACTIONS = ('storeOrders',)
+
+_lock = threading.RLock()
+_clients = {}
+_wsdl_cache = []
+# {idempotent: requests.Session}
+_sessions = {}
+# DPD authentication of the carriers,
+# {(dbname, carrier id, delis id, environment): auth dict}
+_tokens = {}
+
+
+def get_transport_option(name):
+    return type(TRANSPORT_DEFAULTS[name])(
+        config.get(name) or TRANSPORT_DEFAULTS[name])
+
+
+def get_timeout():
+    return (get_transport_option('dpd_connect_timeout'),
+            get_transport_option('dpd_read_timeout'))
+
+
+def _get_retry(idempotent=True):
+    retries = get_transport_option('dpd_max_retries')
+    options = {
+        'total': retries,
+        'connect': retries,
+        'read': idempotent and retries or 0,
+        'backoff_factor': get_transport_option('dpd_retry_backoff'),
+        # The SOAP faults come with a 500, they are answers and aren't sent
+        # again. A 503 means the request wasn't handled.
+        'status_forcelist': idempotent and (502, 503, 504) or (503,),
+        # Don't raise once the retries are exhausted, the caller reads the
+        # last response
+        'raise_on_status': False,
+    }
+    # SOAP calls are POST requests which urllib3 doesn't retry by default
+    try:
+        return Retry(allowed_methods=False, **options)
+    except TypeError:
+        return Retry(method_whitelist=False, **options)
+
+
+def get_session(idempotent=True):
+    '''
+    Return the keep-alive HTTP session of this worker, the connections to the
+    DPD servers are pooled and reused by every SOAP call and WSDL download
+    :param idempotent: False for the session of NON_IDEMPOTENT_ACTIONS, it
+                       only retries the requests DPD didn't receive
+    '''
+    with _lock:
+        if idempotent not in _sessions:
+            pool_size = get_transport_option('dpd_pool_size')
+            adapter = HTTPAdapter(pool_connections=pool_size,
+                                  pool_maxsize=pool_size,
+                                  max_retries=_get_retry(idempotent))
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[idempotent] = session
+        return _sessions[idempotent]
+
+
+def is_unanswered(exception):
+    '''
+    Whether a request failed after it was sent, DPD may have handled it
+    :param exception: requests exception of the call
+    '''
+    if isinstance(exception, (requests.exceptions.ReadTimeout,
+                              requests.exceptions.ChunkedEncodingError)):
+        return True
+    # The errors of urllib3 are wrapped, in a MaxRetryError after retries
+    cause = exception.args and exception.args[0]
+    reason = getattr(cause, 'reason', cause)
+    return isinstance(reason, (ReadTimeoutError, ProtocolError))
+
+
+def post(url, data, headers, stream=False, action=None):
+    session = get_session(idempotent=action not in NON_IDEMPOTENT_ACTIONS)
+    return session.post(url=url, data=data, headers=headers,
+                        timeout=get_timeout(), stream=stream)
+
+
+def get_wsdl_cache():
+    '''
+    Return the on-disk WSDL cache shared by all the workers of this server,
+    it lives in the data directory so it survives restarts
+    '''
+    with _lock:
+        if not _wsdl_cache:
+            cache_dir = os.path.join(config['data_dir'], 'delivery_dpd_be')
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            _wsdl_cache.append(SqliteCache(
+                path=os.path.join(cache_dir, 'wsdl_cache.sqlite'),
+                timeout=WSDL_CACHE_TIMEOUT))
+        return _wsdl_cache[0]
+
+
+def get_client(action, environment, url):
+    '''
+    Return the zeep client of a DPD service, the WSDL is only parsed the
+    first time an (action, environment) pair is asked for in this process
+    :param action: key of dpd_mapping
+    :param environment: 'stage' or 'life'
+    :param url: url of the WSDL document
+    :return: zeep.Client
+    '''
+    key = (action, environment)
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                _logger.info("Loading DPD WSDL for %s (%s)", action,
+                             environment)
+                dpd_metrics.inc('dpd_client_cache_total', result='miss')
+                with dpd_metrics.timer('dpd_client_build_seconds',
+                                       action=action):
+                    client = Client(url, transport=Transport(
+                        cache=get_wsdl_cache(),
+                        timeout=get_transport_option('dpd_read_timeout'),
+                        operation_timeout=get_timeout(),
+                        session=get_session()))
+                _clients[key] = client
+                return client
+    dpd_metrics.inc('dpd_client_cache_total', result='hit')
+    return client
+
+
+def get_binding(action, environment, url):
+    return get_client(action, environment, url).service._binding
+
+
+def invalidate_client(action, environment, url):
+    '''
+    Drop the compiled client of a DPD service and its cached WSDL document,
+    the next call reloads it from DPD
+    '''
+    with _lock:
+        _clients.pop((action, environment), None)
+        with get_wsdl_cache().db_connection() as conn:
+            conn.execute("DELETE FROM request WHERE url = ?", (url,))
+            conn.commit()
+
+
+def get_token(key):
+    return _tokens.get(key)
+
+
+def set_token(key, auth):
+    _tokens[key] = auth
+
+
+def drop_tokens(dbname, carrier_id):
+    # The keys of a carrier start with its database and id
+    for key in list(_tokens):
+        if key[:2] == (dbname, carrier_id):
+            _tokens.pop(key, None)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+from lxml import etree
+
+SOAP_ENV_NS = 'http://schemas.xmlsoap.org/soap/envelope/'
+HEADER_NS = {
+    'authentication': 'http://dpd.com/common/service/types/'
+                      'Authentication/2.0',
+}
+BODY_NS = {
+    'getAuth': 'http://dpd.com/common/service/types/LoginService/2.0',
+    'storeOrders': 'http://dpd.com/common/service/types/ShipmentService/3.1',
+    'getTrackingData': 'http://dpd.com/common/service/types/'
+                       'ParcelLifeCycleService/2.0',
+    'findParcelShops': 'http://dpd.com/common/service/types/'
+                       'ParcelShopFinderService/3.0',
+    'findParcelShopsByGeoData': 'http://dpd.com/common/service/types/'
+                                'ParcelShopFinderService/3.0',
+}
+
+ADDRESS = ('name1', 'name2', 'street', 'houseNo', 'state', 'country',
+           'zipCode', 'city', 'customerNumber', 'contact', 'phone', 'email')
+
+# Order of the child elements in the sequences of the DPD schemas
+SEQUENCES = {
+    'authentication': ('delisId', 'authToken', 'messageLanguage'),
+    'getAuth': ('delisId', 'password', 'messageLanguage'),
+    'getTrackingData': ('parcelLabelNumber',),
+    'findParcelShops': ('country', 'zipCode', 'city', 'street', 'houseNo',
+                        'limit', 'availabilityDate', 'hideOnClosedAt'),
+    'findParcelShopsByGeoData': ('longitude', 'latitude', 'limit',
+                                 'availabilityDate', 'hideOnClosedAt'),
+    'storeOrders': ('printOptions', 'order'),
+    'printOptions': ('printerLanguage', 'paperFormat', 'printer',
+                     'startPosition'),
+    'order': ('generalShipmentData', 'parcels', 'productAndServiceData'),
+    'generalShipmentData': ('mpsCustomerReferenceNumber1',
+                            'identificationNumber', 'sendingDepot',
+                            'product', 'mpsCompleteDelivery', 'sender',
+                            'recipient'),
+    'sender': ADDRESS,
+    'recipient': ADDRESS,
+    'parcels': ('parcelLabelNumber', 'customerReferenceNumber1',
+                'customerReferenceNumber2', 'volume', 'weight'),
+    'productAndServiceData': ('orderType',),
+}
+
+
+def _render(parent, tag, name, value):
+    if value is None:
+        return
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            _render(parent, tag, name, item)
+        return
+    node = etree.SubElement(parent, tag)
+    if isinstance(value, dict):
+        unknown = set(value) - set(SEQUENCES[name])
+        if unknown:
+            raise ValueError('Unknown elements for %s: %s' % (
+                name, ', '.join(sorted(unknown))))
+        for child in SEQUENCES[name]:
+            _render(node, child, child, value.get(child))
+    elif isinstance(value, bytes):
+        node.text = value.decode('utf-8')
+    else:
+        # Same text as zeep renders for xsd:string and xsd:int values
+        node.text = str(value)
+
+
+def _render_root(namespace, name, value):
+    root = etree.Element('root')
+    _render(root, '{%s}%s' % (namespace, name), name, value)
+    return root[0]
+
+
+def create_message(action, headers=None, **kwargs):
+    '''
+    Build the SOAP envelope of a DPD request without going through the
+    zeep bindings, the result is serialized the same way as the envelope
+    of zeep's create_message
+    :param action: key of BODY_NS
+    :param headers: dict of the SOAP headers, like zeep's _soapheaders
+    :return: lxml envelope element
+    '''
+    envelope = etree.Element('{%s}Envelope' % SOAP_ENV_NS,
+                             nsmap={'soap-env': SOAP_ENV_NS})
+    # zeep renders the headers and the body as separate trees, so each of
+    # them declares its namespace with the ns0 prefix
+    if headers:
+        header = etree.SubElement(envelope, '{%s}Header' % SOAP_ENV_NS)
+        for name, value in headers.items():
+            header.append(_render_root(HEADER_NS[name], name, value))
+    body = etree.SubElement(envelope, '{%s}Body' % SOAP_ENV_NS)
+    body.append(_render_root(BODY_NS[action], action, kwargs))
+    return envelope
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import logging
+import threading
+import time
+
+import psycopg2
+
+from odoo.sql_db import db_connect
+
+from . import dpd_client
+from . import dpd_metrics
+
+_logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# {(action, url): CircuitBreaker}
+_breakers = {}
+# {(dbname, action, url): id of the dpd.rate.limit row}
+_buckets = {}
+
+
+class CircuitBreaker(object):
+    '''
+    Stop calling a DPD service from this process after max_failures
+    consecutive failures, one probe call is let through after reset_timeout
+    seconds and closes the circuit again when it succeeds
+    '''
+
+    def __init__(self, failures=5, reset_timeout=30.0):
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if time.time() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def retry_after(self):
+        if self.opened_at is None:
+            return 0
+        return max(self.opened_at + self.reset_timeout - time.time(), 0)
+
+    def allow(self):
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._probing:
+                # Thread of the probe call
+                self._probing = threading.get_ident()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+
+    def release(self):
+        # The probe of this thread ended without a result, the next call
+        # probes again
+        with self._lock:
+            if self._probing == threading.get_ident():
+                self._probing = False
+
+    def record_failure(self):
+        '''
+        :return: True when this failure opened the circuit
+        '''
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.max_failures:
+                opened = self.opened_at is None or bool(self._probing)
+                self.opened_at = time.time()
+                self._probing = False
+                return opened
+            return False
+
+
+def get_breaker(action, url):
+    key = (action, url)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        with _lock:
+            breaker = _breakers.setdefault(key, CircuitBreaker(
+                failures=dpd_client.get_transport_option(
+                    'dpd_breaker_failures'),
+                reset_timeout=dpd_client.get_transport_option(
+                    'dpd_breaker_reset')))
+    return breaker
+
+
+def is_available(action, url):
+    '''
+    Check without taking the probe whether calls to a service would be
+    sent, for the callers which can postpone their work
+    '''
+    return get_breaker(action, url).state != 'open'
+
+
+def _get_bucket(cr, dbname, action, url):
+    key = (dbname, action, url)
+    if key not in _buckets:
+        rate = dpd_client.get_transport_option('dpd_rate_limit')
+        burst = dpd_client.get_transport_option('dpd_rate_burst')
+        cr.execute("""
+            INSERT INTO dpd_rate_limit (
+                action, url, rate, capacity, tokens, date_refill,
+                create_date, write_date)
+            VALUES (%s, %s, %s, %s, %s, now() at time zone 'UTC',
+                    now() at time zone 'UTC', now() at time zone 'UTC')
+            ON CONFLICT (action, url) DO NOTHING""", (
+            action, url, rate, burst, burst))
+        cr.execute("""
+            SELECT id FROM dpd_rate_limit
+            WHERE action = %s AND url = %s""", (action, url))
+        _buckets[key] = cr.fetchone()[0]
+        cr.commit()
+    return _buckets[key]
+
+
+def acquire(dbname, action, url):
+    '''
+    Take a token of the bucket of a DPD service, the buckets are rows of
+    dpd.rate.limit so all the workers of the database share them. Waits
+    for a token at most dpd_rate_limit_wait seconds.
+    :return: True when a token was taken
+    '''
+    deadline = time.time() + dpd_client.get_transport_option(
+        'dpd_rate_limit_wait')
+    try:
+        with db_connect(dbname).cursor() as cr:
+            bucket_id = _get_bucket(cr, dbname, action, url)
+            while True:
+                cr.execute("""
+                    WITH bucket AS (
+                        SELECT id, rate, LEAST(capacity, tokens + rate *
+                            EXTRACT(EPOCH FROM (clock_timestamp() AT TIME
+                            ZONE 'UTC') - date_refill)) AS available
+                        FROM dpd_rate_limit WHERE id = %s FOR UPDATE)
+                    UPDATE dpd_rate_limit AS l SET
+                        tokens = CASE WHEN b.rate > 0 AND b.available >= 1
+                            THEN b.available - 1 ELSE b.available END,
+                        date_refill = clock_timestamp() AT TIME ZONE 'UTC'
+                    FROM bucket AS b WHERE l.id = b.id
+                    RETURNING b.rate, b.available""", (bucket_id,))
+                row = cr.fetchone()
+                cr.commit()
+                if row is None:
+                    # The row was deleted, it is created again next time
+                    _buckets.pop((dbname, action, url), None)
+                    return True
+                rate, available = row
+                # A rate of 0 disables the limit of the service
+                if rate <= 0 or available >= 1:
+                    return True
+                wait = (1 - available) / rate
+                if time.time() + wait > deadline:
+                    return False
+                time.sleep(wait)
+    except psycopg2.Error as e:
+        # Without the table, like during an update, the calls aren't held
+        _logger.info("DPD rate limit of %s not applied: %s", action, e)
+        _buckets.pop((dbname, action, url), None)
+        return True
+
+
+def record_result(action, url, failed):
+    breaker = get_breaker(action, url)
+    if not failed:
+        breaker.record_success()
+    elif breaker.record_failure():
+        _logger.warning("DPD %s failed %s times, calls are suspended for "
+                        "%s seconds", action, breaker.failures,
+                        breaker.reset_timeout)
+        dpd_metrics.inc('dpd_breaker_opened_total', action=action)
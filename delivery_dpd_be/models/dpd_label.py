@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+import base64
+import hashlib
+import tempfile
+
+from PyPDF2 import PdfFileReader, PdfFileWriter
+from PyPDF2.pdf import PageObject
+
+# Labels bigger than this are spooled to a temporary file on disk
+SPOOL_SIZE = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+# Labels merged in one intermediate document, at most this many label
+# files are open at the same time
+MERGE_CHUNK = 50
+# Labels merged in one download, the merged document is held in memory
+# while it is written
+MAX_LABELS = 1000
+# A4 size in points
+A4_WIDTH = 595.28
+A4_HEIGHT = 841.89
+
+
+class LabelFile(object):
+    '''
+    Decoded label document with its sha1 checksum, kept in a spooled
+    temporary file so big multi-parcel labels don't stay in memory
+    '''
+
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        self._sha = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self._sha.update(data)
+        self.size += len(data)
+
+    def tell(self):
+        return self.file.tell()
+
+    @property
+    def checksum(self):
+        return self._sha.hexdigest()
+
+    def open(self):
+        self.file.seek(0)
+        return self.file
+
+    def close(self):
+        self.file.close()
+
+
+class Base64Decoder(object):
+    '''
+    Decode base64 text received in pieces of any length into a binary
+    file-like target
+    '''
+
+    def __init__(self, target):
+        self.target = target
+        self._rest = b''
+
+    def write(self, text):
+        if isinstance(text, str):
+            text = text.encode('ascii')
+        data = self._rest + b''.join(text.split())
+        cut = len(data) - len(data) % 4
+        if cut:
+            self.target.write(base64.b64decode(data[:cut]))
+        self._rest = data[cut:]
+
+    def close(self):
+        if self._rest:
+            self.target.write(base64.b64decode(
+                self._rest + b'=' * (-len(self._rest) % 4)))
+            self._rest = b''
+
+
+def label_from_base64(text):
+    '''
+    Decode a base64 label chunk by chunk
+    :param text: base64 encoded document (str or bytes)
+    :return: LabelFile
+    '''
+    label = LabelFile()
+    decoder = Base64Decoder(label)
+    for start in range(0, len(text), CHUNK_SIZE):
+        decoder.write(text[start:start + CHUNK_SIZE])
+    decoder.close()
+    return label
+
+
+def split_label_pdf(label, label_pages):
+    '''
+    Split a label document in one document per picking
+    :param label: LabelFile
+    :param label_pages: list of (picking id, number of pages) in the order
+                        of the document
+    :return: list of (picking id, LabelFile)
+    '''
+    reader = PdfFileReader(label.open())
+    res = []
+    page = 0
+    for picking_id, count in label_pages:
+        writer = PdfFileWriter()
+        for index in range(page, min(page + count, reader.getNumPages())):
+            writer.addPage(reader.getPage(index))
+        page += count
+        picking_label = LabelFile()
+        writer.write(picking_label)
+        res.append((picking_id, picking_label))
+    return res
+
+
+def _write_pages(label_files, output, four_up=False):
+    writer = PdfFileWriter()
+    sheet = None
+    position = 0
+    for label_file in label_files:
+        reader = PdfFileReader(label_file, strict=False)
+        for index in range(reader.getNumPages()):
+            page = reader.getPage(index)
+            if not four_up:
+                writer.addPage(page)
+                continue
+            if position % 4 == 0:
+                sheet = PageObject.createBlankPage(
+                    width=A4_WIDTH, height=A4_HEIGHT)
+                writer.addPage(sheet)
+            width = float(page.mediaBox.getWidth())
+            height = float(page.mediaBox.getHeight())
+            scale = min(A4_WIDTH / 2 / width, A4_HEIGHT / 2 / height, 1)
+            # Fill the sheet from the top left to the bottom right
+            column, row = position % 2, (position % 4) // 2
+            sheet.mergeScaledTranslatedPage(
+                page, scale, column * A4_WIDTH / 2,
+                (1 - row) * A4_HEIGHT / 2)
+            position += 1
+    writer.write(output)
+
+
+def merge_label_pdfs(label_openers, output, four_up=False):
+    '''
+    Merge label documents in one document. The labels are opened and
+    merged MERGE_CHUNK at a time in temporary documents, which are merged
+    at the end. PyPDF2 holds a document in memory while writing it, so the
+    memory still grows with the size of the merged document: the callers
+    merge at most MAX_LABELS labels.
+    :param label_openers: list of functions returning an opened binary file
+    :param output: binary file object the merged document is written to
+    :param four_up: impose the pages 4 per A4 page (for A6 labels)
+    '''
+    chunks = []
+    try:
+        for start in range(0, len(label_openers), MERGE_CHUNK):
+            label_files = []
+            try:
+                for opener in label_openers[start:start + MERGE_CHUNK]:
+                    label_files.append(opener())
+                chunk = tempfile.TemporaryFile()
+                chunks.append(chunk)
+                _write_pages(label_files, chunk)
+            finally:
+                for label_file in label_files:
+                    label_file.close()
+        for chunk in chunks:
+            chunk.seek(0)
+        _write_pages(chunks, output, four_up=four_up)
+    finally:
+        for chunk in chunks:
+            chunk.close()
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the latency histograms, in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+HELP = {
+    'dpd_request_seconds': ('histogram', 'Time until DPD answered the '
+                                         'headers of a SOAP call'),
+    'dpd_parse_seconds': ('histogram', 'Time spent downloading and parsing '
+                                       'a streamed DPD response'),
+    'dpd_login_seconds': ('histogram', 'Time of a getAuth call'),
+    'dpd_client_build_seconds': ('histogram', 'Time to load and compile a '
+                                              'DPD WSDL'),
+    'dpd_requests_total': ('counter', 'DPD SOAP calls'),
+    'dpd_request_bytes_total': ('counter', 'Bytes of the DPD requests'),
+    'dpd_response_bytes_total': ('counter', 'Bytes of the DPD responses'),
+    'dpd_errors_total': ('counter', 'DPD calls which failed, by error '
+                                    'code'),
+    'dpd_retries_total': ('counter', 'HTTP retries of DPD calls'),
+    'dpd_auth_retries_total': ('counter', 'DPD calls sent again after a '
+                                          'new login'),
+    'dpd_logins_total': ('counter', 'getAuth calls'),
+    'dpd_client_cache_total': ('counter', 'Lookups of the compiled WSDL '
+                                          'clients'),
+    'dpd_rate_cache_total': ('counter', 'Lookups of the rate quote cache'),
+    'dpd_breaker_opened_total': ('counter', 'Times a DPD service was '
+                                            'suspended after failures'),
+    'dpd_breaker_rejected_total': ('counter', 'DPD calls not sent because '
+                                              'the service is suspended'),
+    'dpd_rate_limited_total': ('counter', 'DPD calls not sent because no '
+                                          'token became available'),
+}
+
+_lock = threading.Lock()
+# {(name, labels): [bucket counts..., sum, count]}
+_histograms = {}
+# {(name, labels): value}
+_counters = {}
+# Totals per action not flushed to the database yet
+_pending = {}
+_last_flush = [time.time()]
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(BUCKETS) + 2)
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram[index] += 1
+                break
+        histogram[-2] += value
+        histogram[-1] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - start, **labels)
+
+
+def _get_totals(action):
+    return _pending.setdefault(action, {
+        'requests': 0, 'errors': 0, 'retries': 0, 'total_time': 0.0,
+        'max_time': 0.0, 'parse_time': 0.0, 'bytes_sent': 0,
+        'bytes_received': 0})
+
+
+def record_call(action, duration, sent, received, error_code=None,
+                retries=0):
+    '''
+    Record a DPD SOAP call in the metrics and in the totals which are
+    flushed to the rolling summary of the database
+    '''
+    observe('dpd_request_seconds', duration, action=action)
+    inc('dpd_requests_total', action=action)
+    inc('dpd_request_bytes_total', sent, action=action)
+    if received:
+        inc('dpd_response_bytes_total', received, action=action)
+    if retries:
+        inc('dpd_retries_total', retries, action=action)
+    if error_code:
+        inc('dpd_errors_total', action=action, code=error_code)
+    with _lock:
+        totals = _get_totals(action)
+        totals['requests'] += 1
+        totals['errors'] += error_code and 1 or 0
+        totals['retries'] += retries
+        totals['total_time'] += duration
+        totals['max_time'] = max(totals['max_time'], duration)
+        totals['bytes_sent'] += sent
+        totals['bytes_received'] += received or 0
+
+
+def record_download(action, duration, received):
+    # Streamed response read by dpd_parser
+    observe('dpd_parse_seconds', duration, action=action)
+    inc('dpd_response_bytes_total', received, action=action)
+    with _lock:
+        totals = _get_totals(action)
+        totals['parse_time'] += duration
+        totals['bytes_received'] += received
+
+
+def pop_pending():
+    '''
+    :return: {action: totals} recorded since the last call
+    '''
+    with _lock:
+        res = dict(_pending)
+        _pending.clear()
+    return res
+
+
+def restore_pending(totals_by_action):
+    # Put back totals which could not be flushed
+    with _lock:
+        for action, totals in totals_by_action.items():
+            pending = _get_totals(action)
+            for name, value in totals.items():
+                if name == 'max_time':
+                    pending[name] = max(pending[name], value)
+                else:
+                    pending[name] += value
+
+
+def _format_labels(labels, extra=()):
+    labels = labels + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+
+
+def render(gauges=None):
+    '''
+    Prometheus text exposition of the metrics of this process, each worker
+    has its own metrics so the samples carry a pid label
+    :param gauges: {name: value} of extra gauges, like the cache sizes
+    '''
+    pid = (('pid', os.getpid()),)
+    with _lock:
+        counters = dict(_counters)
+        histograms = dict((key, list(value))
+                          for key, value in _histograms.items())
+    lines = []
+    names = sorted(set(name for name, labels in counters) |
+                   set(name for name, labels in histograms))
+    for name in names:
+        kind, description = HELP.get(name, ('untyped', name))
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append('%s%s %s' % (
+                    name, _format_labels(labels, pid), value))
+        for (metric, labels), value in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS, value):
+                cumulative += count
+                lines.append('%s_bucket%s %s' % (name, _format_labels(
+                    labels, pid + (('le', bound),)), cumulative))
+            lines.append('%s_bucket%s %s' % (name, _format_labels(
+                labels, pid + (('le', '+Inf'),)), value[-1]))
+            lines.append('%s_sum%s %s' % (
+                name, _format_labels(labels, pid), value[-2]))
+            lines.append('%s_count%s %s' % (
+                name, _format_labels(labels, pid), value[-1]))
+    for name, value in sorted((gauges or {}).items()):
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s%s %s' % (name, _format_labels((), pid), value))
+    return '\n'.join(lines) + '\n'
+
+
+def flush_due(interval):
+    '''
+    :return: True once every interval seconds for this process
+    '''
+    with _lock:
+        if time.time() - _last_flush[0] < interval:
+            return False
+        _last_flush[0] = time.time()
+        return True
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import re
+import time
+from datetime import datetime, timedelta
+
+import pytz
+from lxml import etree
+
+from . import dpd_label
+from . import dpd_metrics
+
+CHUNK_SIZE = 64 * 1024
+
+# The dates of the tracking states are in the local time of the depots
+DPD_TIMEZONE = pytz.timezone('Europe/Brussels')
+DATE_FORMATS = ('%d-%m-%Y %H:%M', '%d.%m.%Y %H:%M', '%d-%m-%Y %H:%M:%S',
+                '%d.%m.%Y %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%d-%m-%Y',
+                '%d.%m.%Y')
+# ISO 8601 dates of the pushed notifications, with fractional seconds and
+# a time zone offset or Z for UTC
+ISO_DATE = re.compile(
+    r'^(\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(?::\d{2})?)(?:[.,](\d+))?'
+    r'(Z|[+-]\d{2}:?\d{2})?$')
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+class ResponseTarget(object):
+    '''
+    lxml parser target for the storeOrders and getTrackingData responses,
+    it keeps the label numbers and status records while the response is
+    parsed and decodes the label document straight into a LabelFile, no
+    tree of the response is built
+    '''
+
+    def __init__(self):
+        self.label = None
+        self.label_number = None
+        self.shipments = []
+        self.states = []
+        self._path = []
+        self._text = []
+        self._decoder = None
+        self._status = None
+        self._status_depth = 0
+        self._shipment_depth = 0
+
+    def start(self, tag, attrib):
+        name = _local_name(tag)
+        self._path.append(name)
+        self._text = []
+        if name == 'parcellabelsPDF':
+            self.label = dpd_label.LabelFile()
+            self._decoder = dpd_label.Base64Decoder(self.label)
+        elif name == 'shipmentResponses':
+            self.shipments.append({'parcelLabelNumbers': [], 'faults': []})
+            self._shipment_depth = len(self._path)
+        elif name == 'statusInfo':
+            self._status = {}
+            self._status_depth = len(self._path)
+        elif name == 'faults' and self._shipment_depth and \
+                len(self._path) == self._shipment_depth + 1:
+            self.shipments[-1]['faults'].append({})
+
+    def data(self, data):
+        if self._decoder is not None:
+            self._decoder.write(data)
+        else:
+            self._text.append(data)
+
+    def end(self, tag):
+        name = self._path[-1]
+        text = ''.join(self._text)
+        self._text = []
+        if name == 'parcellabelsPDF':
+            self._decoder.close()
+            self._decoder = None
+        elif name == 'parcelLabelNumber' and self.label_number is None:
+            self.label_number = text
+        if self._shipment_depth:
+            self._end_shipment(name, text)
+        if self._status is not None:
+            self._end_status(name, text)
+        self._path.pop()
+
+    def _end_shipment(self, name, text):
+        path = '/'.join(self._path[self._shipment_depth:])
+        shipment = self.shipments[-1]
+        if path == 'parcelInformation/parcelLabelNumber':
+            shipment['parcelLabelNumbers'].append(text)
+        elif path in ('faults/faultCode', 'faults/message') and \
+                shipment['faults']:
+            shipment['faults'][-1].setdefault(name, text)
+        elif not path:
+            self._shipment_depth = 0
+
+    def _end_status(self, name, text):
+        path = '/'.join(self._path[self._status_depth:])
+        if path == 'importantItems/content/content':
+            self._status.setdefault('importantItems', []).append(text)
+        elif path:
+            # Like find(), only the first element of a path counts
+            self._status.setdefault(path, text)
+        else:
+            status = self._status
+            self.states.append({
+                'state': status.get('status', ''),
+                'reached': status.get('statusHasBeenReached') == 'true',
+                'current': status.get('isCurrentStatus') == 'true',
+                'location': status.get('location/content', ''),
+                'date': status.get('date/content', ''),
+                'extra_info': '/'.join(
+                    [status.get('description/content/content', '')] +
+                    status.get('importantItems', [])),
+            })
+            self._status = None
+
+    def close(self):
+        return self
+
+
+def parse_date(value):
+    '''
+    :return: naive UTC datetime of the date of a tracking state, None when
+             DPD didn't send a date
+    '''
+    value = (value or '').strip()
+    match = ISO_DATE.match(value)
+    if match:
+        return _parse_iso_date(*match.groups())
+    for date_format in DATE_FORMATS:
+        try:
+            date = datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+        return DPD_TIMEZONE.localize(date).astimezone(pytz.utc).replace(
+            tzinfo=None)
+    return None
+
+
+def _parse_iso_date(value, fraction, offset):
+    try:
+        date = datetime.strptime(value.replace(' ', 'T'), '%Y-%m-%dT%H:%M:%S'
+                                 if value.count(':') == 2 else
+                                 '%Y-%m-%dT%H:%M')
+    except ValueError:
+        return None
+    if fraction:
+        date += timedelta(microseconds=int(fraction[:6].ljust(6, '0')))
+    if not offset:
+        return DPD_TIMEZONE.localize(date).astimezone(pytz.utc).replace(
+            tzinfo=None)
+    if offset != 'Z':
+        minutes = int(offset[1:3]) * 60 + int(offset[-2:])
+        date -= timedelta(minutes=offset[0] == '-' and -minutes or minutes)
+    return date
+
+
+def parse_response(response, action):
+    '''
+    Parse a DPD response while it is downloaded
+    :param response: requests response, sent with stream=True
+    :param action: key of dpd_mapping, for the metrics
+    :return: ResponseTarget
+    '''
+    start = time.time()
+    received = 0
+    parser = etree.XMLParser(target=ResponseTarget(), huge_tree=True)
+    try:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            received += len(chunk)
+            parser.feed(chunk)
+        return parser.close()
+    finally:
+        dpd_metrics.record_download(action, time.time() - start, received)
+
+
+SHOP_FIELDS = ('parcelShopId', 'company', 'street', 'houseNo', 'countryCode',
+               'zipCode', 'city', 'phone', 'email', 'latitude', 'longitude')
+OPENING_FIELDS = ('weekday', 'openMorning', 'closeMorning', 'openAfternoon',
+                  'closeAfternoon')
+
+
+def _children(node):
+    return dict((_local_name(child.tag), child.text or '')
+                for child in node if isinstance(child.tag, str))
+
+
+def parse_parcel_shops(content):
+    '''
+    Read the shops of a findParcelShops(ByGeoData) response
+    :return: list of dicts with the SHOP_FIELDS and the openingHours
+    '''
+    res = []
+    node = etree.fromstring(content)
+    for shop_node in node.xpath('//*[local-name()="parcelShop"]'):
+        values = _children(shop_node)
+        shop = dict((name, values.get(name, '')) for name in SHOP_FIELDS)
+        shop['openingHours'] = [
+            dict((name, hours.get(name, '')) for name in OPENING_FIELDS)
+            for hours in map(_children, shop_node.xpath(
+                '*[local-name()="openingHours"]'))]
+        res.append(shop)
+    return res
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import logging
+from datetime import datetime, timedelta
+
+from odoo import fields, models, api
+
+from . import dpd_metrics
+
+_logger = logging.getLogger(__name__)
+
+# Seconds between two flushes of the totals of a worker
+FLUSH_INTERVAL = 60
+
+
+class DPDMetricSummary(models.Model):
+    _name = 'dpd.metric.summary'
+    _description = 'Hourly summary of the DPD calls'
+    _order = 'date desc, action'
+
+    date = fields.Datetime(
+        string='Hour',
+        required=True,
+        index=True,
+    )
+    action = fields.Char(
+        string='Action',
+        required=True,
+    )
+    requests = fields.Integer(
+        string='Calls',
+        group_operator='sum',
+    )
+    errors = fields.Integer(
+        string='Errors',
+        group_operator='sum',
+    )
+    retries = fields.Integer(
+        string='HTTP retries',
+        group_operator='sum',
+    )
+    total_time = fields.Float(
+        string='Total time (s)',
+        group_operator='sum',
+    )
+    max_time = fields.Float(
+        string='Slowest call (s)',
+        group_operator='max',
+    )
+    parse_time = fields.Float(
+        string='Download and parsing time (s)',
+        group_operator='sum',
+        help='Time spent reading the streamed responses after DPD sent '
+             'their headers',
+    )
+    bytes_sent = fields.Integer(
+        string='Bytes sent',
+        group_operator='sum',
+    )
+    bytes_received = fields.Integer(
+        string='Bytes received',
+        group_operator='sum',
+    )
+    average_time = fields.Float(
+        string='Average time (s)',
+        compute='_compute_average_time',
+    )
+
+    _sql_constraints = [
+        ('date_action_uniq', 'unique(date, action)',
+         'There is one summary per hour and action.'),
+    ]
+
+    @api.multi
+    def _compute_average_time(self):
+        for summary in self:
+            summary.average_time = summary.requests and \
+                summary.total_time / summary.requests or 0.0
+
+    @api.model
+    def _flush_if_due(self):
+        if dpd_metrics.flush_due(FLUSH_INTERVAL):
+            self._flush()
+
+    @api.model
+    def _flush(self):
+        '''
+        Add the totals of this worker to the summary of the current hour,
+        in a transaction of its own so they are kept when the current one
+        is rolled back
+        '''
+        pending = dpd_metrics.pop_pending()
+        if not pending:
+            return
+        hour = fields.Datetime.to_string(
+            datetime.now().replace(minute=0, second=0, microsecond=0))
+        try:
+            with self.pool.cursor() as cr:
+                for action, totals in pending.items():
+                    cr.execute("""
+                        INSERT INTO dpd_metric_summary (
+                            date, action, requests, errors, retries,
+                            total_time, max_time, parse_time, bytes_sent,
+                            bytes_received, create_uid, create_date,
+                            write_uid, write_date)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
+                                %s, now() at time zone 'UTC', %s,
+                                now() at time zone 'UTC')
+                        ON CONFLICT (date, action) DO UPDATE SET
+                            requests = dpd_metric_summary.requests +
+                                EXCLUDED.requests,
+                            errors = dpd_metric_summary.errors +
+                                EXCLUDED.errors,
+                            retries = dpd_metric_summary.retries +
+                                EXCLUDED.retries,
+                            total_time = dpd_metric_summary.total_time +
+                                EXCLUDED.total_time,
+                            max_time = GREATEST(dpd_metric_summary.max_time,
+                                                EXCLUDED.max_time),
+                            parse_time = dpd_metric_summary.parse_time +
+                                EXCLUDED.parse_time,
+                            bytes_sent = dpd_metric_summary.bytes_sent +
+                                EXCLUDED.bytes_sent,
+                            bytes_received =
+                                dpd_metric_summary.bytes_received +
+                                EXCLUDED.bytes_received,
+                            write_date = EXCLUDED.write_date""", (
+                        hour, action, totals['requests'], totals['errors'],
+                        totals['retries'], totals['total_time'],
+                        totals['max_time'], totals['parse_time'],
+                        totals['bytes_sent'], totals['bytes_received'],
+                        self.env.uid, self.env.uid))
+        except Exception as e:
+            _logger.info("DPD metrics could not be flushed: %s", e)
+            dpd_metrics.restore_pending(pending)
+
+    @api.model
+    def _cron_flush(self):
+        self._flush()
+        days = int(self.env['ir.config_parameter'].sudo().get_param(
+            'delivery_dpd_be.metrics_retention_days', 14))
+        self.search([('date', '<', fields.Datetime.to_string(
+            datetime.now() - timedelta(days=days)))]).unlink()
+        return True
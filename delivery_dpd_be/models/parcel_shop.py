@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+import json
+import math
+from datetime import datetime, timedelta
+
+from odoo import fields, models, api
+
+# Size of the grid cells in degrees, about 11 x 7 km in the Benelux
+GRID_STEP = 0.1
+EARTH_RADIUS = 6371.0
+# The parcel shops are only searched in the Benelux, DPD is not asked for
+# the positions outside this box
+COUNTRIES = ('BE', 'NL', 'LU')
+MIN_LATITUDE, MAX_LATITUDE = 49.4, 53.7
+MIN_LONGITUDE, MAX_LONGITUDE = 2.5, 7.3
+
+
+def get_bucket(latitude, longitude):
+    return '%d:%d' % (math.floor(latitude / GRID_STEP),
+                      math.floor(longitude / GRID_STEP))
+
+
+def is_supported(latitude, longitude):
+    # False for NaN as well
+    return MIN_LATITUDE <= latitude <= MAX_LATITUDE and \
+        MIN_LONGITUDE <= longitude <= MAX_LONGITUDE
+
+
+def get_bucket_center(bucket):
+    row, column = [int(index) for index in bucket.split(':')]
+    return (row + 0.5) * GRID_STEP, (column + 0.5) * GRID_STEP
+
+
+def get_neighbour_buckets(latitude, longitude):
+    '''
+    The cell of the position and the 8 cells around it, so the shops just
+    over a cell border are found too
+    '''
+    row = math.floor(latitude / GRID_STEP)
+    column = math.floor(longitude / GRID_STEP)
+    return ['%d:%d' % (row + i, column + j)
+            for i in (-1, 0, 1) for j in (-1, 0, 1)]
+
+
+def get_distance(latitude1, longitude1, latitude2, longitude2):
+    # Haversine distance in km
+    lat1, lon1, lat2, lon2 = map(math.radians, (
+        latitude1, longitude1, latitude2, longitude2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+class DPDParcelShop(models.Model):
+    _name = 'dpd.parcel.shop'
+    _description = 'DPD parcel shop'
+    _order = 'name'
+
+    shop_id = fields.Char(
+        string='Parcel shop ID',
+        required=True,
+    )
+    name = fields.Char(
+        string='Name',
+    )
+    street = fields.Char(
+        string='Street',
+    )
+    house_no = fields.Char(
+        string='House number',
+    )
+    zip = fields.Char(
+        string='Zip',
+    )
+    city = fields.Char(
+        string='City',
+    )
+    country_code = fields.Char(
+        string='Country',
+    )
+    phone = fields.Char(
+        string='Phone',
+    )
+    email = fields.Char(
+        string='Email',
+    )
+    latitude = fields.Float(
+        string='Latitude',
+        digits=(10, 7),
+    )
+    longitude = fields.Float(
+        string='Longitude',
+        digits=(10, 7),
+    )
+    bucket = fields.Char(
+        string='Grid cell',
+        index=True,
+    )
+    opening_hours = fields.Text(
+        string='Opening hours',
+    )
+    date_fetched = fields.Datetime(
+        string='Fetched on',
+    )
+
+    _sql_constraints = [
+        ('shop_id_uniq', 'unique(shop_id)',
+         'A DPD parcel shop can only be cached once.'),
+    ]
+
+    @api.model
+    def _store_shops(self, shops):
+        '''
+        Insert or refresh the shops of a DPD response
+        :param shops: list of dicts of dpd_parser.parse_parcel_shops
+        '''
+        for shop in shops:
+            try:
+                latitude = float(shop['latitude'])
+                longitude = float(shop['longitude'])
+            except ValueError:
+                continue
+            # Concurrent requests may fetch the same shops
+            self.env.cr.execute("""
+                INSERT INTO dpd_parcel_shop (
+                    shop_id, name, street, house_no, zip, city,
+                    country_code, phone, email, latitude, longitude, bucket,
+                    opening_hours, date_fetched, create_uid, create_date,
+                    write_uid, write_date)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s,
+                        now() at time zone 'UTC', %s,
+                        now() at time zone 'UTC', %s,
+                        now() at time zone 'UTC')
+                ON CONFLICT (shop_id) DO UPDATE SET
+                    name = EXCLUDED.name, street = EXCLUDED.street,
+                    house_no = EXCLUDED.house_no, zip = EXCLUDED.zip,
+                    city = EXCLUDED.city,
+                    country_code = EXCLUDED.country_code,
+                    phone = EXCLUDED.phone, email = EXCLUDED.email,
+                    latitude = EXCLUDED.latitude,
+                    longitude = EXCLUDED.longitude,
+                    bucket = EXCLUDED.bucket,
+                    opening_hours = EXCLUDED.opening_hours,
+                    date_fetched = EXCLUDED.date_fetched,
+                    write_uid = EXCLUDED.write_uid,
+                    write_date = EXCLUDED.write_date""", (
+                shop['parcelShopId'], shop['company'], shop['street'],
+                shop['houseNo'], shop['zipCode'], shop['city'],
+                shop['countryCode'], shop['phone'], shop['email'],
+                latitude, longitude, get_bucket(latitude, longitude),
+                json.dumps(shop['openingHours']), self.env.uid,
+                self.env.uid))
+        self.invalidate_cache()
+
+    @api.model
+    def _purge_bucket(self, bucket, ttl):
+        # Shops no DPD answer returned within the TTL are closed
+        self.env.cr.execute("""
+            DELETE FROM dpd_parcel_shop
+            WHERE bucket = %s AND date_fetched < %s""", (
+            bucket, fields.Datetime.to_string(datetime.now() - ttl)))
+        self.invalidate_cache()
+
+    @api.model
+    def _find_near(self, latitude, longitude, limit):
+        '''
+        Read the cached shops around a position
+        :return: list of shop dicts sorted by distance, in km
+        '''
+        self.env.cr.execute("""
+            SELECT shop_id, name, street, house_no, zip, city, country_code,
+                   phone, email, latitude, longitude, opening_hours
+            FROM dpd_parcel_shop WHERE bucket IN %s""", (
+            tuple(get_neighbour_buckets(latitude, longitude)),))
+        shops = self.env.cr.dictfetchall()
+        for shop in shops:
+            shop['distance'] = round(get_distance(
+                latitude, longitude, shop['latitude'], shop['longitude']), 3)
+            shop['opening_hours'] = json.loads(shop['opening_hours'] or '[]')
+        shops.sort(key=lambda shop: shop['distance'])
+        return shops[:limit]
+
+
+class DPDParcelShopArea(models.Model):
+    _name = 'dpd.parcel.shop.area'
+    _description = 'Area of the DPD parcel shop cache'
+
+    name = fields.Char(
+        string='Area',
+        required=True,
+        help='grid:<cell> for the cells around a position, '
+             'zip:<country>:<zip> for the postcodes searched by address',
+    )
+    latitude = fields.Float(
+        string='Latitude',
+        digits=(10, 7),
+    )
+    longitude = fields.Float(
+        string='Longitude',
+        digits=(10, 7),
+    )
+    date_fetched = fields.Datetime(
+        string='Fetched on',
+    )
+
+    _sql_constraints = [
+        ('name_uniq', 'unique(name)', 'An area can only be cached once.'),
+    ]
+
+    @api.model
+    def _get_ttl(self):
+        return timedelta(hours=float(
+            self.env['ir.config_parameter'].sudo().get_param(
+                'delivery_dpd_be.parcel_shop_ttl', 24)))
+
+    @api.model
+    def _get_fresh(self, name):
+        '''
+        :return: the area when it was fetched within the TTL
+        '''
+        return self.search([
+            ('name', '=', name),
+            ('date_fetched', '>=', fields.Datetime.to_string(
+                datetime.now() - self._get_ttl()))], limit=1)
+
+    @api.model
+    def _mark_fetched(self, name, latitude=0.0, longitude=0.0):
+        self.env.cr.execute("""
+            INSERT INTO dpd_parcel_shop_area (
+                name, latitude, longitude, date_fetched, create_uid,
+                create_date, write_uid, write_date)
+            VALUES (%s, %s, %s, now() at time zone 'UTC', %s,
+                    now() at time zone 'UTC', %s, now() at time zone 'UTC')
+            ON CONFLICT (name) DO UPDATE SET
+                latitude = EXCLUDED.latitude,
+                longitude = EXCLUDED.longitude,
+                date_fetched = EXCLUDED.date_fetched,
+                write_uid = EXCLUDED.write_uid,
+                write_date = EXCLUDED.write_date""", (
+            name, latitude, longitude, self.env.uid, self.env.uid))
+        self.invalidate_cache()
@@ -1,7 +1,17 @@
 # -*- coding: utf-8 -*-
+import base64
 import logging
+import os
+import shutil
+import time
+from datetime import datetime, timedelta
 
-from odoo import fields, models, api, _
+from psycopg2.extras import execute_values
+
+from odoo import fields, models, api, exceptions, _
+
+from . import dpd_label
+from . import dpd_parser
 
 _logger = logging.getLogger(__name__)
 
@@ -11,6 +21,19 @@ shipment_states = [('ACCEPTED', 'Accepted'),
                    ('AT_DELIVERY_DEPOT', 'At the delivery depot'),
                    ('DELIVERED', 'Delivered')]
 
+# Hours between two tracking polls per delivery state, before backing off
+POLL_INTERVALS = {False: 4,
+                  'ACCEPTED': 4,
+                  'AT_SENDING_DEPOT': 4,
+                  'ON_THE_ROAD': 2,
+                  'AT_DELIVERY_DEPOT': 1}
+MAX_POLL_INTERVAL = 48
+# Code of the copies of the synchronisation cron
+SYNC_RUNNER_CODE = 'model._check_delivery_synchro(runner=True)'
+# Minutes the requests still running at the end of the time budget of a
+# synchronisation may take
+SYNC_LEASE_MARGIN = 5
+
 
 class StockPickingParcel(models.Model):
     _name = 'stock.picking.parcel'
@@ -34,6 +57,7 @@ class StockPicking(models.Model):
     )
     dpd_label_bin = fields.Binary(
         string='DPD Label',
+        attachment=True,
         copy=False
     )
     dpd_parcel_ids = fields.One2many(
@@ -44,50 +68,270 @@ class StockPicking(models.Model):
     number_of_packages = fields.Integer(
         default=1
     )
-    dpd_delivery_info_ids = fields.One2many(
-        comodel_name='stock.picking.delivery',
+    # Pushed tracking notifications are matched on the parcel number
+    carrier_tracking_ref = fields.Char(
+        index=True,
+    )
+    dpd_tracking_event_ids = fields.One2many(
+        comodel_name='stock.picking.tracking.event',
         inverse_name='picking_id',
-        string='Delivery information',
+        string='Tracking events',
     )
     delivery_state = fields.Selection(
-        selection=[('ACCEPTED', 'Accepted'),
-                   ('AT_SENDING_DEPOT', 'At sending depot'),
-                   ('ON_THE_ROAD', 'On the road'),
-                   ('AT_DELIVERY_DEPOT', 'At the delivery depot'),
-                   ('DELIVERED', 'Delivered')],
+        selection=shipment_states,
         string='Delivery state',
         default=None,
+        index=True,
+    )
+    delivery_state_date = fields.Datetime(
+        string='Delivery state date',
+        copy=False,
+    )
+    dpd_next_poll_date = fields.Datetime(
+        string='Next tracking update',
+        index=True,
+        copy=False,
+    )
+    dpd_sync_stopped = fields.Boolean(
+        string='Tracking updates stopped',
+        copy=False,
+        help='Set when the parcel did not move for too long, the automatic '
+             'delivery synchronisation skips it.',
+    )
+    dpd_shipment_job_ids = fields.One2many(
+        comodel_name='dpd.shipment.job',
+        inverse_name='picking_id',
+        string='DPD shipment jobs',
+    )
+    dpd_job_state = fields.Selection(
+        selection=[('pending', 'Queued'),
+                   ('running', 'Sending'),
+                   ('done', 'Sent'),
+                   ('failed', 'Failed')],
+        string='DPD shipment',
+        compute='_compute_dpd_job_state',
     )
 
     @api.multi
     def create(self, vals):
         picking = super(StockPicking, self).create(vals)
-        # if the delivery carrier is dpd_be also generate the parcels
-        if picking.carrier_id.delivery_type == 'dpd_be':
-            picking.onchange_number_of_packages()
+        # if the delivery carrier is dpd_be also generate the parcels, unless
+        # they were edited in the form
+        if not vals.get('dpd_parcel_ids'):
+            picking._dpd_generate_parcels()
         return picking
 
     @api.multi
     def write(self, vals):
-        picking = super(StockPicking, self).write(vals)
-        for picking in self:
-            # if the delivery carrier is dpd_be also generate the parcels
-            if picking.carrier_id.delivery_type == 'dpd_be' and vals.get(
-                    'carrier_id'):
-                picking.onchange_number_of_packages()
-        return picking
+        res = super(StockPicking, self).write(vals)
+        # Parcels edited in the form are saved with the picking, they are
+        # only generated when the packages are changed without them
+        if vals.get('carrier_id') or ('number_of_packages' in vals and
+                                      'dpd_parcel_ids' not in vals):
+            self._dpd_generate_parcels()
+        return res
 
     @api.onchange('number_of_packages')
     def onchange_number_of_packages(self):
-        new_parcels = []
-        weight = self.number_of_packages == 1 and self.weight or 0
-        for x in range(1, self.number_of_packages + 1):
-            parcel_name = '%s-%s-%s' % (self.origin, self.name, x)
-            new_parcels.append((0, 0, {'name': parcel_name,
-                                       'weight': weight
-                                       }))
+        new_parcels = [(5, 0, 0)]
+        for vals in self._dpd_prepare_parcels():
+            del vals['picking_id']
+            new_parcels.append((0, 0, vals))
         self.update({'dpd_parcel_ids': new_parcels})
 
+    @api.multi
+    def _dpd_prepare_parcels(self):
+        '''
+        Values of the parcels of the pickings, the weight of a picking is
+        shared by its packages
+        :return: list of stock.picking.parcel values
+        '''
+        res = []
+        for picking in self:
+            count = max(picking.number_of_packages, 0)
+            weight = count and picking.weight / count or 0
+            for x in range(1, count + 1):
+                res.append({
+                    'name': '%s-%s-%s' % (picking.origin, picking.name, x),
+                    'picking_id': picking.id,
+                    'weight': weight,
+                })
+        return res
+
+    @api.multi
+    def _dpd_generate_parcels(self):
+        '''
+        Replace the parcels of the DPD pickings, the parcels of all the
+        pickings are inserted with one query
+        '''
+        pickings = self.filtered(
+            lambda p: p.carrier_id.delivery_type == 'dpd_be')
+        if not pickings:
+            return
+        parcel_model = self.env['stock.picking.parcel']
+        parcel_model.check_access_rights('create')
+        parcel_model.search([('picking_id', 'in', pickings.ids)]).unlink()
+        rows = [(vals['name'], vals['picking_id'], vals['weight'])
+                for vals in pickings._dpd_prepare_parcels()]
+        if rows:
+            # The ORM of this version creates one record per query
+            execute_values(self.env.cr, """
+                INSERT INTO stock_picking_parcel (
+                    name, picking_id, weight, create_uid, create_date,
+                    write_uid, write_date)
+                VALUES %s""", rows, template="""(
+                    %%s, %%s, %%s, %(uid)s, now() at time zone 'UTC',
+                    %(uid)s, now() at time zone 'UTC')""" % {
+                'uid': int(self.env.uid)}, page_size=1000)
+        pickings.invalidate_cache(['dpd_parcel_ids'])
+
+    @api.multi
+    def _compute_dpd_job_state(self):
+        for picking in self:
+            jobs = picking.dpd_shipment_job_ids.sorted('id')
+            picking.dpd_job_state = jobs and jobs[-1].state or False
+
+    @api.multi
+    def send_to_shipper(self):
+        self.ensure_one()
+        # In queued mode the shipment is sent by the job runners and the
+        # validation doesn't wait for DPD, it is also queued while the
+        # calls to DPD are suspended
+        carrier = self.carrier_id
+        if carrier.delivery_type == 'dpd_be' and (
+                carrier.dpd_queue_shipments or
+                not carrier.dpd_is_available('storeOrders')):
+            self.env['dpd.shipment.job'].create({
+                'picking_id': self.id,
+                'carrier_id': carrier.id,
+            })
+            if carrier.dpd_queue_shipments:
+                self.message_post(body=_("Shipment queued for DPD"))
+            else:
+                self.message_post(
+                    body=_("DPD is unavailable, shipment queued"))
+            return
+        return super(StockPicking, self).send_to_shipper()
+
+    @api.multi
+    def action_dpd_send_shipping(self):
+        # Send the selected pickings to DPD with one batched call per carrier
+        pickings = self.filtered(
+            lambda p: p.carrier_id.delivery_type == 'dpd_be' and
+            not p.carrier_tracking_ref)
+        for carrier in pickings.mapped('carrier_id'):
+            carrier_pickings = pickings.filtered(
+                lambda p: p.carrier_id == carrier)
+            results = carrier.send_shipping(carrier_pickings)
+            carrier_pickings._dpd_apply_shipping_results(results)
+        return True
+
+    @api.multi
+    def _dpd_apply_shipping_results(self, results):
+        '''
+        Store the results of send_shipping like send_to_shipper does
+        :param results: list of send_shipping results, one per picking
+        :return: the pickings which got a tracking number
+        '''
+        sent = self.browse()
+        for picking, res in zip(self, results):
+            if not res['tracking_number']:
+                continue
+            picking.write({'carrier_price': res['exact_price'],
+                           'carrier_tracking_ref': res['tracking_number']})
+            order_currency = picking.sale_id.currency_id or \
+                picking.company_id.currency_id
+            msg = _("Shipment sent to carrier %s for shipping with "
+                    "tracking number %s<br/>Cost: %.2f %s") % (
+                picking.carrier_id.name, picking.carrier_tracking_ref,
+                picking.carrier_price, order_currency.name)
+            picking.message_post(body=msg)
+            sent |= picking
+        return sent
+
+    @api.multi
+    def _dpd_get_label_attachment(self):
+        self.ensure_one()
+        return self.env['ir.attachment'].sudo().search(
+            [('res_model', '=', self._name),
+             ('res_field', '=', 'dpd_label_bin'),
+             ('res_id', '=', self.id)], limit=1)
+
+    @api.multi
+    def _dpd_store_label(self, label):
+        '''
+        Store the label as the attachment of dpd_label_bin, the file is
+        written to the filestore under its checksum without going through
+        base64 so identical labels share the same file
+        :param label: dpd_label.LabelFile
+        '''
+        self.ensure_one()
+        attachment_obj = self.env['ir.attachment'].sudo()
+        self._dpd_get_label_attachment().unlink()
+        vals = {'name': 'dpd_label_bin',
+                'datas_fname': self.dpd_label_name,
+                'res_model': self._name,
+                'res_field': 'dpd_label_bin',
+                'res_id': self.id,
+                'type': 'binary',
+                'mimetype': 'application/pdf'}
+        if attachment_obj._storage() != 'file':
+            vals['datas'] = base64.b64encode(label.open().read())
+            return attachment_obj.create(vals)
+
+        fname, full_path = attachment_obj._get_path(None, label.checksum)
+        if not os.path.exists(full_path):
+            with open(full_path, 'wb') as fp:
+                shutil.copyfileobj(label.open(), fp)
+            attachment_obj._mark_for_gc(fname)
+        vals['store_fname'] = fname
+        attachment = attachment_obj.create(vals)
+        # file_size and checksum are dropped from the values by create
+        self.env.cr.execute("""
+            UPDATE ir_attachment SET file_size = %s, checksum = %s
+            WHERE id = %s""", (label.size, label.checksum, attachment.id))
+        attachment.invalidate_cache(['file_size', 'checksum'],
+                                    attachment.ids)
+        return attachment
+
+    @api.multi
+    def action_dpd_download_label(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/delivery_dpd_be/label/%s' % self.id,
+            'target': 'self',
+        }
+
+    @api.multi
+    def action_dpd_print_labels(self, four_up=False):
+        pickings = self.filtered('dpd_label_name')
+        if not pickings:
+            raise exceptions.UserError(
+                _('None of the selected pickings has a DPD label.'))
+        if len(pickings) > dpd_label.MAX_LABELS:
+            raise exceptions.UserError(
+                _('At most %s labels can be printed at once.') %
+                dpd_label.MAX_LABELS)
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/delivery_dpd_be/labels?ids=%s&four_up=%s' % (
+                ','.join(str(picking_id) for picking_id in pickings.ids),
+                four_up and 1 or 0),
+            'target': 'self',
+        }
+
+    @api.multi
+    def action_dpd_tracking_history(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('Tracking history'),
+            'res_model': 'stock.picking.tracking.event',
+            'view_mode': 'tree',
+            'domain': [('picking_id', '=', self.id)],
+        }
+
     @api.multi
     def action_get_tracking(self):
         for picking in self:
@@ -96,82 +340,234 @@ class StockPicking(models.Model):
     @api.multi
     def update_tracking_information(self, data):
         self.ensure_one()
-        _logger.info("Synchronisation for picking:%s/%s" % (self.origin,
-                                                            self.name))
-        delivery_info = []
-        vals = {}
-        for line in data:
-            # if the status has not been reached yet then
-            # don't log the data
-            if not line.get('reached'):
-                continue
-            # if this is not the current status, check if we have
-            # this info in the log otherwise continue
-            recs = self.dpd_delivery_info_ids.filtered(
-                lambda r: r.state == line.get('state'))
-            if not recs:
-                delivery_info.append((0, 0, line))
-            else:
-                # DPD removes this info after state has been reached
-                if line.get('date', False) == '':
-                    del line['date']
-                if line.get('location', False) == '':
-                    del line['location']
-                recs.update(line)
-            # if this is the current state then also update the
-            # delivery state of the picking
-            if line.get('current') and self.delivery_state != line.get(
-                    'state'):
-                vals['delivery_state'] = line.get('state')
-                trans_state = dict(shipment_states).get(line.get('state'))
-                msg = _(
-                    "Shipment state changed to: %s") % trans_state
-                self.message_post(body=msg)
-
-        vals.update({'dpd_delivery_info_ids': delivery_info})
-        self.update(vals)
+        return self.write_tracking_information({self.id: data})
+
+    @api.multi
+    def write_tracking_information(self, data):
+        '''
+        Append the new tracking events of several pickings at once and keep
+        their current delivery state on the pickings
+        :param data: dict {picking id: list of states}
+        '''
+        event_obj = self.env['stock.picking.tracking.event']
+        reached = event_obj._get_reached_states(self.ids)
+        events = []
+        new_states = {}
+        for picking in self:
+            _logger.info("Synchronisation for picking:%s/%s" % (
+                picking.origin, picking.name))
+            for line in data.get(picking.id, []):
+                # if the status has not been reached yet then
+                # don't log the data
+                if not line.get('reached'):
+                    continue
+                state = line.get('state')
+                date = dpd_parser.parse_date(line.get('date'))
+                # DPD removes the date of a state some time after it has
+                # been reached, the event is already known then
+                if date or (picking.id, state) not in reached:
+                    events.append({
+                        'picking_id': picking.id,
+                        'state': state,
+                        'date': date,
+                        'location': line.get('location'),
+                        'description': line.get('extra_info'),
+                    })
+                # if this is the current state then also update the
+                # delivery state of the picking
+                if line.get('current') and picking.delivery_state != state:
+                    new_states[picking.id] = state, date
+        # The analysis is only rebuilt for the pickings with new events
+        self.env['dpd.delivery.state.report']._refresh(
+            event_obj._append(events))
+
+        # The state date is the one of its event when DPD sent it, so the
+        # older notifications received later can be told apart
+        pickings_by_state = {}
+        for picking_id, (state, date) in new_states.items():
+            key = state, date and fields.Datetime.to_string(date) or \
+                fields.Datetime.now()
+            pickings_by_state.setdefault(key, self.browse())
+            pickings_by_state[key] |= self.browse(picking_id)
+        for (state, date), pickings in pickings_by_state.items():
+            pickings.write({'delivery_state': state,
+                            'delivery_state_date': date})
+            trans_state = dict(shipment_states).get(state)
+            msg = _(
+                "Shipment state changed to: %s") % trans_state
+            for picking in pickings:
+                picking.message_post(body=msg)
         return True
 
     @api.model
-    def _check_delivery_synchro(self):
-        # Get all the recs which are send by dpd, which have
-        # optained a tracking reference and which are not yet delivered
-        self.search(
-            [('carrier_id.delivery_type', '=', 'dpd_be'),
-             ('carrier_tracking_ref', '!=', False),
-             ('delivery_state', '!=', 'DELIVERED')]).action_get_tracking()
+    def _dpd_sync_domain(self):
+        # All the recs which are send by dpd, which have optained a
+        # tracking reference and which are not yet delivered
+        return [('carrier_id.delivery_type', '=', 'dpd_be'),
+                ('carrier_tracking_ref', '!=', False),
+                ('delivery_state', '!=', 'DELIVERED'),
+                ('dpd_sync_stopped', '=', False)]
+
+    @api.model
+    def _dpd_claim_sync(self, limit, lease):
+        '''
+        Claim due pickings for this runner, their next poll date is moved
+        to the end of the lease, in minutes, so the other runners skip
+        them. They are
+        due again when the runner dies before it synchronised them.
+        Pickings claimed by another runner are skipped.
+        :return: the claimed pickings, the claim is committed
+        '''
+        query = self._where_calc(self._dpd_sync_domain() + [
+            '|', ('dpd_next_poll_date', '=', False),
+            ('dpd_next_poll_date', '<=', fields.Datetime.now())])
+        from_clause, where_clause, params = query.get_sql()
+        self.env.cr.execute("""
+            UPDATE stock_picking SET dpd_next_poll_date = %s
+            WHERE id IN (
+                SELECT "stock_picking".id FROM {}
+                WHERE {}
+                ORDER BY "stock_picking".dpd_next_poll_date NULLS FIRST,
+                         "stock_picking".id
+                LIMIT %s
+                FOR UPDATE OF "stock_picking" SKIP LOCKED)
+            RETURNING id""".format(from_clause, where_clause), [
+            fields.Datetime.to_string(datetime.now() + timedelta(
+                minutes=lease))] + params + [limit])
+        picking_ids = [row[0] for row in self.env.cr.fetchall()]
+        self.env.cr.commit()
+        self.invalidate_cache(['dpd_next_poll_date'], picking_ids)
+        return self.browse(picking_ids)
+
+    @api.model
+    def _dpd_get_sync_runners(self):
+        return self.env['ir.cron'].with_context(active_test=False).search(
+            [('code', '=', SYNC_RUNNER_CODE)], order='id')
+
+    @api.model
+    def _dpd_update_sync_runners(self, count):
+        '''
+        Keep count - 1 copies of the synchronisation cron, every cron
+        worker of every node can then run one of them. The copies are
+        active like the synchronisation cron.
+        '''
+        cron = self.env.ref('delivery_dpd_be.ir_cron_delivery_synchronisation',
+                            raise_if_not_found=False)
+        if not cron:
+            return
+        runners = self._dpd_get_sync_runners()
+        for index in range(len(runners) + 1, count):
+            runners |= cron.copy({
+                'name': '%s (%s)' % (cron.name, index + 1),
+                'code': SYNC_RUNNER_CODE,
+                'active': cron.active,
+            })
+        for runner in runners[max(count - 1, 0):]:
+            try:
+                with self.env.cr.savepoint():
+                    runner.unlink()
+            except exceptions.UserError:
+                # It is running, it is removed by a next run
+                continue
+        runners[:max(count - 1, 0)].filtered(
+            lambda runner: runner.active != cron.active).write(
+            {'active': cron.active})
+
+    @api.model
+    def _dpd_set_sync_active(self, active):
+        '''
+        Turn the synchronisation cron and its copies on or off, the copies
+        are created again by the next synchronisation
+        '''
+        cron = self.env.ref('delivery_dpd_be.ir_cron_delivery_synchronisation')
+        (cron | self._dpd_get_sync_runners()).write({'active': active})
+
+    @api.model
+    def _check_delivery_synchro(self, runner=False):
+        '''
+        Poll the due pickings, the most overdue first. Several runners can
+        poll at the same time since each claims its own chunks, every chunk
+        is committed so a run keeps its progress.
+        :param runner: called by a copy of the synchronisation cron
+        '''
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        workers = int(get_param('delivery_dpd_be.sync_workers', 8))
+        chunk_size = int(get_param('delivery_dpd_be.sync_chunk_size', 200))
+        max_age = int(get_param('delivery_dpd_be.sync_max_age', 30))
+        lease = int(get_param('delivery_dpd_be.sync_lease', 15))
+        deadline = time.time() + 60 * float(
+            get_param('delivery_dpd_be.sync_time_budget', 30))
+        if not runner:
+            self._dpd_update_sync_runners(
+                int(get_param('delivery_dpd_be.sync_runners', 1)))
+            # Give up on the parcels which didn't move for too long
+            cutoff = fields.Datetime.to_string(
+                datetime.now() - timedelta(days=max_age))
+            self.search(self._dpd_sync_domain() + [
+                '|', ('delivery_state_date', '<', cutoff),
+                '&', ('delivery_state_date', '=', False),
+                ('date_done', '<', cutoff)]).write({'dpd_sync_stopped': True})
+            self.env.cr.commit()
+
+        while time.time() < deadline:
+            # A chunk may be polled until the end of the time budget, its
+            # claim must not expire before
+            pickings = self._dpd_claim_sync(chunk_size, max(
+                lease, (deadline - time.time()) / 60 + SYNC_LEASE_MARGIN))
+            if not pickings:
+                break
+            synced = pickings._dpd_sync_tracking(workers=workers,
+                                                 deadline=deadline)
+            synced._dpd_schedule_next_poll()
+            # Retry the failed requests and the ones dropped because the
+            # time budget is spent a bit later
+            (pickings - synced).write({
+                'dpd_next_poll_date': fields.Datetime.to_string(
+                    datetime.now() + timedelta(hours=1))})
+            self.env.cr.commit()
         return True
 
+    @api.multi
+    def _dpd_schedule_next_poll(self):
+        '''
+        Poll parcels again after an interval depending on their delivery
+        state, doubled for every day the state didn't change
+        '''
+        now = datetime.now()
+        by_interval = {}
+        for picking in self:
+            since = fields.Datetime.from_string(
+                picking.delivery_state_date or picking.date_done)
+            days = since and max((now - since).days, 0) or 0
+            hours = min(POLL_INTERVALS.get(picking.delivery_state, 4) *
+                        2 ** min(days, 6), MAX_POLL_INTERVAL)
+            by_interval.setdefault(hours, self.browse())
+            by_interval[hours] |= picking
+        for hours, pickings in by_interval.items():
+            pickings.write({'dpd_next_poll_date': fields.Datetime.to_string(
+                now + timedelta(hours=hours))})
 
-class StockPickingDelivery(models.Model):
-    _name = 'stock.picking.delivery'
-    name = fields.Char(
-        string='Name',
-    )
-    picking_id = fields.Many2one(
-        comodel_name='stock.picking',
-        string='Picking',
-    )
-    state = fields.Selection(
-        selection=[('ACCEPTED', 'Accepted'),
-                   ('AT_SENDING_DEPOT', 'At sending depot'),
-                   ('ON_THE_ROAD', 'On the road'),
-                   ('AT_DELIVERY_DEPOT', 'At the delivery depot'),
-                   ('DELIVERED', 'Delivered')],
-        string='Delivery state',
-    )
-    reached = fields.Boolean(
-        string='Reached',
-    )
-    current = fields.Boolean(
-        string='Current',
-    )
-    location = fields.Char(
-        string='Location',
-    )
-    date = fields.Char(
-        string='Date',
-    )
-    extra_info = fields.Text(
-        string='Extra information',
-    )
+    @api.multi
+    def _dpd_sync_tracking(self, workers=8, deadline=None):
+        '''
+        Fetch the tracking data of the pickings concurrently and apply it on
+        the current cursor
+        :return: the pickings which got their tracking data
+        '''
+        synced = self.browse()
+        for carrier in self.mapped('carrier_id'):
+            carrier_pickings = self.filtered(
+                lambda p: p.carrier_id == carrier)
+            results = carrier.dpd_fetch_tracking(
+                carrier_pickings, workers=workers, deadline=deadline)
+            data = {}
+            for picking in carrier_pickings:
+                states = results.get(picking.id)
+                if isinstance(states, list):
+                    data[picking.id] = states
+                    synced |= picking
+                elif states:
+                    _logger.info("DPD synchronisation failed for "
+                                 "picking %s: %s", picking.name, states)
+            carrier_pickings.write_tracking_information(data)
+        return synced
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+from odoo import fields, models
+
+
+class DPDRateLimit(models.Model):
+    _name = 'dpd.rate.limit'
+    _description = 'Rate limit of a DPD service'
+    _order = 'action, url'
+
+    action = fields.Char(
+        string='Action',
+        required=True,
+        readonly=True,
+    )
+    url = fields.Char(
+        string='URL',
+        required=True,
+        readonly=True,
+    )
+    rate = fields.Float(
+        string='Calls per second',
+        help='Calls sent to the service per second by all the workers, '
+             '0 disables the limit.',
+    )
+    capacity = fields.Float(
+        string='Burst',
+        help='Calls which can be sent at once after the service was idle.',
+    )
+    tokens = fields.Float(
+        string='Available calls',
+        readonly=True,
+    )
+    date_refill = fields.Datetime(
+        string='Last call',
+        readonly=True,
+    )
+
+    _sql_constraints = [
+        ('action_url_uniq', 'unique(action, url)',
+         'There is one rate limit per DPD service.'),
+    ]
@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from datetime import datetime, timedelta
+
+from odoo import fields, models, api, _
+
+from .delivery_dpd import NoAnswerError
+
+_logger = logging.getLogger(__name__)
+
+
+class DPDShipmentJob(models.Model):
+    _name = 'dpd.shipment.job'
+    _description = 'DPD shipment job'
+    _order = 'id desc'
+
+    picking_id = fields.Many2one(
+        comodel_name='stock.picking',
+        string='Picking',
+        required=True,
+        index=True,
+        ondelete='cascade',
+    )
+    carrier_id = fields.Many2one(
+        comodel_name='delivery.carrier',
+        string='Carrier',
+        required=True,
+    )
+    state = fields.Selection(
+        selection=[('pending', 'Queued'),
+                   ('running', 'Sending'),
+                   ('done', 'Sent'),
+                   ('failed', 'Failed')],
+        string='State',
+        default='pending',
+        required=True,
+        index=True,
+    )
+    attempts = fields.Integer(
+        string='Attempts',
+    )
+    next_attempt_date = fields.Datetime(
+        string='Next attempt',
+    )
+    date_started = fields.Datetime(
+        string='Started on',
+    )
+    error = fields.Text(
+        string='Error',
+    )
+
+    @api.multi
+    def action_retry(self):
+        self.write({'state': 'pending',
+                    'next_attempt_date': False,
+                    'error': False})
+        return True
+
+    @api.model
+    def _claim_jobs(self, limit):
+        '''
+        Take due jobs which no other runner is working on
+        :return: the claimed jobs, already committed as running
+        '''
+        self.env.cr.execute("""
+            UPDATE dpd_shipment_job SET state = 'running',
+                date_started = now() at time zone 'UTC'
+            WHERE id IN (
+                SELECT id FROM dpd_shipment_job
+                WHERE state = 'pending' AND (next_attempt_date IS NULL OR
+                      next_attempt_date <= now() at time zone 'UTC')
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED)
+            RETURNING id""", (limit,))
+        job_ids = [row[0] for row in self.env.cr.fetchall()]
+        self.env.cr.commit()
+        return self.browse(job_ids)
+
+    @api.model
+    def _process_jobs(self):
+        '''
+        Run the queued shipments, several runners can drain the queue at
+        the same time since every runner claims its own jobs
+        '''
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        batch_size = int(get_param('delivery_dpd_be.job_batch_size', 30))
+        lease = int(get_param('delivery_dpd_be.job_lease', 15))
+        deadline = time.time() + 60 * float(
+            get_param('delivery_dpd_be.job_time_budget', 10))
+
+        # Jobs of a runner which died are queued again
+        self.search([
+            ('state', '=', 'running'),
+            ('date_started', '<', fields.Datetime.to_string(
+                datetime.now() - timedelta(minutes=lease)))]).write(
+            {'state': 'pending'})
+        self.env.cr.commit()
+
+        while time.time() < deadline:
+            jobs = self._claim_jobs(batch_size)
+            if not jobs:
+                break
+            for carrier in jobs.mapped('carrier_id'):
+                jobs.filtered(lambda j: j.carrier_id == carrier)._run()
+            self.env.cr.commit()
+        return True
+
+    @api.multi
+    def _run(self):
+        carrier = self.mapped('carrier_id')
+        carrier.ensure_one()
+        # The pickings sent by hand while their job was queued are done
+        done = self.filtered(lambda j: j.picking_id.carrier_tracking_ref)
+        done.write({'state': 'done', 'error': False})
+        jobs = self - done
+        pickings = jobs.mapped('picking_id')
+        if not pickings:
+            return
+        if not carrier.dpd_is_available('storeOrders'):
+            # Wait for the service to come back without using an attempt
+            jobs.write({'state': 'pending',
+                        'error': _('DPD is unavailable'),
+                        'next_attempt_date': fields.Datetime.to_string(
+                            datetime.now() + timedelta(minutes=1))})
+            return
+        try:
+            with self.env.cr.savepoint():
+                results = carrier.send_shipping(pickings)
+                sent = pickings._dpd_apply_shipping_results(results)
+        except NoAnswerError as e:
+            # Sending again could store the shipments twice
+            jobs._fail(e.name)
+            return
+        except Exception as e:
+            _logger.info("DPD shipment job failed: %s", e)
+            jobs._retry(getattr(e, 'name', None) or str(e))
+            return
+        unanswered = pickings.browse([
+            picking.id for picking, res in zip(pickings, results)
+            if res.get('dpd_no_answer')])
+        jobs.filtered(lambda j: j.picking_id in sent).write(
+            {'state': 'done', 'error': False})
+        jobs.filtered(lambda j: j.picking_id in unanswered)._fail(
+            _('DPD did not answer, check whether the shipment was stored'))
+        jobs.filtered(
+            lambda j: j.picking_id not in sent | unanswered)._retry(
+            _('No tracking number returned'))
+
+    @api.multi
+    def _fail(self, error):
+        # Left to a manual check and retry
+        self.write({'state': 'failed', 'error': error})
+        for job in self:
+            job.picking_id.message_post(
+                body=_("Shipment could not be sent to DPD: %s") % error)
+
+    @api.multi
+    def _retry(self, error):
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        max_attempts = int(get_param('delivery_dpd_be.job_max_attempts', 5))
+        for job in self:
+            attempts = job.attempts + 1
+            if attempts >= max_attempts:
+                job.attempts = attempts
+                job._fail(error)
+                continue
+            # Wait 2, 4, 8, ... minutes before the next attempt
+            job.write({'state': 'pending',
+                       'attempts': attempts,
+                       'error': error,
+                       'next_attempt_date': fields.Datetime.to_string(
+                           datetime.now() + timedelta(
+                               minutes=2 ** attempts))})
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+from psycopg2.extras import execute_values
+
+from odoo import fields, models, api
+
+from .picking import shipment_states
+
+INSERT_PAGE_SIZE = 1000
+
+
+def get_event_key(picking_id, state, date):
+    # Polling again returns the same states, they are stored once
+    return '%s/%s/%s' % (picking_id, state, date or '')
+
+
+class StockPickingTrackingEvent(models.Model):
+    '''
+    Append-only log of the DPD tracking states reached by the pickings, the
+    current state is kept on the picking. An event received without date
+    is only replaced by the dated event of its state.
+    '''
+    _name = 'stock.picking.tracking.event'
+    _description = 'DPD tracking event'
+    _order = 'date desc, id desc'
+    _log_access = False
+
+    event_key = fields.Char(
+        string='Key',
+        required=True,
+        readonly=True,
+    )
+    picking_id = fields.Many2one(
+        comodel_name='stock.picking',
+        string='Picking',
+        required=True,
+        readonly=True,
+        ondelete='cascade',
+    )
+    state = fields.Selection(
+        selection=shipment_states,
+        string='Delivery state',
+        required=True,
+        readonly=True,
+    )
+    date = fields.Datetime(
+        string='Date',
+        index=True,
+        readonly=True,
+    )
+    location = fields.Char(
+        string='Location',
+        readonly=True,
+    )
+    description = fields.Text(
+        string='Description',
+        readonly=True,
+    )
+    date_received = fields.Datetime(
+        string='Received on',
+        readonly=True,
+    )
+
+    _sql_constraints = [
+        ('event_key_uniq', 'unique(event_key)',
+         'A tracking event can only be stored once.'),
+    ]
+
+    @api.model_cr
+    def init(self):
+        # History of a picking and its last event of a state
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS
+                stock_picking_tracking_event_picking_state_index
+            ON stock_picking_tracking_event (picking_id, state)""")
+
+    @api.model
+    def _get_reached_states(self, picking_ids):
+        '''
+        :return: set of the (picking id, state) which have an event
+        '''
+        if not picking_ids:
+            return set()
+        self.env.cr.execute("""
+            SELECT DISTINCT picking_id, state
+            FROM stock_picking_tracking_event
+            WHERE picking_id IN %s""", (tuple(picking_ids),))
+        return set(self.env.cr.fetchall())
+
+    @api.model
+    def _append(self, events):
+        '''
+        Store the events which aren't known yet
+        :param events: list of dicts with picking_id, state, date (naive UTC
+                       datetime or None), location and description
+        :return: set of the ids of the pickings which got new events
+        '''
+        if not events:
+            return set()
+        # An undated event is the same as any event of its state: a state
+        # can be sent without date before it is polled with its date
+        self.env.cr.execute("""
+            SELECT picking_id, state, MIN(CASE WHEN date IS NULL THEN id END)
+            FROM stock_picking_tracking_event
+            WHERE picking_id IN %s
+            GROUP BY picking_id, state""", (
+            tuple(set(event['picking_id'] for event in events)),))
+        reached = set()
+        undated = {}
+        for picking_id, state, undated_id in self.env.cr.fetchall():
+            reached.add((picking_id, state))
+            if undated_id:
+                undated[picking_id, state] = undated_id
+        rows = []
+        replaced = set()
+        for event in events:
+            key = event['picking_id'], event['state']
+            # The dates of the polls have no fraction of second
+            date = event.get('date') and event['date'].replace(microsecond=0)
+            if not date:
+                if key in reached:
+                    continue
+                reached.add(key)
+            elif key in undated:
+                replaced.add(undated.pop(key))
+            rows.append((
+                get_event_key(event['picking_id'], event['state'], date),
+                event['picking_id'], event['state'],
+                date and fields.Datetime.to_string(date) or None,
+                event.get('location') or None,
+                event.get('description') or None))
+        picking_ids = set()
+        if replaced:
+            # The dated events replace the undated ones of their state
+            self.env.cr.execute("""
+                DELETE FROM stock_picking_tracking_event WHERE id IN %s
+                RETURNING picking_id""", (tuple(replaced),))
+            picking_ids.update(row[0] for row in self.env.cr.fetchall())
+        # One statement per page so the inserted rows can be fetched
+        for start in range(0, len(rows), INSERT_PAGE_SIZE):
+            execute_values(
+                self.env.cr, """
+                INSERT INTO stock_picking_tracking_event (
+                    event_key, picking_id, state, date, location,
+                    description, date_received)
+                VALUES %s
+                ON CONFLICT (event_key) DO NOTHING
+                RETURNING picking_id""", rows[start:start + INSERT_PAGE_SIZE],
+                template="(%s, %s, %s, %s, %s, %s, "
+                         "now() at time zone 'UTC')",
+                page_size=INSERT_PAGE_SIZE)
+            picking_ids.update(row[0] for row in self.env.cr.fetchall())
+        self.invalidate_cache()
+        return picking_ids
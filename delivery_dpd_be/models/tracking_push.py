@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+from psycopg2.extras import execute_values
+
+from odoo import fields, models, api
+
+from . import dpd_parser
+from .picking import shipment_states
+
+_logger = logging.getLogger(__name__)
+
+
+class DPDTrackingPush(models.Model):
+    '''
+    Buffer of the status notifications pushed by DPD, the controller only
+    inserts them and a cron applies them in batches
+    '''
+    _name = 'dpd.tracking.push'
+    _description = 'DPD tracking notification'
+    _order = 'id'
+    _log_access = False
+
+    parcel_number = fields.Char(
+        string='Parcel number',
+        required=True,
+    )
+    status = fields.Char(
+        string='Status',
+    )
+    timestamp = fields.Char(
+        string='Timestamp',
+        help='Date of the status as sent by DPD',
+    )
+    depot = fields.Char(
+        string='Depot',
+    )
+    date_received = fields.Datetime(
+        string='Received on',
+    )
+
+    @api.model
+    def _buffer(self, events):
+        '''
+        Store pushed notifications with one statement
+        :param events: list of dicts with parcel_number, status, timestamp
+                       and depot
+        '''
+        execute_values(self.env.cr, """
+            INSERT INTO dpd_tracking_push (
+                parcel_number, status, timestamp, depot, date_received)
+            VALUES %s""", [(
+                event['parcel_number'], event.get('status'),
+                event.get('timestamp'), event.get('depot'))
+                for event in events],
+            template="(%s, %s, %s, %s, now() at time zone 'UTC')",
+            page_size=1000)
+
+    @api.model
+    def _claim(self, limit):
+        '''
+        Take the oldest notifications out of the buffer, they come back
+        when the transaction is rolled back. Notifications claimed by
+        another runner are skipped.
+        '''
+        self.env.cr.execute("""
+            DELETE FROM dpd_tracking_push
+            WHERE id IN (
+                SELECT id FROM dpd_tracking_push
+                ORDER BY id LIMIT %s
+                FOR UPDATE SKIP LOCKED)
+            RETURNING id, parcel_number, status, timestamp, depot""", (
+            limit,))
+        return sorted(self.env.cr.fetchall())
+
+    @api.model
+    def _apply_pushed(self):
+        '''
+        Apply the buffered notifications like the polled tracking states,
+        one transaction per batch
+        '''
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        batch_size = int(get_param('delivery_dpd_be.push_batch_size', 1000))
+        deadline = time.time() + 60 * float(
+            get_param('delivery_dpd_be.push_time_budget', 5))
+        while time.time() < deadline:
+            rows = self._claim(batch_size)
+            if not rows:
+                break
+            self._apply_rows(rows)
+            self.env.cr.commit()
+        return True
+
+    @api.model
+    def _apply_rows(self, rows):
+        states = dict(shipment_states)
+        picking_model = self.env['stock.picking']
+        pickings = picking_model.search([
+            ('carrier_id.delivery_type', '=', 'dpd_be'),
+            ('carrier_tracking_ref', 'in',
+             list(set(row[1] for row in rows)))])
+        picking_ids = {picking.carrier_tracking_ref: picking.id
+                       for picking in pickings}
+
+        data = {}
+        latest = {}
+        ignored = 0
+        for push_id, parcel_number, status, timestamp, depot in rows:
+            picking_id = picking_ids.get(parcel_number)
+            if not picking_id or status not in states:
+                ignored += 1
+                continue
+            line = {
+                'state': status,
+                'reached': True,
+                'current': False,
+                'location': depot or '',
+                'date': timestamp or '',
+                'extra_info': '',
+            }
+            data.setdefault(picking_id, []).append(line)
+            date = dpd_parser.parse_date(timestamp)
+            if date and (picking_id not in latest or
+                         date >= latest[picking_id][0]):
+                latest[picking_id] = (date, line)
+        # The notifications don't arrive in order, the latest dated one is
+        # the current state unless the picking reached its state later. A
+        # late notification doesn't move a delivered parcel back either,
+        # the older ones are only kept in the history.
+        for picking in pickings:
+            if picking.id not in latest or \
+                    picking.delivery_state == 'DELIVERED':
+                continue
+            date, line = latest[picking.id]
+            if picking.delivery_state_date and date < \
+                    fields.Datetime.from_string(picking.delivery_state_date):
+                continue
+            line['current'] = True
+        if ignored:
+            _logger.info("%s DPD notifications of unknown parcels or states "
+                         "ignored", ignored)
+
+        updated = picking_model.browse(list(data))
+        updated.write_tracking_information(data)
+        # Polling is only a fallback for the parcels DPD notifies about
+        updated._dpd_schedule_next_poll()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Throughput benchmark of the DPD integration against fake_dpd_server.py.
+
+It measures, at each scale:
+- labels/s of delivery.carrier.dpd_be_send_shipping
+- pickings/s of the tracking synchronisation (_check_delivery_synchro)
+- quotes/s of dpd_be_rate_shipment, with a cold and a warm quote cache
+- the peak RSS of the process after each step
+
+The synchronisation commits its progress, so run it on a scratch database
+with delivery_dpd_be installed and dpd_service_url set to the fake server.
+It stops when pickings which it didn't create are due for a poll:
+
+    python3 fake_dpd_server.py --port 8765 &
+    python3 benchmark.py -c odoo.conf -d dpd_bench --scales 10,100,1000
+'''
+import argparse
+import json
+import resource
+import sys
+import time
+
+import odoo
+from odoo import api, fields, SUPERUSER_ID
+from odoo.tools import config
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def timed(function, *args, **kwargs):
+    start = time.time()
+    res = function(*args, **kwargs)
+    return res, time.time() - start
+
+
+class Benchmark(object):
+
+    def __init__(self, env, options):
+        self.env = env
+        self.options = options
+        self.carrier = None
+        self.partner = None
+        self.product = None
+        # All the pickings created by the benchmark
+        self.pickings = env['stock.picking']
+
+    def setup(self):
+        env = self.env
+        belgium = env.ref('base.be')
+        self.partner = env['res.partner'].create({
+            'name': 'DPD benchmark customer',
+            'street': 'Stationsstraat 1',
+            'zip': '1000',
+            'city': 'Brussel',
+            'country_id': belgium.id,
+        })
+        warehouse = env['stock.warehouse'].search([], limit=1)
+        warehouse.partner_id.write({
+            'street': warehouse.partner_id.street or 'Kerkstraat 1',
+            'zip': warehouse.partner_id.zip or '2000',
+            'city': warehouse.partner_id.city or 'Antwerpen',
+            'country_id': warehouse.partner_id.country_id.id or belgium.id,
+        })
+        self.product = env['product.product'].create({
+            'name': 'DPD benchmark product',
+            'type': 'consu',
+            'weight': 1.5,
+            'list_price': 20.0,
+        })
+        delivery_product = env['product.product'].create({
+            'name': 'DPD benchmark delivery',
+            'type': 'service',
+        })
+        self.carrier = env['delivery.carrier'].create({
+            'name': 'DPD benchmark',
+            'delivery_type': 'dpd_be',
+            'product_id': delivery_product.id,
+            'prod_environment': False,
+            'dpd_delis_id': 'benchmark',
+            'dpd_password': 'benchmark',
+            'dpd_label_size': 'A6',
+            'dpd_batch_size': self.options.batch_size,
+            'dpd_shipping_cost_type': 'base_on_rule',
+            'price_rule_ids': [
+                (0, 0, {'variable': 'weight', 'operator': '<=',
+                        'max_value': 5, 'list_base_price': 6.5}),
+                (0, 0, {'variable': 'weight', 'operator': '<=',
+                        'max_value': 20, 'list_base_price': 9.5}),
+                (0, 0, {'variable': 'weight', 'operator': '>',
+                        'max_value': 20, 'list_base_price': 15.0}),
+            ],
+        })
+        self.env['ir.config_parameter'].sudo().set_param(
+            'delivery_dpd_be.sync_workers', self.options.workers)
+
+    def create_pickings(self, count):
+        picking_type = self.env.ref('stock.picking_type_out')
+        pickings = self.env['stock.picking']
+        for index in range(count):
+            pickings |= pickings.create({
+                'partner_id': self.partner.id,
+                'picking_type_id': picking_type.id,
+                'location_id': picking_type.default_location_src_id.id,
+                'location_dest_id': self.partner.property_stock_customer.id,
+                'carrier_id': self.carrier.id,
+                'origin': 'BENCH%s' % index,
+                'move_lines': [(0, 0, {
+                    'name': self.product.name,
+                    'product_id': self.product.id,
+                    'product_uom': self.product.uom_id.id,
+                    'product_uom_qty': 1 + index % 3,
+                    'location_id': picking_type.default_location_src_id.id,
+                    'location_dest_id':
+                        self.partner.property_stock_customer.id,
+                })],
+            })
+        self.pickings |= pickings
+        return pickings
+
+    def create_orders(self, count):
+        orders = self.env['sale.order']
+        for index in range(count):
+            orders |= orders.create({
+                'partner_id': self.partner.id,
+                'carrier_id': self.carrier.id,
+                'order_line': [(0, 0, {
+                    'product_id': self.product.id,
+                    'product_uom_qty': 1 + index % 20,
+                })],
+            })
+        return orders
+
+    def run_shipping(self, count):
+        pickings = self.create_pickings(count)
+        results, elapsed = timed(self.carrier.send_shipping, pickings)
+        sent = pickings._dpd_apply_shipping_results(results)
+        return pickings, {
+            'labels': len(sent),
+            'seconds': elapsed,
+            'labels_per_second': len(sent) / elapsed,
+        }
+
+    def run_tracking(self, pickings):
+        picking_model = self.env['stock.picking']
+        # Only the pickings of this run are due, the benchmark doesn't
+        # touch the other pickings of the database
+        (self.pickings - pickings).write(
+            {'dpd_next_poll_date': '2999-01-01 00:00:00'})
+        pickings.write({'dpd_next_poll_date': False})
+        self.env.cr.commit()
+        if picking_model.search_count(picking_model._dpd_sync_domain() + [
+                ('id', 'not in', self.pickings.ids),
+                '|', ('dpd_next_poll_date', '=', False),
+                ('dpd_next_poll_date', '<=', fields.Datetime.now())]):
+            sys.exit('Other DPD pickings are due, they would be polled')
+        # As a runner, the synchronisation neither updates its crons nor
+        # stops the synchronisation of the old pickings
+        result, elapsed = timed(picking_model._check_delivery_synchro,
+                                runner=True)
+        pickings.invalidate_cache()
+        synced = pickings.filtered(
+            lambda p: p.dpd_next_poll_date and
+            p.dpd_next_poll_date < '2999-01-01')
+        return {
+            'pickings': len(synced),
+            'seconds': elapsed,
+            'pickings_per_second': len(synced) / elapsed,
+        }
+
+    def run_rates(self, count):
+        from odoo.addons.delivery_dpd_be.models import dpd_cache
+        orders = self.create_orders(count)
+        dpd_cache.rate_cache.clear()
+        res, cold = timed(lambda: [self.carrier.dpd_be_rate_shipment(order)
+                                   for order in orders])
+        res, warm = timed(lambda: [self.carrier.dpd_be_rate_shipment(order)
+                                   for order in orders])
+        return {
+            'quotes': count,
+            'cold_quotes_per_second': count / cold,
+            'warm_quotes_per_second': count / warm,
+        }
+
+    def run(self, scale):
+        res = {'scale': scale}
+        pickings, res['shipping'] = self.run_shipping(scale)
+        res['shipping']['peak_rss_mb'] = peak_rss_mb()
+        res['tracking'] = self.run_tracking(pickings)
+        res['tracking']['peak_rss_mb'] = peak_rss_mb()
+        res['rates'] = self.run_rates(scale)
+        res['rates']['peak_rss_mb'] = peak_rss_mb()
+        self.env.cr.commit()
+        return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-c', '--config', required=True)
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--scales', default='10,100,1000')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='concurrent tracking requests')
+    parser.add_argument('--batch-size', type=int, default=30,
+                        help='orders per storeOrders request')
+    parser.add_argument('--output', help='write the results as JSON')
+    options = parser.parse_args()
+
+    config.parse_config(['-c', options.config, '-d', options.database])
+    if not config.get('dpd_service_url'):
+        sys.exit('dpd_service_url is not set, the benchmark would call DPD')
+
+    results = []
+    with api.Environment.manage():
+        registry = odoo.registry(options.database)
+        with registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {'tracking_disable': True})
+            benchmark = Benchmark(env, options)
+            benchmark.setup()
+            # The login and the synchronisation work in their own cursors,
+            # which must see the carrier and the products
+            cr.commit()
+            for scale in [int(scale) for scale in options.scales.split(',')]:
+                res = benchmark.run(scale)
+                results.append(res)
+                print('%6d records: %8.1f labels/s %8.1f pickings/s '
+                      '%8.1f quotes/s (%.1f warm) %8.1f MB peak RSS' % (
+                          scale, res['shipping']['labels_per_second'],
+                          res['tracking']['pickings_per_second'],
+                          res['rates']['cold_quotes_per_second'],
+                          res['rates']['warm_quotes_per_second'],
+                          res['rates']['peak_rss_mb']))
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+Stand-in for the DPD web services, to run the module and its benchmark
+without the DPD stage servers.
+
+It serves the WSDL documents of dpd_mapping and answers getAuth,
+storeOrders, getTrackingData, findParcelShops and findParcelShopsByGeoData
+with payloads shaped like the DPD ones, after a configurable latency and
+with optional fault injection.
+
+    python3 fake_dpd_server.py --port 8765 --latency 80 --fault-rate 0.01
+
+and in the Odoo configuration file:
+
+    dpd_service_url = http://localhost:8765
+
+With --push-url it also notifies the state changes of the parcels it
+labelled to the tracking push endpoint of the module, like DPD does:
+
+    python3 fake_dpd_server.py --advance 60 --push-token secret \
+        --push-url http://localhost:8069/delivery_dpd_be/tracking/push_batch
+'''
+import argparse
+import base64
+import io
+import json
+import math
+import os
+import random
+import threading
+import time
+import urllib.request
+import uuid
+import zlib
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from xml.sax.saxutils import escape
+
+from lxml import etree
+from PyPDF2 import PdfFileWriter
+from PyPDF2.generic import DecodedStreamObject, NameObject
+
+WSDL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wsdl')
+SERVICES = {
+    'LoginService.svc': 'login.wsdl',
+    'ShipmentService.svc': 'shipment.wsdl',
+    'ParcelLifeCycleService.svc': 'tracking.wsdl',
+    'ParcelShopFinderService.svc': 'parcelshop.wsdl',
+}
+NAMESPACES = {
+    'getAuth': 'http://dpd.com/common/service/types/LoginService/2.0',
+    'storeOrders': 'http://dpd.com/common/service/types/'
+                   'ShipmentService/3.1',
+    'getTrackingData': 'http://dpd.com/common/service/types/'
+                       'ParcelLifeCycleService/2.0',
+    'findParcelShops': 'http://dpd.com/common/service/types/'
+                       'ParcelShopFinderService/3.0',
+    'findParcelShopsByGeoData': 'http://dpd.com/common/service/types/'
+                                'ParcelShopFinderService/3.0',
+}
+ENVELOPE = ('<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">'
+            '<s:Body>%s</s:Body></s:Envelope>')
+PAGE_SIZES = {'A4': (595.28, 841.89), 'A6': (297.64, 420.94)}
+TRACKING_STATES = ('ACCEPTED', 'AT_SENDING_DEPOT', 'ON_THE_ROAD',
+                   'AT_DELIVERY_DEPOT', 'DELIVERED')
+WEEKDAYS = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
+            'Saturday')
+# Distance in degrees between the fake parcel shops
+SHOP_STEP = 0.02
+# Notifications per push request
+PUSH_BATCH_SIZE = 1000
+
+
+class Fault(Exception):
+
+    def __init__(self, code, message):
+        super(Fault, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+class FakeDPD(object):
+
+    def __init__(self, options):
+        self.options = options
+        self.started = time.time()
+        self.tokens = set()
+        self._labels = {}
+        self._lock = threading.Lock()
+        self._sequence = 0
+        # {parcel label number: number of states pushed}
+        self._pushed = {}
+
+    def delay(self):
+        latency = random.gauss(self.options.latency, self.options.jitter)
+        time.sleep(max(latency, 0) / 1000.0)
+
+    def next_label_number(self):
+        with self._lock:
+            self._sequence += 1
+            number = '05305%09d' % self._sequence
+            self._pushed[number] = 0
+            return number
+
+    def get_reached(self, number):
+        # Parcels start in one of the first states and move one state
+        # further every --advance seconds
+        return min(zlib.crc32(number.encode()) % 3 + int(
+            (time.time() - self.started) / self.options.advance), 5)
+
+    def push_states(self):
+        '''
+        Notify the states reached since the last push, every
+        --push-interval seconds
+        '''
+        while True:
+            time.sleep(self.options.push_interval)
+            events = []
+            with self._lock:
+                parcels = list(self._pushed.items())
+            for number, pushed in parcels:
+                reached = self.get_reached(number)
+                for index in range(pushed, reached):
+                    events.append({
+                        'parcel_number': number,
+                        'status': TRACKING_STATES[index],
+                        'timestamp': datetime.now().strftime(
+                            '%d-%m-%Y %H:%M'),
+                        'depot': '0530',
+                    })
+                with self._lock:
+                    self._pushed[number] = reached
+            for start in range(0, len(events), PUSH_BATCH_SIZE):
+                self.post_events(events[start:start + PUSH_BATCH_SIZE])
+
+    def post_events(self, events):
+        request = urllib.request.Request(
+            self.options.push_url, data=json.dumps({
+                'jsonrpc': '2.0', 'method': 'call', 'params': {
+                    'events': events, 'token': self.options.push_token},
+            }).encode(), headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                result = json.loads(response.read().decode())
+        except (OSError, ValueError) as e:
+            print('Push of %s notifications failed: %s' % (len(events), e))
+            return
+        if self.options.verbose:
+            print('Pushed %s notifications: %s' % (
+                len(events), result.get('result', result.get('error'))))
+
+    def label_document(self, pages, paper_format):
+        '''
+        PDF of blank pages with a content stream of about --label-kb per
+        page, so the transfer and the PDF handling weigh like real labels
+        '''
+        key = (pages, paper_format)
+        if key not in self._labels:
+            width, height = PAGE_SIZES.get(paper_format, PAGE_SIZES['A6'])
+            content = b'0 0 1 1 re f\n' * (self.options.label_kb * 80)
+            writer = PdfFileWriter()
+            for index in range(pages):
+                page = writer.addBlankPage(width=width, height=height)
+                stream = DecodedStreamObject()
+                stream.setData(content)
+                page[NameObject('/Contents')] = writer._addObject(stream)
+            output = io.BytesIO()
+            writer.write(output)
+            self._labels[key] = base64.b64encode(output.getvalue()).decode()
+        return self._labels[key]
+
+    def is_faulty(self, reference):
+        # The same orders fail every time so the batches can be bisected
+        rate = self.options.order_fault_rate
+        return rate and zlib.crc32(reference.encode()) % 10000 < rate * 10000
+
+    def answer(self, action, body, headers):
+        '''
+        :return: HTTP status, response body
+        '''
+        if random.random() < self.options.unavailable_rate:
+            return 503, '<html><body>Service Unavailable</body></html>'
+        if random.random() < self.options.fault_rate:
+            return 500, soap_fault('COMMON_5', 'Internal server error')
+        if action == 'getAuth':
+            return 200, self.get_auth(body)
+        token = headers.findtext('.//authToken') if headers is not None \
+            else None
+        if token not in self.tokens or \
+                random.random() < self.options.token_expiry_rate:
+            return 500, auth_fault()
+        handlers = {
+            'storeOrders': self.store_orders,
+            'getTrackingData': self.get_tracking_data,
+            'findParcelShops': self.find_parcel_shops,
+            'findParcelShopsByGeoData': self.find_parcel_shops_by_geo_data,
+        }
+        try:
+            return 200, handlers[action](body)
+        except Fault as fault:
+            return 500, soap_fault(fault.code, fault.message)
+
+    def get_auth(self, body):
+        token = uuid.uuid4().hex
+        with self._lock:
+            self.tokens.add(token)
+        return ENVELOPE % (
+            '<getAuthResponse xmlns="%s"><return xmlns="">'
+            '<delisId>%s</delisId><customerUid>%s</customerUid>'
+            '<authToken>%s</authToken><depot>0530</depot>'
+            '</return></getAuthResponse>' % (
+                NAMESPACES['getAuth'], escape(body.findtext('delisId') or ''),
+                escape(body.findtext('delisId') or ''), token))
+
+    def store_orders(self, body):
+        paper_format = body.findtext('printOptions/paperFormat') or 'A6'
+        responses = []
+        parcel_count = 0
+        for order in body.findall('order'):
+            reference = order.findtext(
+                'parcels/customerReferenceNumber1') or ''
+            if self.is_faulty(reference):
+                raise Fault('COMMON_7', 'Invalid order %s' % reference)
+            numbers = [self.next_label_number()
+                       for parcel in order.findall('parcels') or [None]]
+            parcel_count += len(numbers)
+            responses.append(
+                '<shipmentResponses><mpsId>MPS%s</mpsId>%s'
+                '</shipmentResponses>' % (numbers[0], ''.join(
+                    '<parcelInformation><parcelLabelNumber>%s'
+                    '</parcelLabelNumber></parcelInformation>' % number
+                    for number in numbers)))
+        pages = paper_format == 'A4' and int(math.ceil(
+            parcel_count / 4.0)) or parcel_count
+        return ENVELOPE % (
+            '<storeOrdersResponse xmlns="%s"><orderResult xmlns="">'
+            '<parcellabelsPDF>%s</parcellabelsPDF>%s'
+            '</orderResult></storeOrdersResponse>' % (
+                NAMESPACES['storeOrders'],
+                self.label_document(max(pages, 1), paper_format),
+                ''.join(responses)))
+
+    def get_tracking_data(self, body):
+        number = body.findtext('parcelLabelNumber') or ''
+        reached = self.get_reached(number)
+        now = datetime.now()
+        states = []
+        for index, state in enumerate(TRACKING_STATES):
+            date = now - timedelta(hours=6 * (reached - index))
+            states.append(
+                '<statusInfo><status>%s</status>'
+                '<label><content>%s</content></label>'
+                '<description><content><content>Parcel %s</content>'
+                '</content></description>'
+                '<statusHasBeenReached>%s</statusHasBeenReached>'
+                '<isCurrentStatus>%s</isCurrentStatus>'
+                '<location><content>Depot 0530</content></location>'
+                '<date><content>%s</content></date>'
+                '</statusInfo>' % (
+                    state, state, state.lower().replace('_', ' '),
+                    index < reached and 'true' or 'false',
+                    index == reached - 1 and 'true' or 'false',
+                    index < reached and date.strftime('%d-%m-%Y %H:%M')
+                    or ''))
+        return ENVELOPE % (
+            '<getTrackingDataResponse xmlns="%s"><trackingresult xmlns="">'
+            '<shipmentInfo><parcelLabelNumber>%s</parcelLabelNumber>'
+            '</shipmentInfo>%s</trackingresult></getTrackingDataResponse>' % (
+                NAMESPACES['getTrackingData'], escape(number),
+                ''.join(states)))
+
+    def find_parcel_shops(self, body):
+        # Place the postcodes somewhere in Belgium
+        digits = ''.join(c for c in body.findtext('zipCode') or ''
+                         if c.isdigit()) or '0'
+        latitude = 49.5 + int(digits) % 1000 / 500.0
+        longitude = 2.5 + int(digits) // 1000 % 10 / 2.0
+        return self.parcel_shops('findParcelShops', latitude, longitude,
+                                 body)
+
+    def find_parcel_shops_by_geo_data(self, body):
+        return self.parcel_shops(
+            'findParcelShopsByGeoData', float(body.findtext('latitude')),
+            float(body.findtext('longitude')), body)
+
+    def parcel_shops(self, action, latitude, longitude, body):
+        '''
+        Shops on a lattice of SHOP_STEP degrees, slightly moved around
+        their lattice point, the nearest --limit ones are returned
+        '''
+        limit = int(body.findtext('limit') or 20)
+        radius = int(math.ceil(math.sqrt(limit))) + 1
+        row = int(round(latitude / SHOP_STEP))
+        column = int(round(longitude / SHOP_STEP))
+        shops = []
+        for i in range(row - radius, row + radius + 1):
+            for j in range(column - radius, column + radius + 1):
+                seed = zlib.crc32(('%s:%s' % (i, j)).encode())
+                shop_latitude = i * SHOP_STEP + (seed % 1000) / 1e5
+                shop_longitude = j * SHOP_STEP + (seed // 1000 % 1000) / 1e5
+                distance = math.hypot(shop_latitude - latitude, (
+                    shop_longitude - longitude) * math.cos(
+                    math.radians(latitude))) * 111.2
+                shops.append((distance, seed, shop_latitude, shop_longitude))
+        shops.sort()
+        res = []
+        for distance, seed, shop_latitude, shop_longitude in shops[:limit]:
+            res.append(
+                '<parcelShop><parcelShopId>%s</parcelShopId>'
+                '<company>Parcel shop %s</company>'
+                '<street>Stationsstraat</street><houseNo>%s</houseNo>'
+                '<countryCode>BE</countryCode><zipCode>%s</zipCode>'
+                '<city>City %s</city><phone>+32 2 %07d</phone>'
+                '<latitude>%.6f</latitude><longitude>%.6f</longitude>'
+                '<distance>%.3f</distance>%s</parcelShop>' % (
+                    seed, seed % 10000, seed % 200 + 1, 1000 + seed % 9000,
+                    seed % 100, seed % 10000000, shop_latitude,
+                    shop_longitude, distance, ''.join(
+                        '<openingHours><weekday>%s</weekday>'
+                        '<openMorning>09:00</openMorning>'
+                        '<closeMorning>12:00</closeMorning>'
+                        '<openAfternoon>13:00</openAfternoon>'
+                        '<closeAfternoon>18:00</closeAfternoon>'
+                        '</openingHours>' % weekday
+                        for weekday in WEEKDAYS)))
+        return ENVELOPE % (
+            '<%sResponse xmlns="%s"><parcelShopFinderResult xmlns="">%s'
+            '</parcelShopFinderResult></%sResponse>' % (
+                action, NAMESPACES[action], ''.join(res), action))
+
+
+def soap_fault(code, message):
+    return ENVELOPE % (
+        '<s:Fault><faultcode>%s</faultcode><faultstring>%s</faultstring>'
+        '<detail><Fault><Message>%s</Message></Fault></detail>'
+        '</s:Fault>' % (code, escape(message), escape(message)))
+
+
+def auth_fault():
+    return ENVELOPE % (
+        '<s:Fault><faultcode>s:Server</faultcode>'
+        '<faultstring>Authentication failed</faultstring><detail>'
+        '<authenticationFault><errorCode>LOGIN_5</errorCode>'
+        '<errorMessage>The token is not valid</errorMessage>'
+        '<faultCodeField>LOGIN_5</faultCodeField>'
+        '<messageField>The token is not valid</messageField>'
+        '</authenticationFault></detail></s:Fault>')
+
+
+def local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.options.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send(self, status, body, content_type='text/xml; charset=utf-8'):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def service_file(self):
+        name = self.path.split('?', 1)[0].rsplit('/', 1)[-1]
+        return SERVICES.get(name)
+
+    def do_GET(self):
+        filename = self.service_file()
+        if not filename:
+            return self.send(404, 'Not found', 'text/plain')
+        with open(os.path.join(WSDL_DIR, filename)) as wsdl:
+            document = wsdl.read().replace(
+                'https://public-dis-stage.dpd.nl',
+                'http://%s:%s' % self.server.server_address[:2])
+        self.send(200, document)
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.service_file():
+            return self.send(404, 'Not found', 'text/plain')
+        try:
+            envelope = etree.fromstring(data)
+        except etree.XMLSyntaxError:
+            return self.send(400, soap_fault('s:Client', 'Invalid XML'))
+        headers = body = None
+        for part in envelope:
+            if local_name(part.tag) == 'Header':
+                headers = part
+            elif local_name(part.tag) == 'Body' and len(part):
+                body = part[0]
+        action = body is not None and local_name(body.tag)
+        if action not in NAMESPACES:
+            return self.send(500, soap_fault('s:Client',
+                                             'Unknown action %s' % action))
+        self.server.dpd.delay()
+        status, response = self.server.dpd.answer(action, body, headers)
+        self.send(status, response)
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=50,
+                        help='mean answer time in ms')
+    parser.add_argument('--jitter', type=float, default=10,
+                        help='standard deviation of the answer time in ms')
+    parser.add_argument('--fault-rate', type=float, default=0,
+                        help='share of the calls answered by a SOAP fault')
+    parser.add_argument('--unavailable-rate', type=float, default=0,
+                        help='share of the calls answered by a 503')
+    parser.add_argument('--token-expiry-rate', type=float, default=0,
+                        help='share of the calls refusing the token')
+    parser.add_argument('--order-fault-rate', type=float, default=0,
+                        help='share of the orders storeOrders rejects')
+    parser.add_argument('--label-kb', type=int, default=30,
+                        help='size of a label page')
+    parser.add_argument('--advance', type=float, default=3600,
+                        help='seconds before a parcel reaches its next '
+                             'tracking state')
+    parser.add_argument('--push-url',
+                        help='push the tracking states to this endpoint')
+    parser.add_argument('--push-token', default='',
+                        help='dpd_push_token of the Odoo server')
+    parser.add_argument('--push-interval', type=float, default=10,
+                        help='seconds between two pushes')
+    parser.add_argument('--verbose', action='store_true')
+    options = parser.parse_args()
+
+    server = Server((options.host, options.port), Handler)
+    server.options = options
+    server.dpd = FakeDPD(options)
+    if options.push_url:
+        pusher = threading.Thread(target=server.dpd.push_states)
+        pusher.daemon = True
+        pusher.start()
+    print('Fake DPD services on http://%s:%s' % (options.host, options.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
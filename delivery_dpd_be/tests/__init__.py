@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+from . import test_envelope
+from . import test_guard
+from . import test_parser
+from . import test_price_simulation
+from . import test_rate_cache
+from . import test_sync_claim
+from . import test_tracking_push
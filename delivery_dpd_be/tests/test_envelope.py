@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import os
+
+from lxml import etree
+from zeep import Client
+
+from odoo.tests import common
+
+from odoo.addons.delivery_dpd_be.models import dpd_envelope
+
+WSDL_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'scripts', 'wsdl')
+
+HEADERS = {
+    'authentication': {
+        'delisId': 'delis01',
+        'authToken': 'token-01',
+        'messageLanguage': 'nl_BE',
+    },
+}
+SENDER = {
+    'name1': 'YourCompany',
+    'street': 'Rue de la Loi 16',
+    'zipCode': '1000',
+    'city': 'Bruxelles',
+    'state': False,
+    'country': 'BE',
+}
+RECIPIENT = {
+    'name1': u'Ørsted & Søn',
+    'street': 'Keizersgracht 1',
+    'zipCode': '1015 CJ',
+    'city': 'Amsterdam',
+    'state': 'Noord-Holland',
+    'country': 'NL',
+}
+
+
+def get_order(reference, weights):
+    return {
+        'generalShipmentData': {
+            'sendingDepot': '0530',
+            'product': 'CL',
+            'sender': SENDER,
+            'recipient': RECIPIENT,
+        },
+        'parcels': [{
+            'customerReferenceNumber1': '%s/%s' % (reference, index),
+            'weight': weight,
+        } for index, weight in enumerate(weights)],
+        'productAndServiceData': {'orderType': 'consignment'},
+    }
+
+
+class TestEnvelope(common.BaseCase):
+    '''
+    The envelopes built by dpd_envelope are sent instead of the ones of
+    the zeep bindings, they must be identical
+    '''
+
+    def assertSameEnvelope(self, wsdl, action, **kwargs):
+        binding = Client(os.path.join(WSDL_DIR, wsdl)).service._binding
+        expected = binding.create_message(action, **kwargs)
+        headers = kwargs.pop('_soapheaders', None)
+        envelope = dpd_envelope.create_message(action, headers=headers,
+                                               **kwargs)
+        self.assertEqual(etree.tostring(envelope), etree.tostring(expected))
+
+    def test_get_auth(self):
+        self.assertSameEnvelope(
+            'login.wsdl', 'getAuth', delisId='delis01',
+            password='secret', messageLanguage='fr_BE')
+
+    def test_store_orders(self):
+        self.assertSameEnvelope(
+            'shipment.wsdl', 'storeOrders',
+            printOptions={'printerLanguage': 'PDF', 'paperFormat': 'A6'},
+            order=[get_order('WH/OUT/00001', [150]),
+                   get_order('WH/OUT/00002', [2000, 3150])],
+            _soapheaders=HEADERS)
+
+    def test_get_tracking_data(self):
+        self.assertSameEnvelope(
+            'tracking.wsdl', 'getTrackingData',
+            parcelLabelNumber='05305000000001', _soapheaders=HEADERS)
+
+    def test_find_parcel_shops(self):
+        self.assertSameEnvelope(
+            'parcelshop.wsdl', 'findParcelShops', country='BE',
+            zipCode='9000', city='Gent', limit=20, _soapheaders=HEADERS)
+
+    def test_find_parcel_shops_by_geo_data(self):
+        self.assertSameEnvelope(
+            'parcelshop.wsdl', 'findParcelShopsByGeoData',
+            latitude=50.85, longitude=4.35, limit=20, _soapheaders=HEADERS)
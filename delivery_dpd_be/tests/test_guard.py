@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+import uuid
+
+from unittest.mock import patch
+
+from odoo.sql_db import db_connect
+from odoo.tests import common
+from odoo.tools import config
+
+from odoo.addons.delivery_dpd_be.models import dpd_guard
+
+
+class TestCircuitBreaker(common.BaseCase):
+
+    def setUp(self):
+        super(TestCircuitBreaker, self).setUp()
+        self.breaker = dpd_guard.CircuitBreaker(failures=3, reset_timeout=30)
+
+    def expire(self):
+        # As if reset_timeout seconds passed since the circuit opened
+        self.breaker.opened_at -= self.breaker.reset_timeout
+
+    def test_open(self):
+        breaker = self.breaker
+        self.assertFalse(breaker.record_failure())
+        self.assertFalse(breaker.record_failure())
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.record_failure())
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        self.assertGreater(breaker.retry_after(), 29)
+
+    def test_success_resets_failures(self):
+        breaker = self.breaker
+        breaker.record_failure()
+        breaker.record_failure()
+        breaker.record_success()
+        self.assertFalse(breaker.record_failure())
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_probe_closes(self):
+        breaker = self.breaker
+        for index in range(3):
+            breaker.record_failure()
+        self.expire()
+        self.assertEqual(breaker.state, 'half_open')
+        # A single probe call is let through
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow())
+
+    def test_probe_reopens(self):
+        breaker = self.breaker
+        for index in range(3):
+            breaker.record_failure()
+        self.expire()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.record_failure())
+        self.assertEqual(breaker.state, 'open')
+        self.assertFalse(breaker.allow())
+        self.expire()
+        self.assertTrue(breaker.allow())
+
+    def test_release(self):
+        breaker = self.breaker
+        for index in range(3):
+            breaker.record_failure()
+        self.expire()
+        self.assertTrue(breaker.allow())
+        # Only the thread of the probe ends it
+        thread = threading.Thread(target=breaker.release)
+        thread.start()
+        thread.join()
+        self.assertFalse(breaker.allow())
+        breaker.release()
+        self.assertEqual(breaker.state, 'half_open')
+        self.assertTrue(breaker.allow())
+
+
+class TestRateLimit(common.BaseCase):
+
+    def setUp(self):
+        super(TestRateLimit, self).setUp()
+        self.dbname = common.get_db_name()
+        # A service of its own, its bucket is committed by acquire
+        self.url = 'http://dpd.test/%s' % uuid.uuid4().hex
+        self.addCleanup(self.drop_bucket)
+        patcher = patch.dict(config.options, {
+            'dpd_rate_limit': '1',
+            'dpd_rate_burst': '2',
+            'dpd_rate_limit_wait': '0.01',
+        })
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def drop_bucket(self):
+        dpd_guard._buckets.pop((self.dbname, 'getAuth', self.url), None)
+        with db_connect(self.dbname).cursor() as cr:
+            cr.execute("DELETE FROM dpd_rate_limit WHERE url = %s",
+                       (self.url,))
+
+    def test_acquire(self):
+        # The burst is available at once, then one call per second
+        self.assertTrue(dpd_guard.acquire(self.dbname, 'getAuth', self.url))
+        self.assertTrue(dpd_guard.acquire(self.dbname, 'getAuth', self.url))
+        self.assertFalse(dpd_guard.acquire(self.dbname, 'getAuth', self.url))
+        with patch.dict(config.options, {'dpd_rate_limit_wait': '5'}):
+            start = time.time()
+            self.assertTrue(dpd_guard.acquire(
+                self.dbname, 'getAuth', self.url))
+            self.assertGreater(time.time() - start, 0.5)
+
+    def test_acquire_without_limit(self):
+        dpd_guard.acquire(self.dbname, 'getAuth', self.url)
+        with db_connect(self.dbname).cursor() as cr:
+            cr.execute("UPDATE dpd_rate_limit SET rate = 0 WHERE url = %s",
+                       (self.url,))
+        for index in range(5):
+            self.assertTrue(dpd_guard.acquire(
+                self.dbname, 'getAuth', self.url))
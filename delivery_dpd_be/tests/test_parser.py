@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import base64
+from datetime import datetime
+
+from odoo.tests import common
+
+from odoo.addons.delivery_dpd_be.models import dpd_parser
+
+ENVELOPE = ('<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">'
+            '<s:Body>%s</s:Body></s:Envelope>')
+LABEL = b'%PDF-1.4 label of the parcels\n' * 50
+
+STORE_ORDERS_RESPONSE = ENVELOPE % (
+    '<storeOrdersResponse xmlns="http://dpd.com/common/service/types/'
+    'ShipmentService/3.1"><orderResult xmlns="">'
+    '<parcellabelsPDF>%s</parcellabelsPDF>'
+    '<shipmentResponses><mpsId>MPS1</mpsId>'
+    '<parcelInformation><parcelLabelNumber>05302000000001'
+    '</parcelLabelNumber></parcelInformation>'
+    '<parcelInformation><parcelLabelNumber>05302000000002'
+    '</parcelLabelNumber></parcelInformation>'
+    '</shipmentResponses>'
+    '<shipmentResponses><mpsId></mpsId>'
+    '<faults><faultCode>COMMON_7</faultCode>'
+    '<message>Invalid zip code</message></faults>'
+    '</shipmentResponses>'
+    '</orderResult></storeOrdersResponse>' %
+    base64.b64encode(LABEL).decode())
+
+TRACKING_RESPONSE = ENVELOPE % (
+    '<getTrackingDataResponse xmlns="http://dpd.com/common/service/types/'
+    'ParcelLifeCycleService/2.0"><trackingresult xmlns="">'
+    '<statusInfo><status>ACCEPTED</status>'
+    '<description><content><content>Parcel accepted</content></content>'
+    '</description>'
+    '<statusHasBeenReached>true</statusHasBeenReached>'
+    '<isCurrentStatus>false</isCurrentStatus>'
+    '<location><content>Depot 0530</content></location>'
+    '<date><content>15-01-2018 10:30</content></date>'
+    '</statusInfo>'
+    '<statusInfo><status>ON_THE_ROAD</status>'
+    '<description><content><content>On the road</content></content>'
+    '</description>'
+    '<importantItems><content><content>Delayed</content></content>'
+    '</importantItems>'
+    '<statusHasBeenReached>true</statusHasBeenReached>'
+    '<isCurrentStatus>true</isCurrentStatus>'
+    '<location><content>Depot 0532</content></location>'
+    '<date><content>16-01-2018 08:00</content></date>'
+    '</statusInfo>'
+    '<statusInfo><status>DELIVERED</status>'
+    '<statusHasBeenReached>false</statusHasBeenReached>'
+    '<isCurrentStatus>false</isCurrentStatus>'
+    '</statusInfo>'
+    '</trackingresult></getTrackingDataResponse>')
+
+PARCEL_SHOPS_RESPONSE = ENVELOPE % (
+    '<findParcelShopsResponse xmlns="http://dpd.com/common/service/types/'
+    'ParcelShopFinderService/3.0"><parcelShopFinderResult xmlns="">'
+    '<parcelShop><parcelShopId>1234</parcelShopId>'
+    '<company>Parcel shop</company><street>Stationsstraat</street>'
+    '<houseNo>12</houseNo><countryCode>BE</countryCode>'
+    '<zipCode>1000</zipCode><city>Brussel</city>'
+    '<latitude>50.845000</latitude><longitude>4.357000</longitude>'
+    '<openingHours><weekday>Monday</weekday>'
+    '<openMorning>09:00</openMorning><closeMorning>12:00</closeMorning>'
+    '<openAfternoon>13:00</openAfternoon>'
+    '<closeAfternoon>18:00</closeAfternoon></openingHours>'
+    '<openingHours><weekday>Saturday</weekday>'
+    '<openMorning>10:00</openMorning><closeMorning>14:00</closeMorning>'
+    '</openingHours>'
+    '</parcelShop>'
+    '</parcelShopFinderResult></findParcelShopsResponse>')
+
+
+class StreamedResponse(object):
+    # Stand-in of a streamed requests response, the chunks cut the text
+    # and the base64 label anywhere
+
+    def __init__(self, content, chunk_size=7):
+        self.content = content.encode('utf-8')
+        self.chunk_size = chunk_size
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), self.chunk_size):
+            yield self.content[start:start + self.chunk_size]
+
+
+class TestParser(common.BaseCase):
+
+    def test_parse_local_date(self):
+        # The dates of the polls are in the time of Brussels
+        self.assertEqual(dpd_parser.parse_date('15-01-2018 10:30'),
+                         datetime(2018, 1, 15, 9, 30))
+        self.assertEqual(dpd_parser.parse_date('15.07.2018 10:30:15'),
+                         datetime(2018, 7, 15, 8, 30, 15))
+        self.assertEqual(dpd_parser.parse_date(' 15-07-2018 '),
+                         datetime(2018, 7, 14, 22, 0))
+
+    def test_parse_iso_date(self):
+        self.assertEqual(dpd_parser.parse_date('2018-07-15T10:30:00Z'),
+                         datetime(2018, 7, 15, 10, 30))
+        self.assertEqual(
+            dpd_parser.parse_date('2018-07-15T10:30:00.25+02:00'),
+            datetime(2018, 7, 15, 8, 30, 0, 250000))
+        self.assertEqual(dpd_parser.parse_date('2018-07-15 10:30-0130'),
+                         datetime(2018, 7, 15, 12, 0))
+        # Without offset, in the time of Brussels
+        self.assertEqual(dpd_parser.parse_date('2018-07-15T10:30:00'),
+                         datetime(2018, 7, 15, 8, 30))
+
+    def test_parse_no_date(self):
+        for value in (None, '', '  ', 'tomorrow', '2018-13-45T10:30:00Z'):
+            self.assertIsNone(dpd_parser.parse_date(value), value)
+
+    def test_parse_store_orders(self):
+        res = dpd_parser.parse_response(
+            StreamedResponse(STORE_ORDERS_RESPONSE), 'storeOrders')
+        self.assertEqual(res.label.open().read(), LABEL)
+        self.assertEqual(res.label_number, '05302000000001')
+        self.assertEqual(res.shipments, [{
+            'parcelLabelNumbers': ['05302000000001', '05302000000002'],
+            'faults': [],
+        }, {
+            'parcelLabelNumbers': [],
+            'faults': [{'faultCode': 'COMMON_7',
+                        'message': 'Invalid zip code'}],
+        }])
+
+    def test_parse_tracking(self):
+        res = dpd_parser.parse_response(
+            StreamedResponse(TRACKING_RESPONSE), 'getTrackingData')
+        self.assertIsNone(res.label)
+        self.assertEqual(res.states, [{
+            'state': 'ACCEPTED',
+            'reached': True,
+            'current': False,
+            'location': 'Depot 0530',
+            'date': '15-01-2018 10:30',
+            'extra_info': 'Parcel accepted',
+        }, {
+            'state': 'ON_THE_ROAD',
+            'reached': True,
+            'current': True,
+            'location': 'Depot 0532',
+            'date': '16-01-2018 08:00',
+            'extra_info': 'On the road/Delayed',
+        }, {
+            'state': 'DELIVERED',
+            'reached': False,
+            'current': False,
+            'location': '',
+            'date': '',
+            'extra_info': '',
+        }])
+
+    def test_parse_parcel_shops(self):
+        shops = dpd_parser.parse_parcel_shops(
+            PARCEL_SHOPS_RESPONSE.encode('utf-8'))
+        self.assertEqual(len(shops), 1)
+        shop = shops[0]
+        self.assertEqual(shop['parcelShopId'], '1234')
+        self.assertEqual(shop['latitude'], '50.845000')
+        # The fields missing in the response are empty
+        self.assertEqual(shop['email'], '')
+        self.assertEqual(shop['openingHours'], [{
+            'weekday': 'Monday',
+            'openMorning': '09:00',
+            'closeMorning': '12:00',
+            'openAfternoon': '13:00',
+            'closeAfternoon': '18:00',
+        }, {
+            'weekday': 'Saturday',
+            'openMorning': '10:00',
+            'closeMorning': '14:00',
+            'openAfternoon': '',
+            'closeAfternoon': '',
+        }])
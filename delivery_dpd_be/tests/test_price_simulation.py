@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from odoo.tests import common
+
+from odoo.addons.delivery_dpd_be.wizard.price_simulation import \
+    evaluate_price_rules, numpy
+
+# total, weight, volume, quantity
+SHIPMENTS = [
+    (100.0, 1.0, 0.01, 1),
+    (50.0, 4.99, 0.02, 2),
+    (200.0, 5.0, 0.0, 3),
+    (20.0, 12.3, 0.1, 7),
+    (10.0, 40.0, 0.5, 25),
+]
+
+
+class DPDPriceCase(common.TransactionCase):
+
+    def setUp(self):
+        super(DPDPriceCase, self).setUp()
+        delivery_product = self.env['product.product'].create({
+            'name': 'DPD delivery',
+            'type': 'service',
+        })
+        self.carrier = self.env['delivery.carrier'].create({
+            'name': 'DPD test',
+            'delivery_type': 'dpd_be',
+            'integration_level': 'rate',
+            'product_id': delivery_product.id,
+            'price_rule_ids': [
+                (0, 0, {
+                    'sequence': 1,
+                    'variable': 'weight',
+                    'operator': '<=',
+                    'max_value': 5,
+                    'list_base_price': 5,
+                    'list_price': 0,
+                    'variable_factor': 'weight',
+                }),
+                (0, 0, {
+                    'sequence': 2,
+                    'variable': 'weight',
+                    'operator': '<=',
+                    'max_value': 30,
+                    'list_base_price': 8,
+                    'list_price': 0.5,
+                    'variable_factor': 'weight',
+                }),
+                (0, 0, {
+                    'sequence': 3,
+                    'variable': 'quantity',
+                    'operator': '>',
+                    'max_value': 0,
+                    'list_base_price': 20,
+                    'list_price': 2,
+                    'variable_factor': 'per_quantity',
+                    'quantity_per_value': 10,
+                }),
+            ],
+        })
+
+
+@unittest.skipIf(numpy is None, 'The price simulation needs numpy')
+class TestPriceSimulation(DPDPriceCase):
+
+    def test_evaluate_like_get_price_from_picking(self):
+        columns = dict(zip(('price', 'weight', 'volume', 'quantity'), (
+            numpy.array(values, dtype=float)
+            for values in zip(*SHIPMENTS))))
+        columns['wv'] = columns['volume'] * columns['weight']
+        prices, matched = evaluate_price_rules(
+            self.carrier._get_compiled_price_rules(), columns,
+            self.carrier.product_id.price)
+        self.assertTrue(matched.all())
+        for shipment, price in zip(SHIPMENTS, prices):
+            self.assertAlmostEqual(
+                price, self.carrier.get_price_from_picking(*shipment))
+
+    def _create_done_picking(self, weight, quantity):
+        product = self.env['product.product'].create({
+            'name': 'Shipped product',
+            'type': 'consu',
+            'weight': weight,
+        })
+        picking_type = self.env.ref('stock.picking_type_out')
+        location = picking_type.default_location_src_id
+        customers = self.env.ref('stock.stock_location_customers')
+        picking = self.env['stock.picking'].create({
+            'partner_id': self.env.ref('base.res_partner_2').id,
+            'picking_type_id': picking_type.id,
+            'location_id': location.id,
+            'location_dest_id': customers.id,
+            'carrier_id': self.carrier.id,
+            'move_lines': [(0, 0, {
+                'name': product.name,
+                'product_id': product.id,
+                'product_uom_qty': quantity,
+                'product_uom': product.uom_id.id,
+                'location_id': location.id,
+                'location_dest_id': customers.id,
+            })],
+        })
+        # Validating would send the picking to DPD
+        self.env.cr.execute("""
+            UPDATE stock_move SET state = 'done' WHERE picking_id = %s;
+            UPDATE stock_picking
+            SET state = 'done', date_done = now() at time zone 'UTC'
+            WHERE id = %s""", (picking.id, picking.id))
+        return picking
+
+    def test_action_simulate(self):
+        self._create_done_picking(2.0, 1)
+        self._create_done_picking(3.0, 4)
+        simulation = self.env['dpd.price.simulation'].create({
+            'carrier_id': self.carrier.id,
+            'rule_ids': [(0, 0, {
+                'variable': 'weight',
+                'operator': '<=',
+                'max_value': 5,
+                'list_base_price': 6,
+                'list_price': 0,
+                'variable_factor': 'weight',
+            }), (0, 0, {
+                'sequence': 20,
+                'variable': 'weight',
+                'operator': '<=',
+                'max_value': 30,
+                'list_base_price': 8,
+                'list_price': 0.5,
+                'variable_factor': 'weight',
+            })],
+        })
+        simulation.action_simulate()
+        # 2 kg costs 5 then 6, 12 kg costs 14 with both rule sets
+        self.assertEqual(simulation.shipment_count, 2)
+        self.assertEqual(simulation.changed_count, 1)
+        self.assertEqual(simulation.unpriced_current, 0)
+        self.assertEqual(simulation.unpriced_proposed, 0)
+        self.assertAlmostEqual(simulation.current_total, 19)
+        self.assertAlmostEqual(simulation.proposed_total, 20)
+        self.assertAlmostEqual(simulation.delta_total, 1)
+        self.assertEqual(sum(simulation.bucket_ids.mapped('shipment_count')),
+                         2)
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import time
+from unittest.mock import patch
+
+from odoo.tests import common
+
+from odoo.addons.delivery_dpd_be.models import dpd_cache
+
+from .test_price_simulation import DPDPriceCase
+
+
+class TestQuoteCache(common.BaseCase):
+
+    def test_lru(self):
+        cache = dpd_cache.QuoteCache(size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        # b is the least recently used
+        cache.set('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 1, 'size': 2})
+
+    def test_ttl(self):
+        cache = dpd_cache.QuoteCache(size=2, ttl=60)
+        cache.set('a', 1)
+        with patch('time.time', return_value=time.time() + 61):
+            self.assertIsNone(cache.get('a'))
+        # The expired entry is dropped
+        self.assertEqual(cache.stats()['size'], 0)
+
+
+class TestRateCache(DPDPriceCase):
+
+    def setUp(self):
+        super(TestRateCache, self).setUp()
+        self.carrier.dpd_shipping_cost_type = 'base_on_rule'
+        self.product = self.env['product.product'].create({
+            'name': 'Quoted product',
+            'type': 'consu',
+            'weight': 2.0,
+            'list_price': 10.0,
+        })
+        self.order = self.env['sale.order'].create({
+            'partner_id': self.env.ref('base.res_partner_2').id,
+            'carrier_id': self.carrier.id,
+            'order_line': [(0, 0, {
+                'product_id': self.product.id,
+                'product_uom_qty': 1,
+            })],
+        })
+        dpd_cache.rate_cache.clear()
+
+    def test_quote_cached(self):
+        self.assertEqual(
+            self.carrier.dpd_be_rate_shipment(self.order)['price'], 5)
+        hits = dpd_cache.rate_cache.stats()['hits']
+        self.assertEqual(
+            self.carrier.dpd_be_rate_shipment(self.order)['price'], 5)
+        self.assertEqual(dpd_cache.rate_cache.stats()['hits'], hits + 1)
+
+    def test_price_rule_changes_key(self):
+        key = self.carrier._get_rate_cache_key(self.order)
+        self.carrier.dpd_be_rate_shipment(self.order)
+        self.carrier.price_rule_ids.filtered(
+            lambda rule: rule.max_value == 5).list_base_price = 7
+        self.assertNotEqual(self.carrier._get_rate_cache_key(self.order), key)
+        self.assertEqual(
+            self.carrier.dpd_be_rate_shipment(self.order)['price'], 7)
+
+    def test_pricelist_item_changes_key(self):
+        key = self.carrier._get_rate_cache_key(self.order)
+        pricelist = self.order.pricelist_id
+        # The prices of the other products don't change the quotes
+        self.env['product.pricelist.item'].create({
+            'pricelist_id': pricelist.id,
+            'applied_on': '0_product_variant',
+            'product_id': self.product.id,
+            'fixed_price': 8,
+        })
+        self.assertEqual(self.carrier._get_rate_cache_key(self.order), key)
+        self.env['product.pricelist.item'].create({
+            'pricelist_id': pricelist.id,
+            'applied_on': '0_product_variant',
+            'product_id': self.carrier.product_id.id,
+            'fixed_price': 4,
+        })
+        self.assertNotEqual(self.carrier._get_rate_cache_key(self.order), key)
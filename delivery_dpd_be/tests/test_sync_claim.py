@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta
+from unittest.mock import patch
+
+from odoo import fields
+
+from .test_tracking_push import DPDTrackingCase
+
+
+class TestSyncClaim(DPDTrackingCase):
+
+    def setUp(self):
+        super(TestSyncClaim, self).setUp()
+        self.pickings = self.picking | self.create_picking(
+            '05302000000002') | self.create_picking('05302000000003')
+        # The claims are committed
+        patcher = patch.object(self.env.cr, 'commit')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_claim(self):
+        picking_model = self.env['stock.picking']
+        now = datetime.now()
+        self.pickings[0].dpd_next_poll_date = fields.Datetime.to_string(
+            now - timedelta(hours=1))
+        self.pickings[1].dpd_next_poll_date = fields.Datetime.to_string(
+            now - timedelta(hours=2))
+        self.pickings[2].dpd_next_poll_date = fields.Datetime.to_string(
+            now + timedelta(hours=1))
+        # The most overdue first
+        claimed = picking_model._dpd_claim_sync(1, 30)
+        self.assertEqual(claimed, self.pickings[1])
+        lease_end = fields.Datetime.from_string(claimed.dpd_next_poll_date)
+        self.assertLess(abs(lease_end - now - timedelta(minutes=30)),
+                        timedelta(minutes=1))
+        # The claimed pickings aren't due until the end of their lease
+        self.assertEqual(picking_model._dpd_claim_sync(5, 30),
+                         self.pickings[0])
+        self.assertFalse(picking_model._dpd_claim_sync(5, 30))
+
+    def test_lease_covers_time_budget(self):
+        picking_model = self.env['stock.picking']
+        set_param = self.env['ir.config_parameter'].sudo().set_param
+        set_param('delivery_dpd_be.sync_lease', 15)
+        set_param('delivery_dpd_be.sync_time_budget', 120)
+        leases = []
+
+        def claim_sync(model, limit, lease):
+            leases.append(lease)
+            return model.browse()
+
+        with patch.object(type(picking_model), '_dpd_claim_sync',
+                          claim_sync):
+            picking_model._check_delivery_synchro(runner=True)
+        # A chunk can be polled until the end of the time budget
+        self.assertEqual(len(leases), 1)
+        self.assertGreater(leases[0], 120)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+from unittest.mock import patch
+
+from odoo.tests import common
+from odoo.tools import config
+
+PARCEL_NUMBER = '05302000000001'
+
+
+class DPDTrackingMixin(object):
+
+    def setUpDPD(self):
+        delivery_product = self.env['product.product'].create({
+            'name': 'DPD delivery',
+            'type': 'service',
+        })
+        self.carrier = self.env['delivery.carrier'].create({
+            'name': 'DPD test',
+            'delivery_type': 'dpd_be',
+            'product_id': delivery_product.id,
+        })
+        self.picking = self.create_picking(PARCEL_NUMBER)
+
+    def create_picking(self, parcel_number):
+        picking_type = self.env.ref('stock.picking_type_out')
+        return self.env['stock.picking'].create({
+            'partner_id': self.env.ref('base.res_partner_2').id,
+            'picking_type_id': picking_type.id,
+            'location_id': picking_type.default_location_src_id.id,
+            'location_dest_id':
+                self.env.ref('stock.stock_location_customers').id,
+            'carrier_id': self.carrier.id,
+            'carrier_tracking_ref': parcel_number,
+        })
+
+    def get_events(self, picking):
+        return self.env['stock.picking.tracking.event'].search(
+            [('picking_id', '=', picking.id)], order='date')
+
+
+class DPDTrackingCase(DPDTrackingMixin, common.TransactionCase):
+
+    def setUp(self):
+        super(DPDTrackingCase, self).setUp()
+        self.setUpDPD()
+
+
+class TestTrackingPush(DPDTrackingCase):
+
+    def apply(self, *rows):
+        # Rows of dpd.tracking.push like _claim returns them
+        self.env['dpd.tracking.push']._apply_rows([
+            (index, parcel_number, status, timestamp, '0530')
+            for index, (parcel_number, status, timestamp)
+            in enumerate(rows, 1)])
+        self.picking.invalidate_cache()
+
+    def test_latest_is_current(self):
+        self.apply(
+            (PARCEL_NUMBER, 'ON_THE_ROAD', '2018-07-16T08:00:00Z'),
+            (PARCEL_NUMBER, 'AT_DELIVERY_DEPOT', '2018-07-16T15:00:00Z'),
+            (PARCEL_NUMBER, 'AT_SENDING_DEPOT', '2018-07-15T18:00:00Z'),
+            ('05302000009999', 'ACCEPTED', '2018-07-15T10:00:00Z'),
+            (PARCEL_NUMBER, 'LOST', '2018-07-17T10:00:00Z'))
+        self.assertEqual(self.picking.delivery_state, 'AT_DELIVERY_DEPOT')
+        self.assertEqual(self.picking.delivery_state_date,
+                         '2018-07-16 15:00:00')
+        self.assertEqual(self.get_events(self.picking).mapped('state'), [
+            'AT_SENDING_DEPOT', 'ON_THE_ROAD', 'AT_DELIVERY_DEPOT'])
+
+    def test_older_notification(self):
+        self.picking.write({
+            'delivery_state': 'AT_DELIVERY_DEPOT',
+            'delivery_state_date': '2018-07-16 15:00:00',
+        })
+        self.apply((PARCEL_NUMBER, 'ON_THE_ROAD', '2018-07-16T08:00:00Z'))
+        # Only kept in the history
+        self.assertEqual(self.picking.delivery_state, 'AT_DELIVERY_DEPOT')
+        self.assertEqual(self.get_events(self.picking).mapped('state'),
+                         ['ON_THE_ROAD'])
+
+    def test_delivered(self):
+        self.picking.write({
+            'delivery_state': 'DELIVERED',
+            'delivery_state_date': '2018-07-16 15:00:00',
+        })
+        self.apply(
+            (PARCEL_NUMBER, 'AT_DELIVERY_DEPOT', '2018-07-17T08:00:00Z'))
+        self.assertEqual(self.picking.delivery_state, 'DELIVERED')
+
+
+@common.at_install(False)
+@common.post_install(True)
+class TestTrackingPushController(DPDTrackingMixin, common.HttpCase):
+
+    def setUp(self):
+        super(TestTrackingPushController, self).setUp()
+        # The requests see the records of the cursor of the test mode
+        self.env = self.env(cr=self.registry.cursor())
+        self.addCleanup(self.env.cr.close)
+        self.setUpDPD()
+        for patcher in (
+                patch.dict(config.options, {'dpd_push_token': 'secret'}),
+                # _apply_pushed commits its batches
+                patch.object(self.env.cr, 'commit')):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def apply_pushed(self):
+        self.env['dpd.tracking.push']._apply_pushed()
+        self.picking.invalidate_cache()
+        self.assertEqual(self.picking.delivery_state, 'AT_DELIVERY_DEPOT')
+        self.assertEqual(self.picking.delivery_state_date,
+                         '2018-07-16 15:00:00')
+        self.assertEqual(len(self.get_events(self.picking)), 3)
+
+    def test_push(self):
+        for status, timestamp in (
+                ('ON_THE_ROAD', '2018-07-16T10:00:00+02:00'),
+                ('AT_DELIVERY_DEPOT', '2018-07-16T17:00:00+02:00'),
+                ('AT_SENDING_DEPOT', '2018-07-15T20:00:00+02:00')):
+            response = self.url_open(
+                '/delivery_dpd_be/tracking/push', data={
+                    'token': 'secret',
+                    'parcel_number': PARCEL_NUMBER,
+                    'status': status,
+                    'timestamp': timestamp,
+                    'depot': '0530',
+                })
+            self.assertEqual(response.status_code, 202)
+        self.apply_pushed()
+
+    def test_push_batch(self):
+        response = self.opener.post(
+            'http://%s:%s/delivery_dpd_be/tracking/push_batch' % (
+                common.HOST, common.PORT), json={
+                'jsonrpc': '2.0',
+                'method': 'call',
+                'params': {'token': 'secret', 'events': [{
+                    'parcel_number': PARCEL_NUMBER,
+                    'status': status,
+                    'timestamp': timestamp,
+                } for status, timestamp in (
+                    ('AT_DELIVERY_DEPOT', '2018-07-16T15:00:00Z'),
+                    ('AT_SENDING_DEPOT', '2018-07-15T18:00:00Z'),
+                    ('ON_THE_ROAD', '2018-07-16T08:00:00Z'))]},
+            }, timeout=10)
+        self.assertEqual(response.json()['result'], {'accepted': 3})
+        self.apply_pushed()
+
+    def test_push_without_token(self):
+        response = self.url_open('/delivery_dpd_be/tracking/push', data={
+            'token': 'wrong',
+            'parcel_number': PARCEL_NUMBER,
+            'status': 'DELIVERED',
+        })
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(self.env['dpd.tracking.push'].search(
+            [('parcel_number', '=', PARCEL_NUMBER)]))
@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
 
-from . import wizard_test_connection
\ No newline at end of file
+from . import wizard_test_connection
+from . import price_simulation
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+from datetime import datetime, timedelta
+
+from odoo import fields, models, api, exceptions, _
+
+from odoo.addons.delivery_dpd_be.models.delivery_dpd import \
+    compile_price_rule, price_types
+
+_logger = logging.getLogger(__name__)
+
+try:
+    import numpy
+except ImportError:
+    _logger.debug('Cannot import numpy, the price simulation is disabled')
+    numpy = None
+
+# Upper bounds of the weight buckets of the simulation report, in kg
+WEIGHT_BUCKETS = (1.0, 3.0, 5.0, 10.0, 20.0, 31.5)
+
+
+def evaluate_price_rules(rules, columns, customer_price):
+    '''
+    Price all the shipments with compiled price rules at once, like
+    delivery.carrier.get_price_from_picking does for one shipment
+    :param rules: tuple of compile_price_rule values
+    :param columns: dict {variable: numpy array}, one value per shipment
+    :param customer_price: price of the delivery product
+    :return: array of prices, boolean array of the shipments a rule matched
+    '''
+    size = len(columns['weight'])
+    prices = numpy.zeros(size)
+    matched = numpy.zeros(size, dtype=bool)
+    for variable, compare, max_value, fixed, list_base_price, list_price, \
+            variable_factor, quantity_per_value in rules:
+        # The first matching rule prices a shipment
+        hit = ~matched & compare(columns[variable], max_value)
+        base_price = list_base_price if fixed else customer_price
+        if variable_factor == 'per_quantity':
+            price = (base_price + list_price) * numpy.ceil(
+                columns['quantity'] / quantity_per_value)
+        else:
+            price = base_price + list_price * columns[variable_factor]
+        prices = numpy.where(hit, price, prices)
+        matched |= hit
+    return prices, matched
+
+
+class DPDPriceSimulation(models.TransientModel):
+    _name = 'dpd.price.simulation'
+    _description = 'DPD shipping cost simulation'
+
+    carrier_id = fields.Many2one(
+        comodel_name='delivery.carrier',
+        string='Carrier',
+        required=True,
+    )
+    date_from = fields.Date(
+        string='Shipped from',
+        required=True,
+        default=lambda self: fields.Date.to_string(
+            datetime.now() - timedelta(days=365)),
+    )
+    date_to = fields.Date(
+        string='Shipped until',
+        required=True,
+        default=fields.Date.context_today,
+    )
+    rule_ids = fields.One2many(
+        comodel_name='dpd.price.simulation.rule',
+        inverse_name='simulation_id',
+        string='Proposed price rules',
+    )
+    bucket_ids = fields.One2many(
+        comodel_name='dpd.price.simulation.bucket',
+        inverse_name='simulation_id',
+        string='Costs per weight',
+        readonly=True,
+    )
+    shipment_count = fields.Integer(
+        string='Shipments',
+        readonly=True,
+    )
+    changed_count = fields.Integer(
+        string='Shipments with a new price',
+        readonly=True,
+    )
+    unpriced_current = fields.Integer(
+        string='Not priced by the current rules',
+        readonly=True,
+    )
+    unpriced_proposed = fields.Integer(
+        string='Not priced by the proposed rules',
+        readonly=True,
+    )
+    current_total = fields.Float(
+        string='Current cost',
+        readonly=True,
+    )
+    proposed_total = fields.Float(
+        string='Proposed cost',
+        readonly=True,
+    )
+    delta_total = fields.Float(
+        string='Difference',
+        readonly=True,
+    )
+    duration = fields.Float(
+        string='Computed in (s)',
+        readonly=True,
+    )
+
+    @api.onchange('carrier_id')
+    def _onchange_carrier_id(self):
+        # The proposal starts from the current rules of the carrier
+        self.rule_ids = [(5, 0, 0)] + [(0, 0, {
+            'sequence': rule.sequence,
+            'variable': rule.variable,
+            'operator': rule.operator,
+            'max_value': rule.max_value,
+            'price_type': rule.price_type,
+            'list_base_price': rule.list_base_price,
+            'list_price': rule.list_price,
+            'variable_factor': rule.variable_factor,
+            'quantity_per_value': rule.quantity_per_value,
+        }) for rule in self.carrier_id.price_rule_ids]
+
+    @api.multi
+    def _load_shipments(self):
+        '''
+        Total, volume, weight and quantity of the done pickings of the
+        carrier, one row per picking
+        :return: dict {variable: numpy array}
+        '''
+        self.env.cr.execute("""
+            SELECT
+                SUM(m.product_qty * COALESCE(l.price_reduce_taxinc, 0)),
+                SUM(m.product_qty * COALESCE(pp.volume, 0)),
+                SUM(m.product_qty * COALESCE(pp.weight, 0)),
+                SUM(m.product_qty)
+            FROM stock_picking AS p
+            JOIN stock_move AS m ON m.picking_id = p.id AND m.state = 'done'
+            JOIN product_product AS pp ON pp.id = m.product_id
+            LEFT JOIN sale_order_line AS l ON l.id = m.sale_line_id
+            WHERE p.carrier_id = %s AND p.state = 'done'
+                AND p.date_done >= %s AND p.date_done < %s::date + 1
+            GROUP BY p.id""", (self.carrier_id.id, self.date_from,
+                               self.date_to))
+        data = numpy.array(self.env.cr.fetchall(), dtype=float).reshape(
+            -1, 4)
+        columns = dict(zip(('price', 'volume', 'weight', 'quantity'),
+                           data.T))
+        columns['wv'] = columns['volume'] * columns['weight']
+        return columns
+
+    @api.multi
+    def _check_rules(self, rules):
+        for rule in rules:
+            if rule.variable_factor == 'per_quantity' and \
+                    not rule.quantity_per_value:
+                raise exceptions.UserError(
+                    _('The rule "%s" needs a quantity per value.') %
+                    rule.name)
+
+    @api.multi
+    def action_simulate(self):
+        self.ensure_one()
+        if numpy is None:
+            raise exceptions.UserError(
+                _('The price simulation needs the numpy Python library.'))
+        self._check_rules(self.carrier_id.price_rule_ids)
+        self._check_rules(self.rule_ids)
+        start = time.time()
+        columns = self._load_shipments()
+        customer_price = self.carrier_id.product_id.price
+        current, current_matched = evaluate_price_rules(
+            self.carrier_id._get_compiled_price_rules(), columns,
+            customer_price)
+        proposed, proposed_matched = evaluate_price_rules(
+            tuple(compile_price_rule(rule) for rule in self.rule_ids),
+            columns, customer_price)
+
+        # Only the shipments both rule sets price are compared
+        both = current_matched & proposed_matched
+        buckets = numpy.digitize(columns['weight'][both], WEIGHT_BUCKETS,
+                                 right=True)
+        size = len(WEIGHT_BUCKETS) + 1
+        counts = numpy.bincount(buckets, minlength=size)
+        current_totals = numpy.bincount(
+            buckets, weights=current[both], minlength=size)
+        proposed_totals = numpy.bincount(
+            buckets, weights=proposed[both], minlength=size)
+        bounds = (0.0,) + WEIGHT_BUCKETS + (None,)
+        bucket_values = [(5, 0, 0)]
+        for index in range(size):
+            if not counts[index]:
+                continue
+            if bounds[index + 1] is None:
+                name = _('> %s kg') % bounds[index]
+            else:
+                name = _('%s - %s kg') % (bounds[index], bounds[index + 1])
+            bucket_values.append((0, 0, {
+                'sequence': index,
+                'name': name,
+                'shipment_count': int(counts[index]),
+                'current_total': float(current_totals[index]),
+                'proposed_total': float(proposed_totals[index]),
+                'delta_total': float(proposed_totals[index] -
+                                     current_totals[index]),
+            }))
+
+        current_total = float(current[both].sum())
+        proposed_total = float(proposed[both].sum())
+        self.write({
+            'shipment_count': len(both),
+            'changed_count': int((both & ~numpy.isclose(
+                current, proposed)).sum()),
+            'unpriced_current': int((~current_matched).sum()),
+            'unpriced_proposed': int((~proposed_matched).sum()),
+            'current_total': current_total,
+            'proposed_total': proposed_total,
+            'delta_total': proposed_total - current_total,
+            'duration': time.time() - start,
+            'bucket_ids': bucket_values,
+        })
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
+
+
+class DPDPriceSimulationRule(models.TransientModel):
+    _name = 'dpd.price.simulation.rule'
+    _description = 'Proposed DPD price rule'
+    _order = 'sequence, id'
+
+    simulation_id = fields.Many2one(
+        comodel_name='dpd.price.simulation',
+        string='Simulation',
+        required=True,
+        ondelete='cascade',
+    )
+    name = fields.Char(
+        string='Name',
+        compute='_compute_name',
+    )
+    sequence = fields.Integer(
+        string='Sequence',
+        default=10,
+    )
+    variable = fields.Selection(
+        selection='_get_variables',
+        string='Variable',
+        required=True,
+        default='weight',
+    )
+    operator = fields.Selection(
+        selection='_get_operators',
+        string='Operator',
+        required=True,
+        default='<=',
+    )
+    max_value = fields.Float(
+        string='Maximum Value',
+        required=True,
+    )
+    price_type = fields.Selection(
+        selection=price_types,
+        default='fixed',
+        string='Price type',
+    )
+    list_base_price = fields.Float(
+        string='Sale Base Price',
+    )
+    list_price = fields.Float(
+        string='Sale Price',
+    )
+    variable_factor = fields.Selection(
+        selection='_get_variable_factors',
+        string='Variable Factor',
+        required=True,
+        default='weight',
+    )
+    quantity_per_value = fields.Float(
+        string='Per Quantity of',
+    )
+
+    # Same choices as delivery.price.rule
+    def _get_variables(self):
+        return self.env['delivery.price.rule']._fields['variable'].selection
+
+    def _get_operators(self):
+        return self.env['delivery.price.rule']._fields['operator'].selection
+
+    def _get_variable_factors(self):
+        return self.env['delivery.price.rule']._fields[
+            'variable_factor'].selection
+
+    @api.depends('variable', 'operator', 'max_value')
+    def _compute_name(self):
+        for rule in self:
+            rule.name = 'if %s %s %s' % (rule.variable, rule.operator,
+                                         rule.max_value)
+
+
+class DPDPriceSimulationBucket(models.TransientModel):
+    _name = 'dpd.price.simulation.bucket'
+    _description = 'DPD shipping cost simulation per weight'
+    _order = 'sequence'
+
+    simulation_id = fields.Many2one(
+        comodel_name='dpd.price.simulation',
+        string='Simulation',
+        required=True,
+        ondelete='cascade',
+    )
+    sequence = fields.Integer(
+        string='Sequence',
+    )
+    name = fields.Char(
+        string='Weight',
+    )
+    shipment_count = fields.Integer(
+        string='Shipments',
+    )
+    current_total = fields.Float(
+        string='Current cost',
+    )
+    proposed_total = fields.Float(
+        string='Proposed cost',
+    )
+    delta_total = fields.Float(
+        string='Difference',
+    )